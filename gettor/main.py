@@ -16,9 +16,14 @@ This sets up GetTor and starts the servers running.
 
 from .utils.commons import log
 from .utils import options
+from .utils import ratelimit
+from .utils import stats
+from .utils.retention import Retention
 
 from .services import BaseService
 from .services.email.sendmail import Sendmail
+from .services.email.intake import IntakeService
+from .services.stats import StatsAPIService
 from .services.twitter.twitterdm import Twitterdm
 
 def run(gettor, app):
@@ -49,3 +54,34 @@ def run(gettor, app):
     gettor.addService(twitter_service)
 
     gettor.setServiceParent(app)
+
+    limiter = ratelimit.get_limiter(settings)
+    ratelimit_service = BaseService(
+        "ratelimit", limiter.get_interval(), limiter
+    )
+
+    gettor.addService(ratelimit_service)
+
+    collector = stats.get_stats(settings)
+    stats_service = BaseService(
+        "stats", collector.get_interval(), collector
+    )
+
+    gettor.addService(stats_service)
+
+    retention = Retention(settings)
+    retention_service = BaseService(
+        "retention", retention.get_interval(), retention
+    )
+
+    gettor.addService(retention_service)
+
+    if settings.get("intake_socket", None):
+        intake_service = IntakeService(settings)
+
+        gettor.addService(intake_service)
+
+    if settings.get("stats_api_port", None):
+        stats_api_service = StatsAPIService(settings)
+
+        gettor.addService(stats_api_service)
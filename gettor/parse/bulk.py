@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import os
+import time
+import sqlite3
+import hashlib
+import mailbox
+
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.python import log
+
+from ..utils.db import apply_pragmas, get_pragmas, get_shards
+from ..utils import migrations
+from ..utils.ratelimit import RateLimiter
+from .email import EmailParser
+
+# Parser used by each worker process, see init_worker()
+_parser = None
+
+
+def init_worker(settings, locales):
+    """
+    Initialize the email parser of a worker process. Workers only parse,
+    requests are stored by the parent, so the parser has no database. There
+    is no reactor either, so the DKIM and MX checks block the worker.
+    """
+    global _parser
+    _parser = EmailParser(
+        settings, settings.get("sendmail_addr"),
+        dkim=settings.get("email_dkim", False), db=False, blocking=True
+    )
+    _parser.locales = locales
+
+
+def close_worker():
+    """
+    Release the email parser of the current process.
+    """
+    global _parser
+    _parser = None
+
+
+def parse_message(msg_str):
+    """
+    Parse a message in a worker process. Errors are logged and the message
+    is skipped, as process_email would do.
+    """
+    try:
+        return _parser.parse(msg_str)
+    except Exception as e:
+        _parser.parse_errback(e)
+        return {}
+
+
+def open_mailbox(path, kind):
+    """
+    Open a Maildir or mbox mailbox.
+
+    :param path (str): path of the mailbox.
+    :param kind (str): `maildir` or `mbox`.
+    """
+    if kind == "maildir":
+        return mailbox.Maildir(path, factory=None, create=False)
+    elif kind == "mbox":
+        return mailbox.mbox(path, factory=None, create=False)
+    raise ValueError("Unknown mailbox type {}".format(kind))
+
+
+class BulkIngest(object):
+    """
+    Ingest the messages queued in a Maildir or mbox mailbox. Messages are
+    parsed in a pool of worker processes, rate limits are applied with a
+    RateLimiter and the resulting requests are stored with one transaction
+    per batch.
+    """
+
+    def __init__(self, settings, locales, checkpoint=None, batch_size=500,
+                 workers=None):
+        """
+        Constructor.
+
+        :param settings (Settings): GetTor settings.
+        :param locales (list): supported locales, as in EmailParser.
+        :param checkpoint (str): name under which the keys of the ingested
+        messages are recorded in the `ingested` table, so an interrupted
+        run can be resumed. Keys in a file of that name, as written by
+        older versions, are skipped too.
+        :param batch_size (int): number of messages per transaction.
+        :param workers (int): number of worker processes. With one worker or
+        less messages are parsed in the current process.
+        """
+        self.settings = settings
+        self.locales = locales
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.workers = workers
+        self.limit = settings.get("email_requests_limit")
+        self.test_hid = settings.get("test_hid")
+        self.done = set()
+        self.limiter = RateLimiter(
+            settings.get("dbname"),
+            window=settings.get("rate_limit_window", 86400),
+            num_buckets=settings.get("rate_limit_buckets", 24)
+        )
+
+        if checkpoint and os.path.isfile(checkpoint):
+            with open(checkpoint) as f:
+                self.done = set(line.strip() for line in f if line.strip())
+
+    def build_rows(self, requests):
+        """
+        Apply the rate limits to the parsed requests and return the rows to
+        insert in the requests table.
+        """
+        now = int(time.time())
+        rows = []
+        for request in requests:
+            if "command" not in request:
+                continue
+
+            hid = hashlib.sha256(request['id'].encode('utf-8')).hexdigest()
+            if hid != self.test_hid and not self.limiter.allow(
+                    request['service'], hid, self.limit):
+                log.msg(
+                    "Discarded. Too many requests from {}.".format(hid),
+                    system="bulk ingest"
+                )
+                continue
+
+            rows.append((
+                request['id'], request['command'], request['platform'],
+                request['language'], request['service'], now, "ONHOLD"
+            ))
+        return rows
+
+    def store(self, conn, rows, keys):
+        """
+        Store a batch of requests and record its keys under the checkpoint
+        in the same transaction, so a batch is either stored and skipped
+        when resuming, or not stored at all.
+        """
+        with conn:
+            conn.executemany(
+                "INSERT INTO requests(id, command, platform, language, service, "
+                "date, status) VALUES(?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            if self.checkpoint:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO ingested VALUES(?, ?)",
+                    [(self.checkpoint, key) for key in keys]
+                )
+        self.limiter.persist()
+        self.done.update(keys)
+
+    def batches(self, box):
+        """
+        Yield batches of (keys, messages) not ingested yet.
+        """
+        keys = []
+        messages = []
+        for key in box.iterkeys():
+            key = str(key)
+            if key in self.done:
+                continue
+            keys.append(key)
+            messages.append(
+                box.get_bytes(key).decode('utf-8', 'replace')
+            )
+            if len(keys) >= self.batch_size:
+                yield keys, messages
+                keys = []
+                messages = []
+        if keys:
+            yield keys, messages
+
+    def run(self, path, kind="maildir"):
+        """
+        Ingest all the messages of a mailbox.
+
+        :param path (str): path of the mailbox.
+        :param kind (str): `maildir` or `mbox`.
+
+        :return: dict with the number of messages, stored requests, elapsed
+        time and messages per second.
+        """
+        box = open_mailbox(path, kind)
+        if kind == "mbox":
+            # mbox keys are only stable while the file doesn't change
+            box.lock()
+
+        # Email requests go to their shard, if there is one
+        dbname = get_shards(self.settings).get(
+            "email", self.settings.get("dbname")
+        )
+        migrations.ensure_schema(dbname)
+        conn = sqlite3.connect(dbname)
+        apply_pragmas(conn, get_pragmas(self.settings))
+        self.limiter.load()
+        if self.checkpoint:
+            self.done.update(key for key, in conn.execute(
+                "SELECT key FROM ingested WHERE checkpoint=?",
+                (self.checkpoint,)
+            ))
+
+        if self.workers and self.workers > 1:
+            pool = ProcessPoolExecutor(
+                self.workers, initializer=init_worker,
+                initargs=(self.settings, self.locales)
+            )
+            parse = lambda msgs: pool.map(
+                parse_message, msgs,
+                chunksize=max(1, len(msgs) // (self.workers * 4))
+            )
+        else:
+            pool = None
+            init_worker(self.settings, self.locales)
+            parse = lambda msgs: map(parse_message, msgs)
+
+        num_messages = 0
+        num_stored = 0
+        start = time.time()
+        try:
+            for keys, messages in self.batches(box):
+                rows = self.build_rows(parse(messages))
+                self.store(conn, rows, keys)
+                num_messages += len(keys)
+                num_stored += len(rows)
+                elapsed = time.time() - start
+                log.msg(
+                    "Ingested {} messages ({:.1f} messages/s).".format(
+                        num_messages, num_messages / max(elapsed, 1e-6)
+                    ), system="bulk ingest"
+                )
+        finally:
+            if pool:
+                pool.shutdown()
+            else:
+                close_worker()
+            if kind == "mbox":
+                box.unlock()
+            box.close()
+            conn.close()
+
+        elapsed = time.time() - start
+        return {
+            "messages": num_messages,
+            "requests": num_stored,
+            "elapsed": elapsed,
+            "rate": num_messages / max(elapsed, 1e-6)
+        }
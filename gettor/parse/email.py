@@ -13,11 +13,9 @@
 from __future__ import absolute_import
 
 import re
-import io
-import dkim
+import time
 import hashlib
 
-from datetime import datetime
 import configparser
 
 from email import message_from_string
@@ -28,6 +26,15 @@ from twisted.internet import defer
 
 from ..utils.db import SQLite3
 from ..utils import validate_email
+from ..utils import dkim_verifier
+from ..utils import ratelimit
+from ..utils.blacklist import get_blacklist, BlacklistError
+from . import keywords
+from . import mime
+
+# Comments in Authentication-Results headers, e.g. (1024-bit key)
+AR_COMMENT_RE = re.compile(r"\([^()]*\)")
+
 
 class AddressError(Exception):
     """
@@ -46,22 +53,73 @@ class DKIMError(Exception):
 class EmailParser(object):
     """Class for parsing email requests."""
 
-    def __init__(self, settings, to_addr=None, dkim=False):
+    def __init__(self, settings, to_addr=None, dkim=False, db=True,
+                 blocking=False):
         """
         Constructor.
 
         param (Boolean) dkim: Set dkim verification to True or False.
+        param (Boolean) db: Open the database and the rate limiter. Parsers
+        that only call parse(), as the bulk ingest workers, go without.
+        param (Boolean) blocking: Run the DKIM and MX checks in the current
+        thread, so parse() never returns a deferred. For parsers without a
+        reactor, as the bulk ingest workers.
         """
         self.settings = settings
         self.dkim = dkim
+        self.blocking = blocking
         self.to_addr = to_addr
         self.locales = []
         self.platforms = self.settings.get("platforms")
-        self.conn = SQLite3(self.settings.get("dbname"))
+        self.max_tokens = self.settings.get(
+            "max_keyword_tokens", keywords.MAX_TOKENS
+        )
+        # `bounded` only looks at the headers and the first text part of
+        # a message, `full` searches the whole message
+        self.parse_mode = self.settings.get("email_parse_mode", "bounded")
+        self.max_body_bytes = self.settings.get(
+            "email_body_max_bytes", mime.MAX_BYTES
+        )
+        self.max_body_lines = self.settings.get(
+            "email_body_max_lines", mime.MAX_LINES
+        )
+        self.conn = None
+        self.limiter = None
+        if db:
+            self.conn = SQLite3.from_settings(self.settings)
+            self.limiter = ratelimit.get_limiter(self.settings)
+        self.blacklist = get_blacklist(self.settings)
+        self.test_hid = self.settings.get("test_hid")
+        if self.dkim:
+            self.verifier = dkim_verifier.get_verifier(self.settings)
+        # MX checks of the sender address, see validate_mx
+        self.check_mx = self.settings.get("email_check_mx", False)
+        self.verify_mx = self.settings.get("email_verify_mx", False)
+        # Resolved here, getfqdn() would block the reactor for each probe
+        self.helo_name = self.settings.get("mx_helo_name", "")
+        if self.verify_mx and not self.helo_name:
+            self.helo_name = validate_email.get_helo_name()
+        validate_email.configure_caches(
+            self.settings.get("mx_cache_size", 4096),
+            self.settings.get("mx_cache_ttl", 3600)
+        )
+        # authserv-id of the local MTA, whose DKIM results we trust
+        self.authserv_id = self.settings.get(
+            "dkim_trusted_authserv_id", ""
+        ).lower()
 
     def __del__(self):
         del self.conn
 
+    def close(self):
+        """
+        Stop using the database.
+
+        :return: deferred firing when the pools are closed, or None.
+        """
+        if self.conn is not None:
+            return self.conn.close()
+
     def normalize(self, msg):
         # Normalization will convert <Alice Wonderland> alice@wonderland.net
         # into alice@wonderland.net
@@ -99,6 +157,53 @@ class EmailParser(object):
             raise AddressError("Invalid email address {}".format(msg['From']))
 
 
+    def dkim_result(self, valid, norm_addr):
+        if valid:
+            log.msg("Valid DKIM signature.", system="email parser")
+            return True
+        else:
+            log.msg("Invalid DKIM signature.", system="email parser")
+            hid = hashlib.sha256(norm_addr.encode('utf-8'))
+            username, domain = norm_addr.split("@")
+            raise DKIMError(
+                "DKIM failed for {} at {}".format(
+                    hid.hexdigest(), domain
+                )
+            )
+
+    def auth_results_verdict(self, msg):
+        """
+        Get the DKIM verdict stamped by our own MTA in the
+        Authentication-Results header (RFC 8601). Our MTA is the last hop,
+        so its header is the topmost one. Any header below it, or any
+        header at all if the topmost one is from someone else, could have
+        been added by the sender and is ignored.
+
+        :param msg (Message): message headers.
+
+        :return: True if the MTA verified a DKIM signature, False if it
+        didn't, or None if the topmost header is not from the trusted MTA.
+        """
+        if not self.authserv_id:
+            return None
+
+        header = msg.get("Authentication-Results")
+        if header is None:
+            return None
+
+        header = AR_COMMENT_RE.sub("", str(header))
+        resinfo = [r.strip() for r in header.split(";")]
+        authserv_id = resinfo[0].split()
+        if not authserv_id or authserv_id[0].lower() != self.authserv_id:
+            return None
+
+        for result in resinfo[1:]:
+            method, _, value = result.partition("=")
+            if method.strip().lower() == "dkim" and \
+                    value.split() and value.split()[0].lower() == "pass":
+                return True
+        return False
+
     def dkim_verify(self, msg_str, norm_addr):
         # DKIM verification. Simply check that the server has verified the
         # message's signature
@@ -106,54 +211,40 @@ class EmailParser(object):
             log.msg("Checking DKIM signature.", system="email parser")
             # Note: msg.as_string() changes the message to conver it to
             # string, so DKIM will fail. Use the original string instead
-            if dkim.verify(msg_str):
-                log.msg("Valid DKIM signature.", system="email parser")
-                return True
-            else:
-                log.msg("Invalid DKIM signature.", system="email parser")
-                username, domain = norm_addr.split("@")
-                raise DkimError(
-                    "DKIM failed for {} at {}".format(
-                        hid.hexdigest(), domain
-                    )
-                )
+            valid = self.verifier.verify_sync(msg_str.encode('utf-8'))
+            return self.dkim_result(valid, norm_addr)
         # Is this even useful like this?
         else:
             return True
 
-    def parse_keywords(self, text, request):
+    def dkim_verify_async(self, msg_str, norm_addr):
+        """
+        Same as dkim_verify, but the signature is verified outside of the
+        reactor thread.
 
-        buf = io.StringIO(text)
-        for line in buf:
-            if len(line.strip()) > 0 and line.strip()[0] == ">":
-                continue
-            for word in re.split(r"\s+", line.strip()):
-                word = word.lower()
-                for locale in self.locales:
-                    if word == locale.lower():
-                        request["language"] = locale
-                    elif not request["language"]:
-                        parts = re.split(r"[-_]", word)
-                        if parts[0] == locale.lower()[:2]:
-                            request["language"] = locale
-                if word in self.platforms:
-                    request["command"] = "links"
-                    request["platform"] = word
-                if (not request["command"]) and word == "help":
-                    request["command"] = "help"
-        return request
+        :return: deferred firing with True, or failing with DKIMError.
+        """
+        if self.dkim:
+            log.msg("Checking DKIM signature.", system="email parser")
+            return self.verifier.verify(
+                msg_str.encode('utf-8')
+            ).addCallback(self.dkim_result, norm_addr)
+        return defer.succeed(True)
 
-    def build_request(self, msg_str, norm_addr):
-        # Search for commands keywords
-        subject_re = re.compile("Subject: (.*)\n")
-        subject = subject_re.search(msg_str)
+    def parse_keywords(self, text, request):
+        index = keywords.get_index(
+            self.locales, self.platforms, self.max_tokens
+        )
+        return index.parse(text, request)
 
-        # the body of a message is "a sequence of characters that follows the header
-        # section and is separated from the header section by an empty line"
-        # https://tools.ietf.org/html/rfc5322#section-2.1
-        body_re = re.compile("\r?\n\r?\n(.*)$", re.DOTALL)
-        body = body_re.search(msg_str)
+    def build_request(self, msg_str, norm_addr, msg=None, body_start=None):
+        """
+        Look for the command, platform and language of a message.
 
+        :param msg (email.message.Message): in bounded mode, the headers
+        parse() already got from mime.parse_headers(), and `body_start` the
+        offset of the body, so the headers aren't parsed twice.
+        """
         request = {
             "id": norm_addr,
             "command": None,
@@ -162,13 +253,33 @@ class EmailParser(object):
             "service": "email"
         }
 
+        # Search for commands keywords
+        if self.parse_mode == "bounded":
+            # Only decode the subject and the first text part, within the
+            # configured budget
+            headers, subject, body = mime.extract_text(
+                msg_str, self.max_body_bytes, self.max_body_lines, msg,
+                body_start
+            )
+        else:
+            subject_re = re.compile("Subject: (.*)\n")
+            subject = subject_re.search(msg_str)
+            if subject:
+                subject = subject.group(1)
+
+            # the body of a message is "a sequence of characters that follows the header
+            # section and is separated from the header section by an empty line"
+            # https://tools.ietf.org/html/rfc5322#section-2.1
+            body_re = re.compile("\r?\n\r?\n(.*)$", re.DOTALL)
+            body = body_re.search(msg_str)
+            if body:
+                body = body.group(1)
+
         if subject:
-            subject = subject.group(1)
             request = self.parse_keywords(subject, request)
 
         # Always parse the body too, to see if there's more specific information
         if body:
-            body = body.group(1)
             request = self.parse_keywords(body, request)
 
         if not request["language"]:
@@ -207,22 +318,40 @@ class EmailParser(object):
 
         :param msg_str (str): incomming message as string.
 
-        :return dict with email address and command (`links` or `help`).
+        :return dict with email address and command (`links` or `help`), or
+        a deferred firing with it if DKIM or MX checks are enabled.
         """
 
         log.msg("Building email message from string.", system="email parser")
 
-        msg = message_from_string(msg_str)
+        body_start = None
+        if self.parse_mode == "bounded":
+            headers, body_start = mime.split_message(msg_str)
+            msg = mime.parse_headers(headers)
+        else:
+            msg = message_from_string(msg_str)
 
         name, norm_addr, to_name, norm_to_addr = self.normalize(msg)
 
+        hid = hashlib.sha256(norm_addr.encode('utf-8'))
+        if hid.hexdigest() != self.test_hid:
+            try:
+                self.blacklist.is_blacklisted(hid.hexdigest(), "email")
+            except BlacklistError as e:
+                log.msg(
+                    "Discarded request from {}: {}.".format(
+                        hid.hexdigest(), e
+                    ),
+                    system="email parser"
+                )
+                return {}
+
         try:
             self.validate(norm_addr, msg)
         except AddressError as e:
             log.msg("Address error: {}".format(e.args))
             return {}
 
-        hid = hashlib.sha256(norm_addr.encode('utf-8'))
         log.msg(
             "Request from {}".format(hid.hexdigest()), system="email parser"
         )
@@ -233,12 +362,73 @@ class EmailParser(object):
                 log.msg("Intended recipient: {}".format(norm_to_addr))
                 return {}
 
-        try:
-            self.dkim_verify(msg_str, norm_addr)
-        except ValueError as e:
-            log.msg("DKIM error: {}".format(e.args))
+        if self.check_mx and self.blocking:
+            valid = validate_email.validate_email(
+                norm_addr, check_mx=True, verify=self.verify_mx,
+                smtp_timeout=self.settings.get("mx_smtp_timeout", 10)
+            )
+            return self.mx_callback(valid, msg, msg_str, norm_addr, body_start)
+
+        if self.check_mx:
+            return self.validate_mx(norm_addr).addCallback(
+                self.mx_callback, msg, msg_str, norm_addr, body_start
+            )
+
+        return self.verify_and_build(msg, msg_str, norm_addr, body_start)
+
+    def validate_mx(self, norm_addr):
+        """
+        Check the MX records (and optionally the mailbox) of an address
+        without blocking the reactor.
 
-        request = self.build_request(msg_str, norm_addr)
+        :return: deferred firing with True, False or None if unsure.
+        """
+        return validate_email.validate_email_async(
+            norm_addr, check_mx=True, verify=self.verify_mx,
+            smtp_timeout=self.settings.get("mx_smtp_timeout", 10),
+            helo_name=self.helo_name
+        )
+
+    def mx_callback(self, valid, msg, msg_str, norm_addr, body_start=None):
+        if valid is False:
+            log.msg(
+                "Address error: no valid MX for {}".format(
+                    norm_addr.split("@")[-1]
+                ), system="email parser"
+            )
+            return {}
+        return self.verify_and_build(msg, msg_str, norm_addr, body_start)
+
+    def verify_and_build(self, msg, msg_str, norm_addr, body_start=None):
+        """
+        Check the DKIM signature of a message, if enabled, and build the
+        request.
+
+        :return: the request, or a deferred firing with it.
+        """
+        # Headers parse() already got, reused in bounded mode
+        bounds = (msg, body_start) if self.parse_mode == "bounded" else ()
+        if self.dkim:
+            verdict = self.auth_results_verdict(msg)
+            if verdict is not None:
+                log.msg(
+                    "Using DKIM result from Authentication-Results.",
+                    system="email parser"
+                )
+                self.dkim_result(verdict, norm_addr)
+                return self.build_request(msg_str, norm_addr, *bounds)
+
+            if self.blocking:
+                self.dkim_verify(msg_str, norm_addr)
+                return self.build_request(msg_str, norm_addr, *bounds)
+
+            # A failed verification fails the returned deferred with
+            # DKIMError, so the message is dropped by parse_errback
+            return self.dkim_verify_async(msg_str, norm_addr).addCallback(
+                lambda _: self.build_request(msg_str, norm_addr, *bounds)
+            )
+
+        request = self.build_request(msg_str, norm_addr, *bounds)
 
         return request
 
@@ -257,7 +447,7 @@ class EmailParser(object):
         execution details.
         """
         email_requests_limit = self.settings.get("email_requests_limit")
-        now_str = datetime.now().strftime("%Y%m%d%H%M%S")
+        now = int(time.time())
         dbname = self.settings.get("dbname")
         test_hid = self.settings.get("test_hid")
 
@@ -271,12 +461,10 @@ class EmailParser(object):
                 system="email parser"
             )
 
-            num_requests = yield self.conn.get_num_requests(
-                id=hid, service=request_service
-            )
+            num_requests = self.limiter.count(request_service, hid)
 
             check = self.too_many_requests(
-                hid, test_hid, num_requests[0][0], email_requests_limit
+                hid, test_hid, num_requests, email_requests_limit
             )
 
             if check:
@@ -286,13 +474,14 @@ class EmailParser(object):
                     ), system="email parser"
                 )
             else:
-                self.conn.new_request(
+                self.limiter.add(request_service, hid)
+                yield self.conn.new_request(
                     id=request['id'],
                     command=request['command'],
                     platform=request['platform'],
                     language=request['language'],
                     service=request['service'],
-                    date=now_str,
+                    date=now,
                     status="ONHOLD",
                 )
         else:
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import io
+import re
+
+from functools import lru_cache
+
+# Maximum number of words scanned for keywords in a single text
+MAX_TOKENS = 2000
+
+WORD_RE = re.compile(r"\S+")
+PARTS_RE = re.compile(r"[-_]")
+
+
+class KeywordIndex(object):
+    """
+    Precompiled index of the keywords GetTor understands: platform names,
+    locale codes (and their two letter prefixes) and `help`. Looking up a
+    word costs the same regardless of the number of locales.
+    """
+
+    def __init__(self, locales, platforms, max_tokens=MAX_TOKENS):
+        """
+        Constructor.
+
+        :param locales (list): supported locales, e.g. `en-US`.
+        :param platforms (list): supported platforms, e.g. `linux`.
+        :param max_tokens (int): maximum number of words scanned per text.
+        """
+        self.max_tokens = max_tokens
+        self.platforms = frozenset(platforms)
+        self.locales = {}
+        self.prefixes = {}
+        for locale in locales:
+            # A word equal to several locales ends up with the last one,
+            # a prefix with the first one.
+            self.locales[locale.lower()] = locale
+            self.prefixes.setdefault(locale.lower()[:2], locale)
+
+    def tokens(self, text, skip_quoted=True):
+        """
+        Yield the lowercased words of a text, up to `max_tokens` words.
+
+        :param text (str): text to scan.
+        :param skip_quoted (bool): skip lines quoted with `>`.
+        """
+        count = 0
+        for line in io.StringIO(text):
+            if skip_quoted and line.lstrip().startswith(">"):
+                continue
+            for word in WORD_RE.finditer(line):
+                yield word.group(0).lower()
+                count += 1
+                if count >= self.max_tokens:
+                    return
+
+    def language(self, word, current=None):
+        """
+        Get the locale a word refers to. An exact match always wins, a
+        match on the language prefix (`es` in `es-MX`) is only used when
+        no language has been found yet.
+
+        :param word (str): lowercased word.
+        :param current (str): language found so far.
+
+        :return: the locale, or `current` if the word is not a locale.
+        """
+        locale = self.locales.get(word)
+        if locale:
+            return locale
+        if not current:
+            return self.prefixes.get(PARTS_RE.split(word, 1)[0], current)
+        return current
+
+    def parse(self, text, request):
+        """
+        Look for command, platform and language keywords in a text and
+        update the request accordingly.
+
+        :param text (str): text to scan.
+        :param request (dict): request being built.
+
+        :return: the updated request.
+        """
+        for word in self.tokens(text):
+            request["language"] = self.language(word, request["language"])
+            if word in self.platforms:
+                request["command"] = "links"
+                request["platform"] = word
+            if (not request["command"]) and word == "help":
+                request["command"] = "help"
+        return request
+
+
+@lru_cache(maxsize=16)
+def _get_index(locales, platforms, max_tokens):
+    return KeywordIndex(locales, platforms, max_tokens)
+
+
+def get_index(locales, platforms, max_tokens=MAX_TOKENS):
+    """
+    Get the keyword index for a set of locales and platforms. Indexes are
+    built once and shared by the email and twitter parsers.
+    """
+    return _get_index(tuple(locales), tuple(platforms), max_tokens)
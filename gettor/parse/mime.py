@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+"""
+Bounded parsing of incoming messages. Only the headers and the first
+text/plain part (or the first text/html part, stripped) are decoded, and
+never more than a fixed budget of bytes and lines. Attachments are skipped
+without being decoded.
+"""
+
+from __future__ import absolute_import
+
+import re
+import html
+import quopri
+import binascii
+
+from email.parser import HeaderParser
+from email.header import decode_header, make_header
+
+# Default budget for the decoded text of a message
+MAX_BYTES = 16384
+MAX_LINES = 200
+
+# Maximum depth of nested multipart parts
+MAX_DEPTH = 4
+
+BLANK_LINE_RE = re.compile(r"\r?\n\r?\n")
+TAG_RE = re.compile(r"<[^<>]*>")
+STYLE_RE = re.compile(r"<(style|script)[^<>]*>", re.IGNORECASE)
+STYLE_END_RE = {
+    name: re.compile(r"</{}\s*>".format(name), re.IGNORECASE)
+    for name in ("style", "script")
+}
+
+
+def split_message(msg_str):
+    """
+    Split a message in its header and body sections. The body is
+    "a sequence of characters that follows the header section and is
+    separated from the header section by an empty line".
+    https://tools.ietf.org/html/rfc5322#section-2.1
+
+    :return: (headers, body start offset). The offset is None if there is
+    no body.
+    """
+    blank = BLANK_LINE_RE.search(msg_str)
+    if blank:
+        return msg_str[:blank.start()], blank.end()
+    return msg_str, None
+
+
+def parse_headers(headers):
+    """
+    Parse a header section without touching the body.
+
+    :return: email.message.Message with the headers only.
+    """
+    return HeaderParser().parsestr(headers + "\n\n")
+
+
+def header_text(value):
+    """
+    Decode a header value with RFC 2047 encoded words, e.g. the subject.
+    """
+    if value is None:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except (UnicodeError, LookupError, binascii.Error, ValueError):
+        return str(value)
+
+
+def decode_body(msg_str, start, end, headers, max_bytes):
+    """
+    Decode at most `max_bytes` of a part body according to its transfer
+    encoding and charset. Only the encoded text needed for that is read.
+    """
+    encoding = (headers.get("Content-Transfer-Encoding") or "").strip().lower()
+    charset = headers.get_content_charset() or "utf-8"
+
+    if encoding == "base64":
+        # 4 base64 characters per 3 bytes, plus line breaks
+        raw = msg_str[start:min(end, start + max_bytes * 2)]
+        raw = "".join(raw.split())
+        raw = raw[:len(raw) - len(raw) % 4]
+        try:
+            data = binascii.a2b_base64(raw.encode("ascii", "ignore"))
+        except binascii.Error:
+            data = b""
+    elif encoding == "quoted-printable":
+        raw = msg_str[start:min(end, start + max_bytes * 3)]
+        data = quopri.decodestring(raw.encode("utf-8", "replace"))
+    else:
+        return msg_str[start:min(end, start + max_bytes)]
+
+    try:
+        return data[:max_bytes].decode(charset, "replace")
+    except LookupError:
+        return data[:max_bytes].decode("utf-8", "replace")
+
+
+def strip_styles(text):
+    """
+    Replace the style and script elements of an HTML part with a space.
+    The end tag is searched once from each start tag, and not at all once
+    there is none left, so unclosed tags don't take quadratic time.
+    """
+    parts = []
+    pos = 0
+    unclosed = set()
+    for start in STYLE_RE.finditer(text):
+        name = start.group(1).lower()
+        if start.start() < pos or name in unclosed:
+            continue
+        end = STYLE_END_RE[name].search(text, start.end())
+        if end is None:
+            unclosed.add(name)
+            continue
+        parts.append(text[pos:start.start()])
+        parts.append(" ")
+        pos = end.end()
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def strip_html(text):
+    """
+    Get the text of an HTML part.
+    """
+    text = strip_styles(text)
+    text = TAG_RE.sub(" ", text)
+    return html.unescape(text)
+
+
+def find_text(msg_str, start, end, headers, max_bytes, depth=0):
+    """
+    Find the first text part of a (possibly multipart) body between
+    `start` and `end`. Text parts sent as attachments are skipped.
+
+    :return: (text, is_html), or (None, False) if there is no text part.
+    """
+    if headers.get_content_disposition() == "attachment":
+        return None, False
+    ctype = headers.get_content_type()
+
+    if ctype == "text/plain":
+        return decode_body(msg_str, start, end, headers, max_bytes), False
+    if ctype == "text/html":
+        return decode_body(msg_str, start, end, headers, max_bytes), True
+    if not headers.get_content_maintype() == "multipart" or depth >= MAX_DEPTH:
+        return None, False
+
+    boundary = headers.get_boundary()
+    if not boundary:
+        return None, False
+
+    delimiter = "--" + boundary
+    html_text = None
+    pos = msg_str.find(delimiter, start, end)
+    while pos != -1:
+        part_start = msg_str.find("\n", pos, end)
+        if part_start == -1 or msg_str.startswith(delimiter + "--", pos):
+            break
+        part_start += 1
+        next_pos = msg_str.find(delimiter, part_start, end)
+        part_end = end if next_pos == -1 else next_pos
+
+        blank = BLANK_LINE_RE.search(msg_str, part_start - 1, part_end)
+        if blank:
+            part_headers = parse_headers(msg_str[part_start:blank.start()])
+            text, is_html = find_text(
+                msg_str, blank.end(), part_end, part_headers, max_bytes,
+                depth + 1
+            )
+            if text is not None and not is_html:
+                return text, False
+            if text is not None and html_text is None:
+                html_text = text
+
+        pos = next_pos
+
+    if html_text is not None:
+        return html_text, True
+    return None, False
+
+
+def clean_text(text, max_lines):
+    """
+    Keep the lines of a text that may contain a request: quoted replies,
+    reply attributions and everything after the signature separator are
+    dropped, and at most `max_lines` lines are kept.
+    """
+    lines = []
+    for line in text.splitlines()[:max_lines]:
+        stripped = line.strip()
+        if line.rstrip("\r\n") == "-- ":
+            break
+        if stripped.startswith(">") or stripped.endswith("wrote:"):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def extract_text(msg_str, max_bytes=MAX_BYTES, max_lines=MAX_LINES,
+                 headers=None, body_start=None):
+    """
+    Get the headers, subject and text of a message within a budget.
+
+    :param msg_str (str): incoming message as string.
+    :param max_bytes (int): maximum number of bytes of text decoded.
+    :param max_lines (int): maximum number of lines of text kept.
+    :param headers (email.message.Message): headers already parsed with
+    parse_headers(), and `body_start` the offset split_message() gave with
+    them, so they aren't parsed again.
+
+    :return: (headers, subject, text). `headers` is an
+    email.message.Message without body.
+    """
+    if headers is None:
+        headers_str, body_start = split_message(msg_str)
+        headers = parse_headers(headers_str)
+    subject = header_text(headers.get("Subject"))
+
+    text = ""
+    if body_start is not None:
+        body, is_html = find_text(
+            msg_str, body_start, len(msg_str), headers, max_bytes
+        )
+        if body is not None:
+            if is_html:
+                body = strip_html(body)
+            text = clean_text(body, max_lines)
+
+    return headers, subject, text
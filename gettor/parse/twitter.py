@@ -12,11 +12,10 @@
 
 from __future__ import absolute_import
 
-import re
 import dkim
+import time
 import hashlib
 
-from datetime import datetime
 import configparser
 
 from twisted.python import log
@@ -24,6 +23,9 @@ from twisted.internet import defer
 
 from ..utils.db import SQLite3
 from ..utils import strings
+from ..utils import ratelimit
+from ..utils.blacklist import get_blacklist, BlacklistError
+from . import keywords
 
 
 class TwitterParser(object):
@@ -35,11 +37,32 @@ class TwitterParser(object):
         """
         self.settings = settings
         self.twitter_id = twitter_id
-        self.conn = SQLite3(self.settings.get("dbname"))
+        self.conn = SQLite3.from_settings(self.settings)
+        self.limiter = ratelimit.get_limiter(self.settings)
+        self.blacklist = get_blacklist(self.settings)
 
     def __del__(self):
         del self.conn
 
+    def close(self):
+        """
+        Stop using the database.
+        """
+        return self.conn.close()
+
+    def sender_hid(self, twitter_id):
+        """
+        Hash of the sender of a message. Messages ids change, so blacklists
+        and rate limits are applied to the sender.
+
+        :param twitter_id (dict): message id and sender's `twitter_handle`.
+        """
+        if isinstance(twitter_id, dict):
+            sender = str(twitter_id.get("twitter_handle"))
+        else:
+            sender = str(twitter_id)
+        return hashlib.sha256(sender.encode('utf-8')).hexdigest()
+
     def build_request(self, msg_text, twitter_id, languages, platforms):
 
         request = {
@@ -51,13 +74,14 @@ class TwitterParser(object):
         }
 
         if msg_text:
-            for word in re.split(r"\s+", msg_text.strip()):
-                if word.lower() in languages:
-                    request["language"] = word.lower()
-                if word.lower() in platforms:
+            index = keywords.get_index(languages, platforms)
+            for word in index.tokens(msg_text, skip_quoted=False):
+                if word in index.locales:
+                    request["language"] = index.locales[word]
+                if word in index.platforms:
                     request["command"] = "links"
-                    request["platform"] = word.lower()
-                if word.lower() == "help":
+                    request["platform"] = word
+                if word == "help":
                     request["command"] = "help"
                     break
 
@@ -87,6 +111,16 @@ class TwitterParser(object):
             "Request from {}".format(hid.hexdigest()), system="twitter parser"
         )
 
+        sender_hid = self.sender_hid(twitter_id)
+        try:
+            self.blacklist.is_blacklisted(sender_hid, "twitter")
+        except BlacklistError as e:
+            log.msg(
+                "Discarded request from {}: {}.".format(sender_hid, e),
+                system="twitter parser"
+            )
+            return self.build_request(None, twitter_id, languages, platforms)
+
         request = self.build_request(msg, twitter_id, languages, platforms)
 
         return request
@@ -112,32 +146,27 @@ class TwitterParser(object):
         )
 
         if request["command"]:
-            now_str = datetime.now().strftime("%Y%m%d%H%M%S")
+            now = int(time.time())
 
-            hid = hashlib.sha256(str(request['id']).encode('utf-8'))
+            hid = self.sender_hid(request['id'])
             # check limits first
-            num_requests = yield self.conn.get_num_requests(
-                id=hid.hexdigest(), service=request['service']
-            )
-
-            num_requests += yield self.conn.get_num_requests(
-                id=str(request['id']), service=request['service']
+            allowed = self.limiter.allow(
+                request['service'], hid, twitter_requests_limit
             )
 
-            if num_requests[0][0] > twitter_requests_limit:
+            if not allowed:
                 log.msg(
-                    "Discarded. Too many requests from {}.".format(
-                        hid.hexdigest()
-                    ), system="twitter parser"
+                    "Discarded. Too many requests from {}.".format(hid),
+                    system="twitter parser"
                 )
             else:
-                self.conn.new_request(
+                yield self.conn.new_request(
                     id=str(request['id']),
                     command=request['command'],
                     platform=request['platform'],
                     language=request['language'],
                     service=request['service'],
-                    date=now_str,
+                    date=now,
                     status="ONHOLD",
                 )
 
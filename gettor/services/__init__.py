@@ -13,6 +13,7 @@ the Tor Browser.
 from __future__ import absolute_import
 
 from twisted.application import internet
+from twisted.internet import defer
 from ..utils.commons import log
 
 class BaseService(internet.TimerService):
@@ -54,10 +55,19 @@ class BaseService(internet.TimerService):
         """
         Stop the service. Overridden from parent class to close connection to
         database, shutdown the service and add extra logging information.
+        The database is closed once the running call, if any, is done.
         """
         log.info("SERVICE:: Stopping {} service.".format(self.name))
+        d = defer.maybeDeferred(internet.TimerService.stopService, self)
+        d.addCallback(lambda _: self.shutdown())
+        return d
+
+    def shutdown(self):
         log.debug("SERVICE:: Calling shutdown on {}".format(self.name))
-        del self.instance
-        log.debug("SERVICE:: Shutdown for {} done".format(self.name))
-        internet.TimerService.stopService(self)
-        log.info("SERVICE:: Service stopped.")
+        close = getattr(self.instance, "close", None)
+        d = defer.maybeDeferred(close) if close else defer.succeed(None)
+
+        def closed(_):
+            log.debug("SERVICE:: Shutdown for {} done".format(self.name))
+            log.info("SERVICE:: Service stopped.")
+        return d.addCallback(closed)
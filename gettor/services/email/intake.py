@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import os
+import socket
+
+from twisted.application import internet
+from twisted.internet import defer, protocol
+from twisted.protocols import basic
+
+from ...parse.email import EmailParser, AddressError, DKIMError
+from ...utils.commons import log
+
+
+REPLY_OK = b"OK"
+# The message was handled but dropped by the parser's policy (invalid
+# address, autoresponder, failed DKIM), parsing it again won't change that
+REPLY_REJECTED = b"REJECTED"
+REPLY_ERROR = b"ERROR"
+
+
+class IntakeProtocol(basic.NetstringReceiver):
+    """
+    Receive incoming messages as netstrings and answer each one with a
+    netstring reply once the message has been parsed and stored.
+    """
+
+    def connectionMade(self):
+        self.MAX_LENGTH = self.factory.max_size
+
+    def stringReceived(self, string):
+        d = self.factory.intake.process(string.decode('utf-8', 'replace'))
+        d.addCallback(self.reply)
+
+    def reply(self, status):
+        self.sendString(status)
+
+
+class IntakeFactory(protocol.ServerFactory):
+    """
+    Factory for intake connections. All connections share the same Intake
+    instance and so the same email parser and database pool.
+    """
+    protocol = IntakeProtocol
+
+    def __init__(self, intake, max_size):
+        self.intake = intake
+        self.max_size = max_size
+
+
+class Intake(object):
+    """
+    Long-lived email intake. It keeps one EmailParser (and so one database
+    pool and one copy of the locales) for all the incoming messages instead
+    of building them again for every message.
+    """
+
+    def __init__(self, settings):
+        """
+        Constructor.
+
+        :param settings (Settings): GetTor settings.
+        """
+        self.settings = settings
+        self.ep = EmailParser(
+            settings, settings.get("sendmail_addr"),
+            dkim=settings.get("email_dkim", False)
+        )
+        self.locales_loaded = False
+
+    def close(self):
+        """
+        Release the email parser and its connection to the database.
+
+        :return: deferred firing when the database pools are closed, or None.
+        """
+        return self.ep.close()
+
+    @defer.inlineCallbacks
+    def load_locales(self):
+        """
+        Load the locales once and keep them for the following messages.
+        """
+        if not self.locales_loaded:
+            yield self.ep.get_locales().addErrback(self.ep.parse_errback)
+            self.locales_loaded = len(self.ep.locales) > 0
+
+    @defer.inlineCallbacks
+    def process(self, message):
+        """
+        Parse a message and store the resulting request.
+
+        :param message (str): incoming message as string.
+
+        :return: deferred firing with REPLY_OK if the message was processed,
+        REPLY_REJECTED if the parser dropped it or REPLY_ERROR if there was an
+        error.
+        """
+        log.debug("Processing incoming email.")
+        try:
+            yield self.load_locales()
+            yield defer.maybeDeferred(
+                self.ep.parse, message
+            ).addCallback(self.ep.parse_callback)
+        except (AddressError, DKIMError) as e:
+            self.ep.parse_errback(e)
+            return REPLY_REJECTED
+        except Exception as e:
+            self.ep.parse_errback(e)
+            return REPLY_ERROR
+        return REPLY_OK
+
+
+class IntakeService(internet.UNIXServer):
+    """
+    Unix socket service accepting the messages handed over by
+    scripts/process_email.
+    """
+
+    def __init__(self, settings):
+        """
+        Constructor.
+
+        :param settings (Settings): GetTor settings. Reads `intake_socket`
+        and `intake_max_size` (in bytes).
+        """
+        self.intake = Intake(settings)
+        self.loading = None
+        factory = IntakeFactory(
+            self.intake, settings.get("intake_max_size", 10485760)
+        )
+        internet.UNIXServer.__init__(
+            self, settings.get("intake_socket"), factory, mode=0o660,
+            wantPID=True
+        )
+
+    def startService(self):
+        log.info("SERVICE:: Starting intake service.")
+        internet.UNIXServer.startService(self)
+        self.loading = self.intake.load_locales()
+
+    def stopService(self):
+        log.info("SERVICE:: Stopping intake service.")
+        d = defer.maybeDeferred(internet.UNIXServer.stopService, self)
+        # The parser is still used while the locales are loading
+        d.addCallback(lambda _: self.loading)
+        d.addCallback(lambda _: self.intake.close())
+        return d
+
+
+def send_message(path, message, timeout=30):
+    """
+    Hand a message over to the intake service. This is what
+    scripts/process_email uses instead of parsing the message itself.
+
+    :param path (str): path of the intake unix socket.
+    :param message (str): incoming message as string.
+    :param timeout (int): socket timeout, in seconds.
+
+    :return: True if the intake service processed or rejected the message.
+    :raise: socket.error if the service could not be reached.
+    """
+    data = message.encode('utf-8', 'replace')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(b"%d:%s," % (len(data), data))
+        reply = b""
+        while not reply.endswith(b","):
+            chunk = sock.recv(64)
+            if not chunk:
+                break
+            reply += chunk
+    finally:
+        sock.close()
+
+    return reply in (
+        b"%d:%s," % (len(status), status)
+        for status in (REPLY_OK, REPLY_REJECTED)
+    )
+
+
+def intake_available(path):
+    """
+    Check if there is an intake socket at the given path.
+    """
+    return bool(path) and os.path.exists(path)
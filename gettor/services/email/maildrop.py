@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+"""
+Delivery of replies as files in a spool directory, without an SMTP dialog.
+Nothing in the service reads the spool, scripts/send_maildrop hands the
+files to the local MTA and has to run periodically.
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import socket
+import itertools
+
+from twisted.internet import threads
+
+from ...utils.commons import log
+
+
+class Maildrop(object):
+    """
+    Spool directory with `tmp` and `new` subdirectories, as in Maildir.
+    Messages are written and synced in `tmp` and then renamed into `new`,
+    so send_maildrop never picks up a partial message.
+    """
+
+    def __init__(self, path, fsync=True):
+        """
+        Constructor.
+
+        :param path (str): spool directory, created if needed.
+        :param fsync (bool): sync each message to disk before handing it
+        off.
+        """
+        self.path = path
+        self.fsync = fsync
+        self.tmp = os.path.join(path, "tmp")
+        self.new = os.path.join(path, "new")
+        for directory in (self.tmp, self.new):
+            os.makedirs(directory, exist_ok=True)
+        self.hostname = socket.gethostname().replace("/", "_")
+        self.counter = itertools.count()
+        self.num_sent = 0
+        log.warn(
+            "MAILDROP:: Replies are left in {}, they are only sent while "
+            "scripts/send_maildrop runs.".format(path)
+        )
+
+    def send(self, from_addr, to_addr, data):
+        """
+        Drop a message in the spool, the envelope goes in the `Return-Path`
+        and `X-Original-To` headers.
+
+        :param data (bytes): the message.
+
+        :return: deferred firing with the name of the file.
+        """
+        d = threads.deferToThread(self.write, from_addr, to_addr, data)
+        return d.addCallback(self.sent)
+
+    def sent(self, name):
+        self.num_sent += 1
+        return name
+
+    def write(self, from_addr, to_addr, data):
+        name = "{:.6f}.P{}Q{}.{}".format(
+            time.time(), os.getpid(), next(self.counter), self.hostname
+        )
+        tmp = os.path.join(self.tmp, name)
+        # Same line endings as the message
+        eol = "\r\n" if data[:data.find(b"\n")].endswith(b"\r") else "\n"
+        envelope = "Return-Path: <{}>{}X-Original-To: {}{}".format(
+            from_addr, eol, to_addr, eol
+        ).encode("utf-8")
+        try:
+            with open(tmp, "xb") as f:
+                f.write(envelope)
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmp, os.path.join(self.new, name))
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return name
+
+    def get_stats(self):
+        """
+        :return: dict with the messages `sent`.
+        """
+        return {"sent": self.num_sent}
+
+    def close(self):
+        log.info("MAILDROP:: {sent} messages dropped.".format(
+            **self.get_stats()
+        ))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+"""
+Replies encoded once per variant. Recipients of the same reply only differ
+in the To and Message-ID headers, which are spliced into the pre-encoded
+bytes of the rest of the message.
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import itertools
+
+from email import charset
+from email.mime.text import MIMEText
+
+
+class MessageTemplate(object):
+    """
+    Plain text message without its To and Message-ID headers, encoded as
+    MIMEText would: 7bit for ASCII bodies, and otherwise UTF-8 in
+    quoted-printable or base64, whichever is shorter.
+    """
+
+    def __init__(self, from_addr, subject, body):
+        """
+        Constructor.
+
+        :param from_addr (str): sender of the message.
+        :param subject (str): subject of the message.
+        :param body (str): content of the message.
+        """
+        try:
+            body.encode("ascii")
+            message = MIMEText(body)
+        except UnicodeEncodeError:
+            message = min(
+                (self.encode(body, encoding)
+                 for encoding in (charset.QP, charset.BASE64)),
+                key=lambda m: len(m.get_payload())
+            )
+        message['Subject'] = subject
+        message['From'] = from_addr
+
+        data = message.as_bytes()
+        # Headers end with a newline, the blank line starts the body
+        headers, self.body = data.split(b"\n\n", 1)
+        self.headers = headers + b"\nTo: "
+        self.encoding = message['Content-Transfer-Encoding']
+
+    @staticmethod
+    def encode(body, encoding):
+        cs = charset.Charset("utf-8")
+        cs.body_encoding = encoding
+        return MIMEText(body, "plain", cs)
+
+    def render(self, to_addr, message_id):
+        """
+        Assemble the message for a recipient.
+
+        :param to_addr (str): recipient of the message.
+        :param message_id (str): value of the Message-ID header.
+
+        :return: the message (bytes).
+
+        :raise: ValueError if a header would span several lines.
+        """
+        if "\n" in to_addr or "\r" in to_addr:
+            raise ValueError("Invalid recipient {!r}".format(to_addr))
+        return b"".join((
+            self.headers, to_addr.encode("utf-8"), b"\nMessage-ID: ",
+            message_id.encode("ascii"), b"\n\n", self.body
+        ))
+
+
+class MessageIds(object):
+    """
+    Unique Message-ID values, without the per-call hostname lookup of
+    email.utils.make_msgid.
+    """
+
+    def __init__(self, domain):
+        """
+        Constructor.
+
+        :param domain (str): right hand side of the ids, e.g. the domain
+        of the sender.
+        """
+        self.suffix = ".{}@{}>".format(os.getpid(), domain)
+        self.counter = itertools.count()
+
+    def next(self):
+        return "<{}.{}{}".format(
+            time.time_ns(), next(self.counter), self.suffix
+        )
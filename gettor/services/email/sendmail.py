@@ -12,20 +12,24 @@
 
 from __future__ import absolute_import
 
+import os
+import socket
 import hashlib
 
 import configparser
-from email.mime.text import MIMEText
 
 from twisted.internet import defer
-from twisted.mail import smtp
 
 from ...utils.db import SQLite3 as DB
 from ...utils.commons import log
 from ...utils import strings
+from ...utils.stats import get_stats
+from ...utils.responses import get_responses
+from .smtp_pool import SMTPPool, LMTPPool
+from .maildrop import Maildrop
+from .mime import MessageTemplate, MessageIds
 
 
-from email.mime.text import MIMEText
 class Sendmail(object):
     """
     Class for sending email replies to `help` and `links` requests.
@@ -36,12 +40,78 @@ class Sendmail(object):
         :dbname: reads from configs
         """
         self.settings = settings
-        dbname = self.settings.get("dbname")
-        self.conn = DB(dbname)
+        self.transport = self.build_transport()
+        # Encoded replies by (subject, body), see MessageTemplate
+        self.templates = {}
+        sender = settings.get("sendmail_addr") or ""
+        self.message_ids = MessageIds(
+            sender.rpartition("@")[2] or socket.getfqdn()
+        )
+        self.conn = DB.from_settings(settings)
+        self.stats = get_stats(settings)
+        self.responses = get_responses(settings)
+        self.responses.register("email", self.render_reply, self.variants)
+        # Identifies the requests claimed by this sender, see get_new
+        self.worker_id = "{}:{}:{}".format(
+            socket.gethostname(), os.getpid(), id(self)
+        )
+        self.batch_size = settings.get("sendmail_batch_size", 50)
+        self.lease_time = settings.get("sendmail_lease_time", 600)
+        self.semaphore = defer.DeferredSemaphore(
+            settings.get("sendmail_concurrency", 10)
+        )
+        self.num_sent = 0
+        self.num_failed = 0
+
+    def build_transport(self):
+        """
+        Build the delivery backend chosen by `sendmail_backend`: `smtp`
+        (default) to sendmail_host, `lmtp` to the unix socket
+        sendmail_lmtp_socket, or `maildrop` into the spool directory
+        sendmail_maildrop_dir.
+
+        :return: object whose send(from, to, data) returns a deferred.
+        """
+        backend = self.settings.get("sendmail_backend", "smtp")
+        size = self.settings.get(
+            "sendmail_pool_size", self.settings.get("sendmail_concurrency", 10)
+        )
+        idle_timeout = self.settings.get("sendmail_pool_idle", 30)
+        if backend == "smtp":
+            # ESMTP sessions reused between replies
+            return SMTPPool(
+                self.settings.get("sendmail_host"),
+                port=self.settings.get("sendmail_port", 587),
+                size=size, idle_timeout=idle_timeout,
+                username=self.settings.get("sendmail_username", None),
+                password=self.settings.get("sendmail_password", None),
+                require_tls=self.settings.get("sendmail_require_tls", True)
+            )
+        if backend == "lmtp":
+            return LMTPPool(
+                self.settings.get("sendmail_lmtp_socket"), size=size,
+                idle_timeout=idle_timeout
+            )
+        if backend == "maildrop":
+            return Maildrop(
+                self.settings.get("sendmail_maildrop_dir"),
+                fsync=self.settings.get("sendmail_maildrop_fsync", True)
+            )
+        raise ValueError("Unknown sendmail_backend {}".format(backend))
 
     def __del__(self):
         del self.conn
 
+    def close(self):
+        """
+        Stop using the database and the delivery backend, called when the
+        service is stopped.
+
+        :return: deferred firing when the pool is closed, or None.
+        """
+        self.transport.close()
+        return self.conn.close()
+
     def get_interval(self):
         """
         Get time interval for service periodicity.
@@ -68,8 +138,8 @@ class Sendmail(object):
 
     def sendmail(self, email_addr, subject, body):
         """
-        Send an email message. It creates a plain text message, set headers
-        and content and finally send it.
+        Send an email message. Replies with the same subject and body are
+        encoded once, only the recipient and Message-ID are added to them.
 
         :param email_addr (str): email address of the recipient.
         :param subject (str): subject of the message.
@@ -78,18 +148,22 @@ class Sendmail(object):
         :return: deferred whose callback/errback will handle the SMTP
         execution details.
         """
-        log.debug("Creating plain text email")
-        message = MIMEText(body)
-
-        message['Subject'] = subject
-        message['From'] = self.settings.get("sendmail_addr")
-        message['To'] = email_addr
+        template = self.templates.get((subject, body))
+        if template is None:
+            log.debug("Creating plain text email")
+            template = MessageTemplate(
+                self.settings.get("sendmail_addr"), subject, body
+            )
+            self.templates[(subject, body)] = template
+        try:
+            message = template.render(email_addr, self.message_ids.next())
+        except ValueError as e:
+            return defer.fail(e)
 
         log.debug("Calling asynchronous sendmail.")
 
-        return smtp.sendmail(
-            self.settings.get("sendmail_host"), self.settings.get("sendmail_addr"), email_addr, message,
-            requireTransportSecurity=True
+        return self.transport.send(
+            self.settings.get("sendmail_addr"), email_addr, message
         ).addCallback(self.sendmail_callback).addErrback(self.sendmail_errback)
 
     def build_locale_string(self, locales):
@@ -161,78 +235,152 @@ class Sendmail(object):
 
 
     @defer.inlineCallbacks
-    def get_new(self):
-        """
-        Get new requests to process. This will define the `main loop` of
-        the Sendmail service.
+    def render_reply(self, command, platform, language):
         """
+        Render the reply to a request, see ResponseCache.
 
-        # Manage help and links messages separately
-        requests = yield self.conn.get_requests(
-            status="ONHOLD", service="email"
+        :return: deferred firing with (subject, body).
+        """
+        if command == "help":
+            locales = yield self.conn.get_locales()
+            # Strings are global, load them right before using them
+            strings.load_strings("en")
+            locale_string = self.build_locale_string(locales)
+            body_msg = self.build_help_body_message(locale_string)
+            return strings._("help_subject"), body_msg
+
+        log.debug("Getting links for {} {}.".format(platform, language))
+        links = yield self.conn.get_links(
+            platform=platform, language=language, status="ACTIVE"
         )
-
         strings.load_strings("en")
-        try:
+        link_msg, file = self.build_link_strings(links, platform, language)
+        body_msg = self.build_body_message(link_msg, platform, file)
+        return strings._("links_subject"), body_msg
 
-            for request in requests:
-                id = request[0]
-                command = request[1]
-                platform = request[2]
-                language = request[3]
-                date = request[5]
-
-                if not language:
-                    language = 'en'
-
-                body_msg =""
-                subject_msg =""
-
-                if command == "help":
-
-                    locales = yield self.conn.get_locales()
-                    locale_string = self.build_locale_string(locales)
-
-                    # build message
-                    body_msg = self.build_help_body_message(locale_string)
-                    subject_msg = strings._("help_subject")
-
-                elif command == "links":
-                    log.debug("Getting links for {} {}.".format(platform, language))
-                    links = yield self.conn.get_links(
-                        platform=platform, language=language, status="ACTIVE"
-                    )
-
-                    # build message
-                    link_msg, file = self.build_link_strings(links, platform, language)
-                    body_msg = self.build_body_message(link_msg, platform, file)
-                    subject_msg = strings._("links_subject")
-                else:
-                    log.warn("Invalid gettor command {}.".format(command))
-                    yield self.conn.remove_request(
-                        id=id, service="email", date=date
-                    )
-
-                log.debug("Sending {} message.".format(request[1]))
-
-                yield self.sendmail(
-                    email_addr=id,
-                    subject=subject_msg,
-                    body=body_msg
-                )
+    def variants(self, link_variants):
+        """
+        Replies rendered in advance: help, and links for every platform
+        and language with active links.
+        """
+        return [("help", None, None)] + [
+            ("links", platform, language)
+            for platform, language in link_variants
+        ]
 
-                yield self.conn.update_stats(
-                    command=command, platform=platform, language=language,
-                    service="email"
+    def get_gauges(self):
+        """
+        Get the state of the delivery scheduler.
+
+        :return: dict with the number of messages `in_flight` and `queued`
+        waiting for a slot, and the totals `sent` and `failed`.
+        """
+        return {
+            "in_flight": self.semaphore.limit - self.semaphore.tokens,
+            "queued": len(self.semaphore.waiting),
+            "sent": self.num_sent,
+            "failed": self.num_failed,
+        }
+
+    @defer.inlineCallbacks
+    def serve_request(self, request, writes):
+        """
+        Build and send the reply to a claimed request. Errors are logged and
+        don't affect the other requests of the batch.
+
+        :param request (tuple): row returned by SQLite3.claim_requests.
+        :param writes (list): bookkeeping writes are appended here.
+        """
+        rowid = request[0]
+        id = request[1]
+        command = request[2]
+        platform = request[3]
+        language = request[4]
+
+        if not language:
+            language = 'en'
+
+        body_msg = ""
+        subject_msg = ""
+
+        try:
+            if command == "help":
+                subject_msg, body_msg = yield self.responses.get(
+                    "email", "help"
                 )
 
-                yield self.conn.remove_request(
-                    id=id, service="email", date=date
+            elif command == "links":
+                subject_msg, body_msg = yield self.responses.get(
+                    "email", "links", platform, language
                 )
+            else:
+                log.warn("Invalid gettor command {}.".format(command))
+                writes.append(self.conn.complete_request(
+                    rowid, self.worker_id, "email"
+                ))
+                return
+
+            log.debug("Sending {} message.".format(command))
+
+            yield self.sendmail(
+                email_addr=id,
+                subject=subject_msg,
+                body=body_msg
+            )
+            self.num_sent += 1
 
-        except Exception as e:
-            yield self.conn.remove_request(
-                id=id, service="email", date=date
+            self.stats.count(
+                command=command, platform=platform, language=language,
+                service="email",
+                hid=hashlib.sha256(id.encode('utf-8')).hexdigest()
             )
+
+        except Exception as e:
+            self.num_failed += 1
             log.error(strings.redact_emails(
                 "Error sending email to {}:{}.".format(id, e)))
+
+        writes.append(self.conn.complete_request(
+            rowid, self.worker_id, "email"
+        ))
+
+    @defer.inlineCallbacks
+    def get_new(self):
+        """
+        Get new requests to process. This will define the `main loop` of
+        the Sendmail service.
+
+        Requests are claimed in batches with a lease, so several senders can
+        share the database without sending the same reply twice. Requests
+        whose lease expired, e.g. because a sender died, are claimed again.
+        """
+        yield self.conn.reap_requests()
+
+        # Renders the replies again if the links or locales changed
+        changed = yield self.responses.refresh(self.conn)
+        if changed:
+            self.templates = {}
+        # Bookkeeping writes of the whole run are committed together
+        writes = []
+        after = None
+        while True:
+            requests = yield self.conn.claim_requests(
+                service="email", worker=self.worker_id,
+                limit=self.batch_size, lease_time=self.lease_time,
+                after=after
+            )
+            if not requests:
+                break
+            # Keyset paging, rows this worker failed to claim are skipped
+            after = (requests[-1][6], requests[-1][0])
+
+            # Replies are sent concurrently, see sendmail_concurrency
+            yield defer.gatherResults([
+                self.semaphore.run(self.serve_request, request, writes)
+                for request in requests
+            ])
+
+        log.debug("Sendmail totals: {} sent, {} failed.".format(
+            self.num_sent, self.num_failed
+        ))
+        yield defer.gatherResults(writes)
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+"""
+Pool of ESMTP sessions kept open between messages, so the EHLO, STARTTLS
+and AUTH handshakes are paid once per session instead of once per reply,
+and its LMTP variant for the local MTA's unix socket.
+"""
+
+from __future__ import absolute_import
+
+from io import BytesIO
+
+from twisted.internet import defer, protocol, reactor
+from twisted.mail import smtp
+
+from ...utils.commons import log
+
+
+class Job(object):
+    """
+    A message waiting to be sent, and the deferred of its result.
+    """
+
+    def __init__(self, from_addr, to_addr, data):
+        self.from_addr = from_addr
+        self.to_addr = to_addr
+        self.data = data
+        self.d = defer.Deferred()
+        self.retried = False
+
+
+class PooledSender(smtp.ESMTPSender):
+    """
+    ESMTP session sending the messages the pool hands to it. Between
+    messages the session is reset with RSET and parked instead of quitting.
+    """
+
+    def __init__(self, pool, *args, **kwargs):
+        smtp.ESMTPSender.__init__(self, *args, **kwargs)
+        self.pool = pool
+        self.current = None
+        self.ready = False
+        self.greeted = False
+        self.num_sent = 0
+
+    def connectionMade(self):
+        if hasattr(self.transport, "setTcpNoDelay"):
+            # The dialog is many small writes, don't wait for delayed ACKs
+            self.transport.setTcpNoDelay(True)
+        smtp.ESMTPSender.connectionMade(self)
+
+    def smtpState_from(self, code, resp):
+        if self.current is None:
+            # Handshake done or previous message reset, wait for the next
+            self.ready = self.greeted = True
+            self.pool.park(self)
+            return
+        smtp.ESMTPSender.smtpState_from(self, code, resp)
+
+    def send(self, job):
+        """
+        Start sending a message, the session must be parked.
+        """
+        self.ready = False
+        self.current = job
+        smtp.ESMTPSender.smtpState_from(self, 250, b"")
+
+    def quit(self):
+        self.ready = False
+        self._disconnectFromServer()
+
+    def getMailFrom(self):
+        return self.current.from_addr
+
+    def getMailTo(self):
+        return [self.current.to_addr]
+
+    def getMailData(self):
+        return BytesIO(self.current.data)
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        job, self.current = self.current, None
+        self.num_sent += 1
+        self.pool.num_sent += 1
+        if code in smtp.SUCCESS:
+            job.d.callback((numOk, addresses))
+        else:
+            job.d.errback(smtp.SMTPDeliveryError(
+                code, resp, log.str(), addresses
+            ))
+
+    def sendError(self, exc):
+        job, self.current = self.current, None
+        self.ready = False
+        smtp.SMTPClient.sendError(self, exc)
+        self.pool.failed(self, job, exc)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        smtp.ESMTPSender.connectionLost(self, reason)
+        job, self.current = self.current, None
+        self.ready = False
+        self.pool.lost(self, job, reason.value)
+
+
+class LMTPSender(PooledSender):
+    """
+    LMTP session, ESMTP greeting with LHLO instead of EHLO. Messages have
+    one recipient, so DATA gets a single reply as in SMTP.
+    """
+
+    def esmtpState_ehlo(self, code, resp):
+        self._expected = smtp.SUCCESS
+        self._okresponse = self.esmtpState_serverConfig
+        self._failresponse = self.smtpTransferFailed
+        self.sendLine(b"LHLO " + self.identity)
+
+
+class PoolFactory(protocol.ClientFactory):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def buildProtocol(self, addr):
+        return self.pool.build_session()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool.failed(None, None, reason.value)
+
+
+class SMTPPool(object):
+    """
+    Up to `size` ESMTP sessions to one server. Sessions idle for more than
+    `idle_timeout` seconds are closed, and a message whose reused session
+    turns out to be dead is retried once on a new one.
+    """
+
+    protocol = PooledSender
+
+    def __init__(self, host, port=587, size=4, idle_timeout=30,
+                 username=None, password=None, require_tls=True,
+                 timeout=60, clock=reactor):
+        """
+        Constructor.
+
+        :param host (str): SMTP server.
+        :param port (int): SMTP server port.
+        :param size (int): maximum number of sessions.
+        :param idle_timeout (int): seconds a session can stay unused.
+        :param username (str): username to authenticate with, if any.
+        :param password (str): password to authenticate with.
+        :param require_tls (bool): refuse servers without STARTTLS.
+        :param timeout (int): seconds to wait for a server response.
+        """
+        self.host = host
+        self.port = port
+        # Name the server certificate is checked against, None for no TLS
+        self.tls_hostname = host
+        self.size = size
+        self.idle_timeout = idle_timeout
+        # ESMTPSender wants bytes credentials, as smtp.sendmail gives it
+        if isinstance(username, str):
+            username = username.encode("utf-8")
+        if isinstance(password, str):
+            password = password.encode("utf-8")
+        self.username = username
+        self.password = password
+        self.require_tls = require_tls
+        self.timeout = timeout
+        self.clock = clock
+        self.factory = PoolFactory(self)
+        self.sessions = set()
+        self.idle = []
+        self.idle_calls = {}
+        self.waiting = []
+        self.connecting = 0
+        self.closed = False
+        self.num_sent = 0
+        self.num_connections = 0
+
+    def send(self, from_addr, to_addr, data):
+        """
+        Send a message.
+
+        :param data (bytes): the message.
+
+        :return: deferred firing when the server accepts the message.
+        """
+        if self.closed:
+            return defer.fail(RuntimeError("SMTP pool closed"))
+        job = Job(from_addr, to_addr, data)
+        self.waiting.append(job)
+        self.dispatch()
+        return job.d
+
+    def dispatch(self):
+        while self.waiting and self.idle:
+            session = self.idle.pop()
+            self.cancel_idle(session)
+            session.send(self.waiting.pop(0))
+        busy = len(self.sessions) - len(self.idle) + self.connecting
+        if self.waiting and busy < len(self.waiting) and \
+                len(self.sessions) + self.connecting < self.size:
+            self.connect()
+
+    def connect(self):
+        self.connecting += 1
+        self.num_connections += 1
+        self.open_connection()
+
+    def open_connection(self):
+        self.clock.connectTCP(
+            self.host, self.port, self.factory, timeout=self.timeout
+        )
+
+    def build_session(self):
+        self.connecting -= 1
+        session = self.protocol(
+            self, self.username, self.password, None, smtp.DNSNAME,
+            hostname=self.tls_hostname
+        )
+        session.heloFallback = True
+        session.requireAuthentication = self.username is not None
+        session.requireTransportSecurity = self.require_tls
+        session.timeout = self.timeout
+        self.sessions.add(session)
+        return session
+
+    def park(self, session):
+        """
+        Called by a session ready for a message.
+        """
+        if self.closed:
+            session.quit()
+            return
+        self.idle.append(session)
+        self.idle_calls[session] = self.clock.callLater(
+            self.idle_timeout, self.expire, session
+        )
+        self.dispatch()
+
+    def expire(self, session):
+        self.idle_calls.pop(session, None)
+        if session in self.idle:
+            self.idle.remove(session)
+            session.quit()
+
+    def cancel_idle(self, session):
+        call = self.idle_calls.pop(session, None)
+        if call is not None and call.active():
+            call.cancel()
+
+    def forget(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+        if session in self.idle:
+            self.idle.remove(session)
+        self.cancel_idle(session)
+
+    def failed(self, session, job, error):
+        """
+        Called when a session fails, or a connection can't be made.
+        """
+        if session is None:
+            self.connecting -= 1
+        else:
+            self.forget(session)
+        if job is None and session is not None and session.greeted:
+            # An idle session was closed, nothing was lost
+            return self.dispatch()
+        if job is None and self.waiting:
+            # The server can't be used, fail a message rather than wait
+            job = self.waiting.pop(0)
+        if job is not None:
+            if session is not None and session.num_sent and not job.retried:
+                # Reused sessions may have been dropped by the server
+                job.retried = True
+                self.waiting.insert(0, job)
+            else:
+                job.d.errback(error)
+        self.dispatch()
+
+    def lost(self, session, job, error):
+        if session in self.sessions:
+            self.failed(session, job, error)
+
+    def get_stats(self):
+        """
+        :return: dict with the messages `sent`, the `connections` made and
+        the `handshakes_saved` by reusing them.
+        """
+        return {
+            "sent": self.num_sent,
+            "connections": self.num_connections,
+            "handshakes_saved": max(0, self.num_sent - self.num_connections),
+        }
+
+    def close(self):
+        """
+        Quit the idle sessions, busy ones quit after their message.
+        """
+        self.closed = True
+        for session in list(self.idle):
+            self.forget(session)
+            session.quit()
+        log.info("SMTP:: {sent} sent over {connections} connections, "
+                 "{handshakes_saved} handshakes saved.".format(
+                     **self.get_stats()))
+
+
+class LMTPPool(SMTPPool):
+    """
+    Pool of LMTP sessions to the unix socket of the local MTA, with no TLS
+    or authentication.
+    """
+
+    protocol = LMTPSender
+
+    def __init__(self, path, size=4, idle_timeout=30, timeout=60,
+                 clock=reactor):
+        """
+        Constructor.
+
+        :param path (str): LMTP unix socket.
+        """
+        SMTPPool.__init__(
+            self, path, port=None, size=size, idle_timeout=idle_timeout,
+            require_tls=False, timeout=timeout, clock=clock
+        )
+        self.tls_hostname = None
+
+    def open_connection(self):
+        self.clock.connectUNIX(self.host, self.factory, timeout=self.timeout)
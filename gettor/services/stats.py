@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import json
+
+from twisted.application import internet
+from twisted.internet import threads
+from twisted.web import resource, server
+
+from ..utils.stats import StatsQuery
+from ..utils.commons import log
+
+
+class StatsResource(resource.Resource):
+    """
+    JSON answers to stats queries, e.g.
+    GET /?period=month&since=20191001&group_by=platform,service&command=links
+    """
+    isLeaf = True
+
+    def __init__(self, query):
+        """
+        Constructor.
+
+        :param query (StatsQuery): queries answered.
+        """
+        resource.Resource.__init__(self)
+        self.query = query
+
+    def render_GET(self, request):
+        args = dict(
+            (k.decode("utf-8"), v[0].decode("utf-8"))
+            for k, v in request.args.items()
+        )
+        period = args.pop("period", "day")
+        since = args.pop("since", None)
+        until = args.pop("until", None)
+        group_by = [c for c in args.pop("group_by", "platform").split(",") if c]
+
+        d = threads.deferToThread(
+            self.query.query, period, since, until, group_by, **args
+        )
+        d.addCallbacks(
+            self.write, self.error, (request,), None, (request,)
+        )
+        return server.NOT_DONE_YET
+
+    def write(self, rows, request, code=200):
+        request.setResponseCode(code)
+        request.setHeader(b"content-type", b"application/json")
+        request.write(json.dumps(rows).encode("utf-8"))
+        request.finish()
+
+    def error(self, failure, request):
+        if failure.check(ValueError):
+            return self.write(
+                {"error": failure.getErrorMessage()}, request, 400
+            )
+        log.error("STATS:: Query failed: {}".format(failure.getErrorMessage()))
+        return self.write({"error": "Internal error"}, request, 500)
+
+
+class StatsAPIService(internet.TCPServer):
+    """
+    Read only HTTP service answering stats queries from the rollups.
+    """
+
+    def __init__(self, settings):
+        """
+        Constructor.
+
+        :param settings (Settings): GetTor settings. Reads `stats_api_port`,
+        `stats_api_interface`, `stats_api_cache_size` and
+        `stats_api_cache_ttl` (in seconds).
+        """
+        self.query = StatsQuery(
+            settings,
+            cache_size=settings.get("stats_api_cache_size", 256),
+            cache_ttl=settings.get("stats_api_cache_ttl", 300)
+        )
+        internet.TCPServer.__init__(
+            self, settings.get("stats_api_port"),
+            server.Site(StatsResource(self.query)),
+            interface=settings.get("stats_api_interface", "127.0.0.1")
+        )
+
+    def startService(self):
+        log.info("SERVICE:: Starting stats API service.")
+        internet.TCPServer.startService(self)
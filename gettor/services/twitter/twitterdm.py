@@ -25,6 +25,8 @@ from ...utils.twitter import Twitter
 from ...utils.db import SQLite3 as DB
 from ...utils.commons import log
 from ...utils import strings
+from ...utils.stats import get_stats
+from ...utils.responses import get_responses
 
 class Twitterdm(object):
     """
@@ -37,13 +39,26 @@ class Twitterdm(object):
 
         """
         self.settings = settings
-        dbname = self.settings.get("dbname")
         self.twitter = Twitter(settings)
-        self.conn = DB(dbname)
+        self.conn = DB.from_settings(settings)
+        self.stats = get_stats(settings)
+        self.responses = get_responses(settings)
+        self.responses.register("twitter", self.render_reply, self.variants)
+        # One parser for all the messages, it keeps its own limiter state
+        self.parser = TwitterParser(settings)
 
     def __del__(self):
         del self.conn
 
+    def close(self):
+        """
+        Stop using the database, called when the service is stopped.
+
+        :return: deferred firing when the pool is closed, or None.
+        """
+        self.parser.close()
+        return self.conn.close()
+
     def get_interval(self):
         """
         Get time interval for service periodicity.
@@ -98,6 +113,76 @@ class Twitterdm(object):
 
         return post_data
 
+    @defer.inlineCallbacks
+    def render_reply(self, command, platform, language):
+        """
+        Render the message replying to a request, see ResponseCache. Links
+        requests for a platform and locale without active links get help.
+
+        :return: deferred firing with the text of the message.
+        """
+        if command == "help":
+            strings.load_strings("en")
+            body_msg = strings._("help_body_intro")
+            body_msg += strings._("help_body_support")
+            return body_msg
+
+        locale = strings.get_locales()[language]['locale']
+        log.debug("Getting links for {}.".format(platform))
+        links = yield self.conn.get_links(
+            platform=platform, language=locale, status="ACTIVE"
+        )
+        if not links:
+            # Nothing to send, don't cache a reply with "None" as the links
+            log.info("No active links for {} {}, replying with help.".format(
+                platform, locale
+            ))
+            body_msg = yield self.render_reply("help", None, None)
+            return body_msg
+
+        # Strings are global, load them right before using them
+        strings.load_strings(language)
+        link_msg = None
+        file = ""
+
+        for link in links:
+            provider = link[5]
+            version = link[4]
+            arch = link[3]
+            url = link[0]
+            file = link[7]
+            sig_url = url + ".asc"
+
+            link_str = "Tor Browser {} for {}-{}-{} ({}): {}\n".format(
+                version, platform, locale, arch, provider, url
+            )
+
+            link_str += "Signature file: {}\n".format(sig_url)
+
+            if link_msg:
+                link_msg = "{}\n{}".format(link_msg, link_str)
+            else:
+                link_msg = link_str
+
+        body_msg = strings._("links_body_platform").format(platform)
+        body_msg += strings._("links_body_step1").format(link_msg)
+        body_msg += strings._("links_body_archive").format(file)
+        body_msg += strings._("links_body_internet_archive")
+        body_msg += strings._("links_body_google_drive")
+        return body_msg
+
+    def variants(self, link_variants):
+        """
+        Replies rendered in advance: help, and links for every platform
+        and language with active links.
+        """
+        keys = [("help", None, None)]
+        for language, info in sorted(strings.get_locales().items()):
+            for platform, link_language in link_variants:
+                if link_language == info['locale']:
+                    keys.append(("links", platform, language))
+        return keys
+
     @defer.inlineCallbacks
     def get_new(self):
         """
@@ -105,6 +190,9 @@ class Twitterdm(object):
         the Twitter service.
         """
 
+        # Renders the replies again if the links or locales changed
+        yield self.responses.refresh(self.conn)
+
         log.debug("Retrieve list of messages")
         data = self.twitter.twitter_data()
 
@@ -113,11 +201,10 @@ class Twitterdm(object):
             message_id = { "id": e['id'], "twitter_handle": e['message_create']['sender_id'] }
 
             log.debug("Parsing message")
-            tp = TwitterParser(self.settings, message_id)
+            tp = self.parser
             yield defer.maybeDeferred(
                 tp.parse, e['message_create']['message_data']['text'], message_id
             ).addCallback(tp.parse_callback).addErrback(tp.parse_errback)
-            del tp
 
         # Manage help and links messages separately
         help_requests = yield self.conn.get_requests(
@@ -129,7 +216,6 @@ class Twitterdm(object):
         )
 
         if help_requests:
-            strings.load_strings("en")
             try:
                 log.debug("Got new help request.")
 
@@ -146,18 +232,16 @@ class Twitterdm(object):
                         )
                     )
 
-                    body_msg = strings._("help_body_intro")
-                    body_msg += strings._("help_body_paragraph")
-                    body_msg += strings._("help_body_support")
+                    body_msg = yield self.responses.get("twitter", "help")
 
                     yield self.twitterdm(
                         twitter_id=twitter_id,
                         message=body_msg
                     )
 
-                    yield self.conn.update_stats(
+                    self.stats.count(
                         command="help", platform='', language='en',
-                        service="twitter"
+                        service="twitter", hid=hid.hexdigest()
                     )
 
                     yield self.conn.update_request(
@@ -183,47 +267,11 @@ class Twitterdm(object):
                     if not language:
                         language = 'en'
 
-                    locales = strings.get_locales()
-
-                    strings.load_strings(language)
-                    locale = locales[language]['locale']
-
-                    log.debug("Getting links for {}.".format(platform))
-                    links = yield self.conn.get_links(
-                        platform=platform, language=locale, status="ACTIVE"
+                    locale = strings.get_locales()[language]['locale']
+                    body_msg = yield self.responses.get(
+                        "twitter", "links", platform, language
                     )
 
-                    # build message
-                    link_msg = None
-                    file = ""
-
-                    for link in links:
-                        provider = link[5]
-                        version = link[4]
-                        arch = link[3]
-                        url = link[0]
-                        file = link[7]
-                        sig_url = url + ".asc"
-
-                        link_str = "Tor Browser {} for {}-{}-{} ({}): {}\n".format(
-                            version, platform, locale, arch, provider, url
-                        )
-
-                        link_str += "Signature file: {}\n".format(sig_url)
-
-                        if link_msg:
-                            link_msg = "{}\n{}".format(link_msg, link_str)
-                        else:
-                            link_msg = link_str
-
-                        body_msg = strings._("links_body_platform").format(platform)
-                        body_msg += trings._("links_body_links").format(link_msg)
-                        body_msg += trings._("links_body_archive")
-                        body_msg += trings._("links_body_internet_archive")
-                        body_msg += trings._("links_body_google_drive")
-                        body_msg += trings._("links_body_internet_archive").format(file)
-                        body_msg += trings._("links_body_ending")
-
                     hid = hashlib.sha256(twitter_id.encode('utf-8'))
                     log.debug(
                         "Sending links to {}.".format(
@@ -236,9 +284,9 @@ class Twitterdm(object):
                         message=body_msg
                     )
 
-                    yield self.conn.update_stats(
+                    self.stats.count(
                         command="links", platform=platform, language=locale,
-                        service="twitter"
+                        service="twitter", hid=hid.hexdigest()
                     )
 
                     yield self.conn.update_request(
@@ -10,149 +10,204 @@
 #
 # :license: This is Free Software. See LICENSE for license information.
 
-import os
-import logging
-import datetime
-import configparser
+from __future__ import absolute_import
 
-import db
-import utils
+import time
+import bisect
+import sqlite3
 
-"""Blacklist module for managing blacklisting of users."""
+from array import array
+from datetime import datetime
 
+from .db import SQLite3
+from .cache import TTLCache
+from .commons import log
 
-class BlacklistError(Exception):
-    pass
+"""Blacklist module for managing blacklisting of users."""
+
+# Blacklists of this process, by database name
+_blacklists = {}
 
 
-class ConfigError(Exception):
+class BlacklistError(Exception):
     pass
 
 
-class InternalError(Exception):
-    pass
+def get_blacklist(settings):
+    """
+    Get the blacklist of a database, shared by the email and twitter
+    parsers of this process. Permanent blocks are loaded when it's created.
+    """
+    dbname = settings.get("dbname")
+    blacklist = _blacklists.get(dbname)
+    if blacklist is None:
+        blacklist = Blacklist(
+            dbname,
+            max_req=settings.get("blacklist_max_req", 0),
+            wait_time=settings.get("blacklist_wait_time", 20),
+            cache_size=settings.get("blacklist_cache_size", 65536)
+        )
+        blacklist.load()
+        _blacklists[dbname] = blacklist
+    return blacklist
+
+
+def prefix(hid):
+    """
+    First 64 bits of a hashed user (sha256 hexdigest), as stored in memory.
+    """
+    return int(hid[:16], 16)
 
 
 class Blacklist(object):
     """Manage blacklisting of users.
 
+    Permanently blocked users are stored in the `blacklist` table and kept
+    in memory as a sorted array of 64 bit hash prefixes per service, so
+    checking a user doesn't touch the database. Users making too many
+    requests in a row are tracked in a bounded in-memory cache.
+
     Public methods:
 
         is_blacklisted(): Check if someone is blacklisted.
+        add(): Permanently block someone.
+        remove(): Remove a permanent block.
 
     Exceptions:
 
-         ConfigurationError: Bad configuration.
          BlacklistError: User is blacklisted.
-         InternalError: Something went wrong internally.
 
     """
 
-    def __init__(self, cfg=None):
-    	"""Create new object by reading a configuration file.
+    def __init__(self, dbname=None, max_req=0, wait_time=20,
+                 cache_size=65536, clock=time.time):
+        """Create a new blacklist.
 
-        :param: cfg (string) path of the configuration file.
+        :param: dbname (string) database where permanent blocks are stored,
+                or None to keep them in memory only.
+        :param: max_req (int) maximum number of requests a user can make
+                in a row, 0 (the default) to disable the check.
+        :param: wait_time (int) amount of time the user must wait before
+                making requests again after 'max_req' requests is reached,
+                in minutes.
+        :param: cache_size (int) maximum number of users tracked.
+        :param: clock (callable) function returning the current time.
 
         """
-        default_cfg = 'blacklist.cfg'
-        config = ConfigParser.ConfigParser()
-
-        if cfg is None or not os.path.isfile(cfg):
-            cfg = default_cfg
-
+        self.dbname = dbname
+        self.max_req = max_req
+        self.wait_time = wait_time
+        self.blocked = {}
+        self.recent = TTLCache(cache_size, wait_time * 60, clock=clock)
+        # Only opened when blocks are added or removed, see get_conn()
+        self.conn = None
+
+    def get_conn(self):
+        """Get the database connection used to store blocks."""
+        if self.conn is None and self.dbname:
+            self.conn = SQLite3(self.dbname)
+        return self.conn
+
+    def load(self):
+        """Load the permanently blocked users from the database."""
+        if not self.dbname:
+            return
         try:
-            with open(cfg) as f:
-                config.readfp(f)
-        except IOError:
-            raise ConfigError("File %s not found!" % cfg)
+            conn = sqlite3.connect(self.dbname)
+            try:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS blacklist(hid TEXT, "
+                    "service TEXT, date TEXT, PRIMARY KEY(hid, service))"
+                )
+                rows = conn.execute(
+                    "SELECT hid, service FROM blacklist"
+                ).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            log.info("BLACKLIST:: Could not load blacklist: {}".format(e))
+            return
+
+        prefixes = {}
+        for hid, service in rows:
+            prefixes.setdefault(service, []).append(prefix(hid))
+        self.blocked = dict(
+            (service, array('Q', sorted(p))) for service, p in prefixes.items()
+        )
+        log.info("BLACKLIST:: Loaded {} blocked users.".format(len(rows)))
+
+    def is_blocked(self, user, service):
+        """Check if a user is permanently blocked for a service.
 
-        try:
-            dbname = config.get('general', 'db')
-            logdir = config.get('log', 'dir')
-            logfile = os.path.join(logdir, 'blacklist.log')
-            loglevel = config.get('log', 'level')
-            self.db = db.DB(dbname)
-
-        except ConfigParser.Error as e:
-            raise ConfigError("%s" % e)
-        except db.Exception as e:
-            raise ConfigError("%s" % e)
-
-        # logging
-        log = logging.getLogger(__name__)
-
-        logging_format = utils.get_logging_format()
-        date_format = utils.get_date_format()
-        formatter = logging.Formatter(logging_format, date_format)
-
-        log.info('Redirecting BLACKLIST logging to %s' % logfile)
-        logfileh = logging.FileHandler(logfile, mode='a+')
-        logfileh.setFormatter(formatter)
-        logfileh.setLevel(logging.getLevelName(loglevel))
-        log.addHandler(logfileh)
-
-        # stop logging on stdout from now on
-        log.propagate = False
-        self.log = log
-
-    def is_blacklisted(self, user, service, max_req, wait_time):
+        :param: user (string) the hashed user.
+        :param: service (string) the service the user is making a request to.
+
+        """
+        blocked = self.blocked.get(service)
+        if not blocked:
+            return False
+        p = prefix(user)
+        i = bisect.bisect_left(blocked, p)
+        return i < len(blocked) and blocked[i] == p
+
+    def is_blacklisted(self, user, service):
         """Check if a user is blacklisted.
 
         The user is blacklisted if:
 
-        a) The 'blocked' field is set to one, meaning that is permanently
-        blacklisted.
+        a) It's permanently blocked for the service.
 
-        b) Does too many requests on a short period of time. For now, a user
-        that makes more than 'max_req' requests should wait 'wait_time'
-        minutes to make a new request.
+        b) Does too many requests on a short period of time. A user that
+        makes more than 'max_req' requests should wait 'wait_time' minutes
+        since the last one to make a new request.
 
         :param: user (string) the hashed user.
         :param: service (string) the service the user is making a request to.
-        :param: max_req (int) maximum number of requests a user can make
-                in a row.
-        :param: wait_time (int) amount of time the user must wait before
-                making requests again after 'max_req' requests is reached.
-                For now this is considered in minutes.
 
         :raise: BlacklistError if the user is blacklisted
 
         """
-        try:
-            self.log.info("Trying to get info from user")
-            self.db.connect()
-            r = self.db.get_user(user, service)
-            if r:
-                # permanently blacklisted
-                if r['blocked']:
-                    self.log.warning("Request from user permanently blocked")
-                    self.db.update_user(user, service, r['times']+1, 1)
-                    raise BlacklistError("Blocked user")
-                # don't be greedy
-                elif r['times'] >= max_req:
-                    last = datetime.datetime.fromtimestamp(
-                        float(r['last_request'])
-                    )
-                    next = last + datetime.timedelta(minutes=wait_time)
-
-                    if datetime.datetime.now() < next:
-                        self.log.warning("Too many requests from same user")
-                        self.db.update_user(user, service, r['times']+1, 0)
-                        raise BlacklistError("Too many requests")
-                    else:
-                        # fresh user again!
-                        self.log.info("Updating counter for existing user")
-                        self.db.update_user(user, service, 1, 0)
-                else:
-                    # adding up a request for user
-                    self.log.info("Request from existing user")
-                    self.db.update_user(user, service, r['times']+1, 0)
-            else:
-                # new request for user
-                self.log.info("Request from new user")
-                self.db.add_user(user, service, 0)
-        except db.DBError as e:
-            self.log.error("Something failed!")
-            raise InternalError("Error with database (%s)" % str(e))
-        except BlacklistError as e:
-            raise BlacklistError(e)
+        if self.is_blocked(user, service):
+            raise BlacklistError("Blocked user")
+
+        if self.max_req:
+            key = (service, user)
+            times = self.recent.get(key, 0)
+            if times >= self.max_req:
+                raise BlacklistError("Too many requests")
+            self.recent.set(key, times + 1)
+
+    def add(self, user, service):
+        """Permanently block a user for a service.
+
+        :param: user (string) the hashed user.
+        :param: service (string) the service the user is blocked for.
+
+        :return: deferred firing when the block is stored, or None if there
+        is no database.
+
+        """
+        if not self.is_blocked(user, service):
+            blocked = self.blocked.setdefault(service, array('Q'))
+            p = prefix(user)
+            blocked.insert(bisect.bisect_left(blocked, p), p)
+        if self.get_conn():
+            now_str = datetime.now().strftime("%Y%m%d%H%M%S")
+            return self.conn.add_blacklist(user, service, now_str)
+
+    def remove(self, user, service):
+        """Remove the permanent block of a user for a service.
+
+        :param: user (string) the hashed user.
+        :param: service (string) the service the user was blocked for.
+
+        :return: deferred firing when the block is removed, or None if there
+        is no database.
+
+        """
+        if self.is_blocked(user, service):
+            blocked = self.blocked[service]
+            del blocked[bisect.bisect_left(blocked, prefix(user))]
+        self.recent.pop((service, user))
+        if self.get_conn():
+            return self.conn.remove_blacklist(user, service)
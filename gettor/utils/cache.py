@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Bounded in-memory cache. Entries expire after a time to live and the
+    least recently used entry is evicted when the cache is full. It keeps
+    hit and miss counters and can be shared between threads.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, clock=time.monotonic):
+        """
+        Constructor.
+
+        :param maxsize (int): maximum number of entries.
+        :param ttl (float): default time to live of an entry, in seconds.
+        :param clock (callable): function returning the current time.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get the value of a key, or `default` if it's missing or expired.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > self.clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Set the value of a key.
+
+        :param ttl (float): time to live of this entry, if different from
+        the default one.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (self.clock() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > self.clock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def hit_rate(self):
+        """
+        Fraction of lookups that were served from the cache.
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate()
+        }
@@ -9,23 +9,461 @@
 
 from __future__ import absolute_import
 
-from datetime import datetime
+import os
+import re
+import time
+import sqlite3
 
-from twisted.python import log
+from datetime import datetime, timedelta
+from urllib.request import pathname2url
+
+from twisted.python import log, failure
+from twisted.internet import defer, reactor
 from twisted.enterprise import adbapi
 
+from . import migrations
+
+# Pragmas applied to every connection, unless overridden by `db_pragmas`.
+# WAL lets readers and the writer work at the same time, and a busy
+# timeout makes concurrent writers wait instead of failing as locked.
+DEFAULT_PRAGMAS = {
+	"busy_timeout": 5000,
+	"journal_mode": "WAL",
+	"synchronous": "NORMAL",
+	"cache_size": -8192,
+	"mmap_size": 67108864,
+	"temp_store": "MEMORY",
+}
+
+PRAGMA_RE = re.compile(r"^[A-Za-z_]+$")
+VALUE_RE = re.compile(r"^(-?\d+|[A-Za-z_]+)$")
+
+def get_pragmas(settings):
+	"""
+	Get the pragma profile of the database from the settings.
+	"""
+	pragmas = dict(DEFAULT_PRAGMAS)
+	pragmas.update(settings.get("db_pragmas", {}))
+	return pragmas
+
+def apply_pragmas(conn, pragmas):
+	"""
+	Apply a pragma profile to a sqlite3 connection. Pragmas set to None
+	are left untouched. The busy timeout goes first, changing the journal
+	mode needs a lock other connections may be holding.
+	"""
+	names = sorted(pragmas, key=lambda name: name != "busy_timeout")
+	for name in names:
+		value = pragmas[name]
+		if value is None:
+			continue
+		value = str(value)
+		if not (PRAGMA_RE.match(name) and VALUE_RE.match(value)):
+			raise ValueError("Invalid pragma {}={}".format(name, value))
+		conn.execute("PRAGMA {}={}".format(name, value))
+
+class WriteQueue(object):
+	"""
+	Single writer of a connection pool. Write queries are queued and
+	committed together in one transaction every `interval` seconds or every
+	`max_ops` queries, whichever comes first, and only one transaction is
+	in flight at a time. Each query runs in its own savepoint, so a failing
+	one doesn't undo the others, and its deferred fires after the commit.
+	"""
+	def __init__(self, dbpool, interval=0.05, max_ops=100, clock=reactor):
+		"""
+		Constructor.
+
+		:param dbpool (ConnectionPool): pool the transactions run in.
+		:param interval (float): maximum time a query waits to be
+		committed, in seconds. 0 commits as soon as possible.
+		:param max_ops (int): maximum number of queries per transaction.
+		"""
+		self.dbpool = dbpool
+		self.interval = interval
+		self.max_ops = max_ops
+		self.clock = clock
+		self.pending = []
+		self.waiters = []
+		self.in_flight = False
+		self.delayed = None
+		self.num_ops = 0
+		self.num_commits = 0
+		self.shutdown_trigger = reactor.addSystemEventTrigger(
+			"before", "shutdown", self.shutdown
+		)
+
+	def write(self, query, args=()):
+		"""
+		Queue a write query.
+
+		:return: deferred firing with the query results after the commit.
+		"""
+		return self.queue(None, query, args)
+
+	def interaction(self, func, *args):
+		"""
+		Queue a function to run in the group transaction, as
+		ConnectionPool.runInteraction does.
+
+		:return: deferred firing with the function result after the commit.
+		"""
+		return self.queue(func, None, args)
+
+	def queue(self, func, query, args):
+		d = defer.Deferred()
+		self.pending.append((func, query, args, d))
+		self.schedule()
+		return d
+
+	def schedule(self):
+		if self.in_flight or not self.pending:
+			return
+		if len(self.pending) >= self.max_ops or not self.interval:
+			self.flush()
+		elif self.delayed is None:
+			self.delayed = self.clock.callLater(self.interval, self.flush)
+
+	def flush(self):
+		"""
+		Commit the queued queries now, unless a transaction is in flight.
+		"""
+		if self.delayed is not None:
+			if self.delayed.active():
+				self.delayed.cancel()
+			self.delayed = None
+		if self.in_flight or not self.pending:
+			return
+
+		ops = self.pending[:self.max_ops]
+		del self.pending[:self.max_ops]
+		self.in_flight = True
+		d = self.dbpool.runInteraction(
+			self.run_ops, [op[:3] for op in ops]
+		)
+		d.addCallbacks(self.committed, self.failed, (ops,), None, (ops,))
+		d.addBoth(self.done)
+
+	def run_ops(self, txn, ops):
+		"""
+		Run a group of queries in one transaction, in a pool thread.
+		"""
+		results = []
+		txn.execute("BEGIN IMMEDIATE")
+		for func, query, args in ops:
+			txn.execute("SAVEPOINT op")
+			try:
+				if func is None:
+					txn.execute(query, args)
+					results.append((True, txn.fetchall()))
+				else:
+					results.append((True, func(txn, *args)))
+			except Exception:
+				results.append((False, failure.Failure()))
+				txn.execute("ROLLBACK TO op")
+			txn.execute("RELEASE op")
+		return results
+
+	def committed(self, results, ops):
+		self.num_ops += len(ops)
+		self.num_commits += 1
+		for (success, result), op in zip(results, ops):
+			d = op[-1]
+			if success:
+				d.callback(result)
+			else:
+				d.errback(result)
+
+	def failed(self, error, ops):
+		for op in ops:
+			op[-1].errback(error)
+
+	def done(self, _):
+		self.in_flight = False
+		if self.pending:
+			self.schedule()
+		else:
+			waiters, self.waiters = self.waiters, []
+			for d in waiters:
+				d.callback(None)
+
+	def drain(self):
+		"""
+		Commit all the queued queries.
+
+		:return: deferred firing when there is nothing left to commit.
+		"""
+		if not self.in_flight and not self.pending:
+			return defer.succeed(None)
+		d = defer.Deferred()
+		self.waiters.append(d)
+		self.flush()
+		return d
+
+	def shutdown(self):
+		"""
+		Shutdown trigger, the reactor forgets the trigger once it fired.
+		"""
+		self.shutdown_trigger = None
+		return self.drain()
+
+	def stop(self):
+		"""
+		Remove the shutdown trigger, if it hasn't fired yet.
+		"""
+		if self.shutdown_trigger:
+			reactor.removeSystemEventTrigger(self.shutdown_trigger)
+			self.shutdown_trigger = None
+
+
+# Shared pools of this process, by database name
+_pools = {}
+
+class SharedPool(object):
+	"""
+	Connection pool and writer of a database, shared by all the SQLite3
+	objects of the process that use it. It's closed when the last of them
+	is closed, so the number of threads and connections doesn't depend on
+	how many objects are created.
+	"""
+	def __init__(self, dbname, pragmas, commit_interval, commit_max_ops,
+				 cp_min, cp_max):
+		self.dbname = dbname
+		self.refs = 0
+		self.dbpool = adbapi.ConnectionPool(
+			"sqlite3", dbname, check_same_thread=False,
+			cp_min=cp_min, cp_max=cp_max,
+			cp_openfun=lambda conn: apply_pragmas(conn, pragmas)
+		)
+		self.writer = WriteQueue(self.dbpool, commit_interval, commit_max_ops)
+
+	def close(self):
+		"""
+		Commit the queued writes and close the pool.
+
+		:return: deferred firing when the pool is closed.
+		"""
+		self.writer.stop()
+		d = self.writer.drain()
+		d.addCallback(lambda _: self.dbpool.close())
+		return d
+
+def acquire_pool(dbname, pragmas=None, commit_interval=0.05,
+				 commit_max_ops=100, cp_min=3, cp_max=5):
+	"""
+	Get the shared pool of a database, opening it if needed. The options
+	only apply when the pool is opened, later callers share it as it is.
+
+	:return: SharedPool, to be given back with release_pool().
+	"""
+	pool = _pools.get(dbname)
+	if pool is None:
+		migrations.ensure_schema(dbname)
+		if pragmas is None:
+			pragmas = DEFAULT_PRAGMAS
+		pool = SharedPool(
+			dbname, pragmas, commit_interval, commit_max_ops, cp_min, cp_max
+		)
+		_pools[dbname] = pool
+	pool.refs += 1
+	return pool
+
+def release_pool(pool):
+	"""
+	Give back a pool got from acquire_pool(), closing it if it's no longer
+	used.
+
+	:return: deferred firing when the pool is closed, or None if it's still
+	in use.
+	"""
+	pool.refs -= 1
+	if pool.refs > 0:
+		return None
+	if _pools.get(pool.dbname) is pool:
+		del _pools[pool.dbname]
+	return pool.close()
+
+def get_shards(settings):
+	"""
+	Get the database file of each shard from the settings. `db_shards` maps
+	a service (`email`, `twitter`) or `links` to its own file, so their
+	writes don't wait for each other's locks. Shards not listed there stay
+	in `dbname`.
+	"""
+	return dict(settings.get("db_shards", {}))
+
+STATS_COLUMNS = "num_requests, platform, language, command, service, date, "\
+                "updated"
+
+# Periods of the stats_rollups table, maintained along with stats
+ROLLUP_PERIODS = ("day", "week", "month")
+
+ROLLUP_UPSERT = "INSERT INTO stats_rollups(period, start, platform, "\
+                "language, command, service, num_requests) VALUES(?, ?, ?, "\
+                "?, ?, ?, ?) ON CONFLICT(period, start, platform, language, "\
+                "command, service) DO UPDATE SET "\
+                "num_requests=num_requests+excluded.num_requests"
+
+def period_start(period, date):
+	"""
+	Get the first day of the period containing a stats date, weeks start
+	on monday. Both are YYYYmmdd strings.
+	"""
+	day = datetime.strptime(str(date), "%Y%m%d")
+	if period == "week":
+		day -= timedelta(days=day.weekday())
+	elif period == "month":
+		day = day.replace(day=1)
+	return day.strftime("%Y%m%d")
+
+def rollup_args(num, platform, language, command, service, date):
+	"""
+	Get the ROLLUP_UPSERT arguments adding `num` requests of a stats row
+	to its periods. Rollups store missing platforms and languages as ''.
+	"""
+	return [
+		(period, period_start(period, date), platform or '', language or '',
+		 command, service, num)
+		for period in ROLLUP_PERIODS
+	]
+
+def open_stats(settings, readonly=False):
+	"""
+	Open a sqlite3 connection to the main database with the shards attached
+	and temporary `all_stats` and `all_rollups` views adding up the stats
+	and rollups of all of them. `updated` is the last time any of the
+	stats rows added up changed.
+
+	:param readonly (bool): open the files read only, so the connection
+	never takes a write lock. They must be migrated already.
+
+	:return: sqlite3.Connection, to be closed by the caller.
+	"""
+	def uri(filename):
+		return "file:{}{}".format(
+			pathname2url(os.path.abspath(filename)),
+			"?mode=ro" if readonly else ""
+		)
+
+	dbname = settings.get("dbname")
+	conn = sqlite3.connect(uri(dbname), uri=True)
+	if not readonly:
+		migrations.migrate(conn)
+	selects = ["SELECT {} FROM main.stats".format(STATS_COLUMNS)]
+	rollups = ["SELECT * FROM main.stats_rollups"]
+	files = sorted(set(get_shards(settings).values()) - set([dbname]))
+	for num, filename in enumerate(files):
+		if not readonly:
+			migrations.ensure_schema(filename)
+		conn.execute(
+			"ATTACH DATABASE ? AS shard{}".format(num), (uri(filename),)
+		)
+		selects.append(
+			"SELECT {} FROM shard{}.stats".format(STATS_COLUMNS, num)
+		)
+		rollups.append("SELECT * FROM shard{}.stats_rollups".format(num))
+	conn.execute(
+		"CREATE TEMP VIEW all_stats AS SELECT SUM(num_requests) AS "
+		"num_requests, platform, language, command, service, date, "
+		"MAX(updated) AS updated FROM ({}) "
+		"GROUP BY platform, language, command, service, date".format(
+			" UNION ALL ".join(selects)
+		)
+	)
+	conn.execute(
+		"CREATE TEMP VIEW all_rollups AS SELECT period, start, platform, "
+		"language, command, service, SUM(num_requests) AS num_requests FROM "
+		"({}) GROUP BY period, start, platform, language, command, "
+		"service".format(" UNION ALL ".join(rollups))
+	)
+	return conn
+
 class SQLite3(object):
 	"""
 	This class handles the database connections and operations.
 	"""
-	def __init__(self, dbname):
-		"""Constructor."""
-		self.dbpool = adbapi.ConnectionPool(
-			"sqlite3", dbname, check_same_thread=False
+	def __init__(self, dbname, pragmas=None, commit_interval=0.05,
+				 commit_max_ops=100, cp_min=3, cp_max=5, shards=None):
+		"""
+		Constructor. Objects of the same database share its pool, see
+		acquire_pool(). Requests and stats of a service, and links, are
+		routed to their shard if they have one, see get_shards().
+
+		:param dbname (str): database filename.
+		:param pragmas (dict): pragma profile applied to every connection
+		of the pool, DEFAULT_PRAGMAS if None.
+		:param commit_interval (float): maximum time a write waits to be
+		committed with others, in seconds.
+		:param commit_max_ops (int): maximum number of writes per commit.
+		:param cp_min (int): minimum number of connections of the pool.
+		:param cp_max (int): maximum number of connections of the pool.
+		:param shards (dict): database filename by service or `links`.
+		"""
+		self.pool = acquire_pool(
+			dbname, pragmas, commit_interval, commit_max_ops, cp_min, cp_max
 		)
+		self.dbpool = self.pool.dbpool
+		self.writer = self.pool.writer
+		# Shards in other files, each with its own pool and writer
+		self.shards = {}
+		for name, filename in (shards or {}).items():
+			if filename != dbname:
+				self.shards[name] = acquire_pool(
+					filename, pragmas, commit_interval, commit_max_ops,
+					cp_min, cp_max
+				)
+
+	@classmethod
+	def from_settings(cls, settings):
+		"""
+		Open the database of the settings with its pragma profile, group
+		commit and pool options.
+		"""
+		return cls(
+			settings.get("dbname"), get_pragmas(settings),
+			settings.get("db_commit_interval", 0.05),
+			settings.get("db_commit_max_ops", 100),
+			settings.get("db_cp_min", 3),
+			settings.get("db_cp_max", 5),
+			get_shards(settings)
+		)
+
+	def route(self, shard):
+		"""
+		Get the pool of a shard, the main one if it isn't sharded.
+		"""
+		return self.shards.get(shard, self.pool)
+
+	def get_pools(self):
+		"""
+		Get the distinct pools in use, the main one first.
+		"""
+		pools = [self.pool]
+		for pool in self.shards.values():
+			if pool not in pools:
+				pools.append(pool)
+		return pools
+
+	def close(self):
+		"""
+		Stop using the shared pools. It can be called more than once.
+
+		:return: deferred firing when the pools are closed, or None if they
+		are still in use or were already released.
+		"""
+		if self.pool is None:
+			return None
+		# One release per pool acquired, shards may share a file
+		pools = [self.pool] + list(self.shards.values())
+		self.pool = None
+		self.shards = {}
+		closing = [d for d in map(release_pool, pools) if d is not None]
+		if closing:
+			return defer.gatherResults(closing)
 
 	def __del__(self):
-		self.dbpool.close()
+		if getattr(self, "pool", None) is not None:
+			self.close()
 
 	def query_callback(self, results=None):
 		"""
@@ -47,9 +485,10 @@ class SQLite3(object):
 		"""
 		Perform a new request to the database
 		"""
-		query = "INSERT INTO requests VALUES(?, ?, ?, ?, ?, ?, ?)"
+		query = "INSERT INTO requests(id, command, platform, language, "\
+		        "service, date, status) VALUES(?, ?, ?, ?, ?, ?, ?)"
 
-		return self.dbpool.runQuery(
+		return self.route(service).writer.write(
 			query, (id, command, platform, language, service, date, status)
 		).addCallback(self.query_callback).addErrback(self.query_errback)
 
@@ -59,7 +498,7 @@ class SQLite3(object):
 		"""
 		query = "SELECT * FROM requests WHERE service=? AND status = ?"
 
-		return self.dbpool.runQuery(
+		return self.route(service).dbpool.runQuery(
 			query, (service, status)
 		).addCallback(self.query_callback).addErrback(self.query_errback)
 
@@ -69,7 +508,7 @@ class SQLite3(object):
 		"""
 		query = "SELECT COUNT(rowid) FROM requests WHERE id=? AND service=?"
 
-		return self.dbpool.runQuery(
+		return self.route(service).dbpool.runQuery(
 			query, (id, service)
 		).addCallback(self.query_callback).addErrback(self.query_errback)
 
@@ -79,29 +518,114 @@ class SQLite3(object):
 		"""
 		query = "DELETE FROM requests WHERE id=? AND service=? AND date=?"
 
-		return self.dbpool.runQuery(
+		return self.route(service).writer.write(
 			query, (id, service, date)
 		).addCallback(self.query_callback).addErrback(self.query_errback)
 
+	def update_request(self, id, hid, status, service, date):
+		"""
+		Update the status of a request, replacing its id by the hashed one
+		"""
+		query = "UPDATE requests SET id=?, status=? WHERE id=? AND "\
+		        "service=? AND date=?"
+
+		return self.route(service).writer.write(
+			query, (hid, status, id, service, date)
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def claim_requests(self, service, worker, limit, lease_time, after=None):
+		"""
+		Atomically claim up to `limit` queued requests of a service, oldest
+		first. Claimed requests are IN_PROGRESS and owned by `worker` until
+		their lease expires, `lease_time` seconds from now.
+
+		:param after (tuple): (date, rowid) of the last request claimed, to
+		page through the queue without reading it all.
+
+		:return: deferred firing with a list of (rowid, id, command,
+		platform, language, service, date) rows.
+		"""
+		return self.route(service).writer.interaction(
+			self._claim_requests, service, worker, limit, lease_time, after
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def _claim_requests(self, txn, service, worker, limit, lease_time, after):
+		query = "SELECT rowid, id, command, platform, language, service, "\
+		        "date FROM requests WHERE service=? AND status='ONHOLD'"
+		args = (service,)
+		if after:
+			query += " AND (date, rowid) > (?, ?)"
+			args += tuple(after)
+		txn.execute(query + " ORDER BY date, rowid LIMIT ?", args + (limit,))
+		rows = txn.fetchall()
+
+		lease = int(time.time()) + lease_time
+		txn.executemany(
+			"UPDATE requests SET status='IN_PROGRESS', worker=?, lease=? "
+			"WHERE rowid=?", [(worker, lease, row[0]) for row in rows]
+		)
+		return rows
+
+	def complete_request(self, rowid, worker, service):
+		"""
+		Remove a claimed request once it has been served, if it's still
+		owned by `worker`
+		"""
+		query = "DELETE FROM requests WHERE rowid=? AND worker=?"
+
+		return self.route(service).writer.write(
+			query, (rowid, worker)
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def release_request(self, rowid, worker, service):
+		"""
+		Put a claimed request back in the queue
+		"""
+		query = "UPDATE requests SET status='ONHOLD', worker=NULL, "\
+		        "lease=NULL WHERE rowid=? AND worker=?"
+
+		return self.route(service).writer.write(
+			query, (rowid, worker)
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def reap_requests(self, now=None):
+		"""
+		Put the requests whose lease has expired, e.g. because their worker
+		crashed, back in the queue
+		"""
+		query = "UPDATE requests SET status='ONHOLD', worker=NULL, "\
+		        "lease=NULL WHERE status='IN_PROGRESS' AND lease<?"
+
+		now = int(time.time()) if now is None else now
+		return defer.gatherResults([
+			pool.writer.write(query, (now,)) for pool in self.get_pools()
+		]).addCallback(self.query_callback).addErrback(self.query_errback)
+
 	def update_stats(self, command, service, platform=None, language='en'):
 		"""
 		Update statistics to the database
 		"""
 		now_str = datetime.now().strftime("%Y%m%d")
 		query = "INSERT INTO stats(num_requests, platform, language, command, "\
-		        "service, date) VALUES (1, ?, ?, ?, ?, ?) ON CONFLICT(platform, "\
-				"language, command, service, date) DO UPDATE SET num_requests=num_requests+1"
+		        "service, date, updated) VALUES (1, ?, ?, ?, ?, ?, ?) ON CONFLICT(platform, "\
+				"language, command, service, date) DO UPDATE SET num_requests=num_requests+1, "\
+				"updated=excluded.updated"
 
-		return self.dbpool.runQuery(
-			query, (platform, language, command, service, now_str)
+		return self.route(service).writer.interaction(
+			self._update_stats, query, (platform, language, command, service,
+			now_str, int(time.time()))
 		).addCallback(self.query_callback).addErrback(self.query_errback)
 
+	def _update_stats(self, txn, query, args):
+		txn.execute(query, args)
+		txn.executemany(ROLLUP_UPSERT, rollup_args(1, *args[:5]))
+
 	def get_links(self, platform, language, status):
 		"""
 		Get links from the database per platform
 		"""
 		query = "SELECT * FROM links WHERE platform=? AND language=? AND status=?"
-		return self.dbpool.runQuery(
+		return self.route("links").dbpool.runQuery(
 			query, (platform, language, status)
 		).addCallback(self.query_callback).addErrback(self.query_errback)
 
@@ -110,5 +634,41 @@ class SQLite3(object):
 		Get a list of the supported tor browser binary locales
 		"""
 		query = "SELECT DISTINCT language FROM links"
-		return self.dbpool.runQuery(query
+		return self.route("links").dbpool.runQuery(query
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def get_link_variants(self):
+		"""
+		Get the (platform, language) pairs with active links
+		"""
+		query = "SELECT DISTINCT platform, language FROM links WHERE "\
+			"status='ACTIVE' ORDER BY platform, language"
+		return self.route("links").dbpool.runQuery(query
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def get_links_version(self):
+		"""
+		Get the version of the links table, bumped by triggers on every
+		change, see migrations.py
+		"""
+		query = "SELECT version FROM links_version"
+		return self.route("links").dbpool.runQuery(query
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def add_blacklist(self, hid, service, date):
+		"""
+		Permanently block a hashed id for a service
+		"""
+		query = "INSERT OR REPLACE INTO blacklist VALUES(?, ?, ?)"
+		return self.writer.write(
+			query, (hid, service, date)
+		).addCallback(self.query_callback).addErrback(self.query_errback)
+
+	def remove_blacklist(self, hid, service):
+		"""
+		Remove a permanent block
+		"""
+		query = "DELETE FROM blacklist WHERE hid=? AND service=?"
+		return self.writer.write(
+			query, (hid, service)
 		).addCallback(self.query_callback).addErrback(self.query_errback)
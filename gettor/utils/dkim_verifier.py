@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import time
+import threading
+
+import dkim
+import dkim.dnsplug
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from .cache import TTLCache
+from .commons import log
+
+_verifier = None
+
+
+def get_verifier(settings):
+    """
+    Get the DKIM verifier of this process, so that all the email parsers
+    share the same threads and key cache.
+    """
+    global _verifier
+    if _verifier is None:
+        _verifier = DKIMVerifier(
+            max_workers=settings.get("dkim_workers", 4),
+            key_ttl=settings.get("dkim_key_ttl", 3600),
+            key_cache_size=settings.get("dkim_key_cache_size", 1024)
+        )
+    return _verifier
+
+
+class DKIMVerifier(object):
+    """
+    Verify DKIM signatures in a bounded pool of threads, so the RSA
+    verification and the DNS lookup of the selector key don't block the
+    reactor. Selector keys are cached by (selector, domain).
+    """
+
+    def __init__(self, max_workers=4, key_ttl=3600, key_cache_size=1024,
+                 negative_ttl=300, dnsfunc=dkim.dnsplug.get_txt):
+        """
+        Constructor.
+
+        :param max_workers (int): maximum number of concurrent verifications.
+        :param key_ttl (int): time to keep a selector key, in seconds.
+        :param key_cache_size (int): maximum number of keys cached.
+        :param negative_ttl (int): time to remember a missing key, in seconds.
+        :param dnsfunc (callable): function used to look up TXT records.
+        """
+        self.keys = TTLCache(key_cache_size, key_ttl)
+        self.negative_ttl = negative_ttl
+        self.dnsfunc = dnsfunc
+        self.threadpool = ThreadPool(0, max_workers, name="dkim")
+        self.shutdown_trigger = None
+
+        self.num_valid = 0
+        self.num_invalid = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not self.threadpool.started:
+            self.threadpool.start()
+            self.shutdown_trigger = reactor.addSystemEventTrigger(
+                "during", "shutdown", self.shutdown
+            )
+
+    def shutdown(self):
+        """
+        Shutdown trigger, the reactor forgets the trigger once it fired.
+        """
+        self.shutdown_trigger = None
+        self.stop()
+
+    def stop(self):
+        """
+        Stop the verification threads and log the verifier statistics.
+        """
+        if self.shutdown_trigger:
+            reactor.removeSystemEventTrigger(self.shutdown_trigger)
+            self.shutdown_trigger = None
+        if self.threadpool.started:
+            self.threadpool.stop()
+            log.info("DKIM:: {}".format(self.stats()))
+
+    def get_txt(self, name, timeout=5):
+        """
+        Cached version of dkim.dnsplug.get_txt, used as `dnsfunc` by
+        dkim.verify.
+
+        :param name (bytes): name to look up, selector._domainkey.domain.
+        """
+        selector, _, domain = name.rstrip(b".").lower().partition(
+            b"._domainkey."
+        )
+        key = (selector, domain)
+        txt = self.keys.get(key, False)
+        if txt is False:
+            txt = self.dnsfunc(name, timeout=timeout)
+            if txt:
+                self.keys.set(key, txt)
+            else:
+                self.keys.set(key, txt, self.negative_ttl)
+        return txt
+
+    def verify_sync(self, msg):
+        """
+        Verify the DKIM signature of a message in the current thread.
+
+        :param msg (bytes): the message as received.
+
+        :return: True if the signature is valid.
+        """
+        start = time.time()
+        try:
+            valid = dkim.verify(msg, dnsfunc=self.get_txt)
+        except dkim.DKIMException:
+            valid = False
+        elapsed = time.time() - start
+
+        with self._lock:
+            if valid:
+                self.num_valid += 1
+            else:
+                self.num_invalid += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+        return valid
+
+    def verify(self, msg):
+        """
+        Verify the DKIM signature of a message in the verifier threads.
+
+        :param msg (bytes): the message as received.
+
+        :return: deferred firing with True if the signature is valid.
+        """
+        self.start()
+        return threads.deferToThreadPool(
+            reactor, self.threadpool, self.verify_sync, msg
+        )
+
+    def stats(self):
+        """
+        Verification latency and key cache statistics.
+        """
+        num_verified = self.num_valid + self.num_invalid
+        return {
+            "valid": self.num_valid,
+            "invalid": self.num_invalid,
+            "mean_latency": self.total_time / num_verified if num_verified else 0.0,
+            "max_latency": self.max_time,
+            "key_cache": self.keys.stats()
+        }
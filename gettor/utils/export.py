@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: hiro <hiro@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2019, The Tor Project, Inc.
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+"""
+Incremental export of the GetTor stats. Each run only reads the rows
+updated since the previous one, from a read only connection, and writes
+the totals of their keys as gzipped CSV files partitioned by the date of
+the stats.
+"""
+
+from __future__ import absolute_import
+
+import os
+import csv
+import gzip
+import json
+import time
+
+from datetime import datetime, timedelta
+
+from .db import open_stats
+from .commons import log
+
+HEADER = [
+    "num_requests", "platform", "language", "command", "service", "date"
+]
+ROLLUP_HEADER = ["period", "service", "command", "platform", "num_requests"]
+
+
+def day_period(date):
+    """
+    Daily rollup period of a stats date, and the range of dates in it.
+    """
+    return date.strftime("%Y-%m-%d"), date, date
+
+
+def week_period(date):
+    """
+    Weekly rollup period (ISO week) of a stats date, and the range of dates
+    in it.
+    """
+    year, week, weekday = date.isocalendar()
+    first = date - timedelta(days=weekday - 1)
+    return "{}-W{:02d}".format(year, week), first, first + timedelta(days=6)
+
+
+ROLLUPS = {"daily": day_period, "weekly": week_period}
+
+
+class StatsExport(object):
+    """
+    Export the stats changed since the last watermark, the update time of
+    the newest row exported so far, stored in `outdir`/watermark.json.
+    """
+
+    def __init__(self, settings, outdir, clock=time.time, overlap=300):
+        """
+        Constructor.
+
+        :param settings (Settings): settings with the database and shards.
+        :param outdir (str): directory where the files are written.
+        :param clock (callable): function returning the current time.
+        :param overlap (int): seconds before the watermark read again on
+        each run. Writers stamp `updated` before they commit, so a row may
+        show up after the watermark moved past its stamp.
+        """
+        self.settings = settings
+        self.outdir = outdir
+        self.clock = clock
+        self.overlap = overlap
+        self.state = os.path.join(outdir, "watermark.json")
+
+    def load_watermark(self):
+        """
+        Get the watermark of the last export, -1 if there was none, and the
+        rows of the overlap exported by it.
+
+        :return: tuple with the watermark and a set of (schema, platform,
+        language, command, service, date, updated) tuples.
+        """
+        if not os.path.isfile(self.state):
+            return -1, set()
+        with open(self.state) as f:
+            state = json.load(f)
+        return state["watermark"], set(
+            tuple(row) for row in state.get("exported", [])
+        )
+
+    def save_watermark(self, watermark, exported=()):
+        state = {"watermark": watermark, "exported": sorted(exported)}
+        self.write_atomic(self.state, lambda f: json.dump(state, f))
+
+    def write_atomic(self, path, write, compress=False):
+        """
+        Write a file under a temporary name and move it in place, so readers
+        never see half written files.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        if compress:
+            f = gzip.open(tmp, "wt", newline="")
+        else:
+            f = open(tmp, "w")
+        with f:
+            write(f)
+        os.replace(tmp, path)
+
+    def get_schemas(self, conn):
+        """
+        Names of the main database and the attached shards.
+        """
+        return [
+            row[1] for row in conn.execute("PRAGMA database_list")
+            if row[1] != "temp"
+        ]
+
+    def find_changes(self, conn, schemas, watermark, exported, cutoff):
+        """
+        Collect in the temporary `changed` table the keys of the stats rows
+        updated in (`watermark` - overlap, `cutoff`] and not exported yet.
+        Each shard is read on its own, so the `stats_updated` index is used.
+
+        :return: set of the rows of the overlap of the next run.
+        """
+        conn.execute(
+            "CREATE TEMP TABLE changed(platform, language, command, service, "
+            "date, PRIMARY KEY(platform, language, command, service, date))"
+        )
+        seen = set()
+        for schema in schemas:
+            rows = conn.execute(
+                "SELECT platform, language, command, service, date, updated "
+                "FROM {}.stats WHERE updated > ? AND updated <= ?".format(
+                    schema
+                ), (watermark - self.overlap, cutoff)
+            )
+            keys = []
+            for row in rows:
+                row = (schema,) + tuple(row)
+                if row[-1] > cutoff - self.overlap:
+                    seen.add(row)
+                if row not in exported:
+                    keys.append(row[1:-1])
+            conn.executemany(
+                "INSERT OR IGNORE INTO changed VALUES(?, ?, ?, ?, ?)", keys
+            )
+        return seen
+
+    def run(self, rollups=()):
+        """
+        Export the stats updated since the last run.
+
+        :param rollups (list): names of the rollups to write for the periods
+        with changes, `daily` and/or `weekly`.
+
+        :return: dict with the number of `rows` exported and the `files`
+        written.
+        """
+        watermark, exported = self.load_watermark()
+        # Rows of the current second may still change, they go next time
+        cutoff = int(self.clock()) - 1
+        report = {"rows": 0, "files": []}
+
+        conn = open_stats(self.settings, readonly=True)
+        try:
+            schemas = self.get_schemas(conn)
+            seen = self.find_changes(
+                conn, schemas, watermark, exported, cutoff
+            )
+            # Totals of the changed keys only, looked up by primary key
+            cursor = conn.execute(
+                "SELECT SUM(num_requests), platform, language, command, "
+                "service, date FROM ({}) GROUP BY platform, language, "
+                "command, service, date ORDER BY date".format(
+                    " UNION ALL ".join(
+                        "SELECT s.num_requests, c.* FROM temp.changed c "
+                        "JOIN {}.stats s ON s.platform IS c.platform AND "
+                        "s.language IS c.language AND s.command IS c.command "
+                        "AND s.service IS c.service AND s.date IS c.date"
+                        .format(schema) for schema in schemas
+                    )
+                )
+            )
+            dates = self.write_partitions(cursor, cutoff, report)
+            for name in rollups:
+                self.write_rollups(conn, ROLLUPS[name], name, dates, report)
+        finally:
+            conn.close()
+
+        self.save_watermark(cutoff, seen)
+        log.info("EXPORT:: Exported {} stats rows to {} files.".format(
+            report["rows"], len(report["files"])
+        ))
+        return report
+
+    def write_partitions(self, cursor, cutoff, report):
+        """
+        Stream the rows, ordered by date, to one file per date.
+
+        :return: set of the dates written.
+        """
+        dates = set()
+        group = []
+
+        def flush():
+            date = datetime.strptime(str(group[0][5]), "%Y%m%d")
+            path = os.path.join(
+                self.outdir, date.strftime("%Y-%m-%d"),
+                "stats-{}.csv.gz".format(cutoff)
+            )
+            rows = list(group)
+            self.write_atomic(path, lambda f: self.write_csv(
+                f, HEADER, rows
+            ), compress=True)
+            report["files"].append(path)
+            dates.add(date)
+
+        for row in cursor:
+            if group and row[5] != group[0][5]:
+                flush()
+                group = []
+            group.append(row)
+            report["rows"] += 1
+        if group:
+            flush()
+        return dates
+
+    def write_rollups(self, conn, period, name, dates, report):
+        """
+        Write the totals of each period with changes, replacing the file of
+        the period written before.
+        """
+        periods = dict(
+            (period(date)[0], period(date)) for date in dates
+        )
+        for label, first, last in sorted(periods.values()):
+            rows = conn.execute(
+                "SELECT ?, service, command, platform, SUM(num_requests) "
+                "FROM all_stats WHERE date BETWEEN ? AND ? "
+                "GROUP BY service, command, platform "
+                "ORDER BY service, command, platform",
+                (label, first.strftime("%Y%m%d"), last.strftime("%Y%m%d"))
+            ).fetchall()
+            path = os.path.join(
+                self.outdir, "rollups", "{}-{}.csv.gz".format(name, label)
+            )
+            self.write_atomic(path, lambda f: self.write_csv(
+                f, ROLLUP_HEADER, rows
+            ), compress=True)
+            report["files"].append(path)
+
+    def write_csv(self, f, header, rows):
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+"""
+Versioned schema of the GetTor database. Migrations are applied in order,
+each one in its own transaction, and recorded in the `schema_version`
+table, so a live database can be upgraded in place.
+"""
+
+from __future__ import absolute_import
+
+import time
+import sqlite3
+import threading
+
+from .commons import log
+
+# Databases already migrated by this process
+_migrated = set()
+_lock = threading.Lock()
+
+# YYYYmmdd[HHMMSS] text dates, in local time, as unix timestamps
+_PADDED_DATE = "(date || '000000')"
+_TEXT_DATE = (
+    "CAST(strftime('%s', substr({d}, 1, 4) || '-' || substr({d}, 5, 2) "
+    "|| '-' || substr({d}, 7, 2) || ' ' || substr({d}, 9, 2) || ':' "
+    "|| substr({d}, 11, 2) || ':' || substr({d}, 13, 2), 'utc') AS INTEGER)"
+).format(d=_PADDED_DATE)
+
+# YYYYmmdd stats dates as YYYY-mm-dd
+_ISO_DATE = (
+    "substr(date, 1, 4) || '-' || substr(date, 5, 2) || '-' || "
+    "substr(date, 7, 2)"
+)
+
+MIGRATIONS = [
+    (1, "base schema", [
+        "CREATE TABLE IF NOT EXISTS requests(id TEXT, command TEXT, "
+        "platform TEXT, language TEXT, service TEXT, date TEXT, status TEXT)",
+        "CREATE TABLE IF NOT EXISTS links(link TEXT, platform TEXT, "
+        "language TEXT, arch TEXT, version TEXT, provider TEXT, status TEXT, "
+        "file TEXT)",
+        "CREATE TABLE IF NOT EXISTS stats(num_requests NUMBER, "
+        "platform TEXT, language TEXT, command TEXT, service TEXT, date, "
+        "PRIMARY KEY (platform, language, command, service, date))",
+        "CREATE TABLE IF NOT EXISTS rate_limits(service TEXT, hid TEXT, "
+        "bucket INTEGER, num_requests INTEGER, "
+        "PRIMARY KEY(service, hid, bucket))",
+        "CREATE TABLE IF NOT EXISTS blacklist(hid TEXT, service TEXT, "
+        "date TEXT, PRIMARY KEY(hid, service))",
+    ]),
+    (2, "integer request timestamps", [
+        "CREATE TABLE requests_new(id TEXT, command TEXT, platform TEXT, "
+        "language TEXT, service TEXT, date INTEGER, status TEXT)",
+        "INSERT INTO requests_new SELECT id, command, platform, language, "
+        "service, CASE typeof(date) WHEN 'integer' THEN date ELSE "
+        + _TEXT_DATE + " END, status FROM requests",
+        "DROP TABLE requests",
+        "ALTER TABLE requests_new RENAME TO requests",
+    ]),
+    (3, "indexes", [
+        # get_requests
+        "CREATE INDEX IF NOT EXISTS requests_service_status "
+        "ON requests(service, status, date)",
+        # get_num_requests and remove_request
+        "CREATE INDEX IF NOT EXISTS requests_id_service "
+        "ON requests(id, service)",
+        # get_links
+        "CREATE INDEX IF NOT EXISTS links_platform_language_status "
+        "ON links(platform, language, status)",
+    ]),
+    (4, "request leases", [
+        "ALTER TABLE requests ADD COLUMN worker TEXT",
+        "ALTER TABLE requests ADD COLUMN lease INTEGER",
+        # reap_requests
+        "CREATE INDEX IF NOT EXISTS requests_status_lease "
+        "ON requests(status, lease)",
+    ]),
+    (5, "stats update times", [
+        "ALTER TABLE stats ADD COLUMN updated INTEGER",
+        # Existing rows go out with the first incremental export
+        "UPDATE stats SET updated=0",
+        # export_stats
+        "CREATE INDEX IF NOT EXISTS stats_updated ON stats(updated)",
+    ]),
+    (6, "distinct requesters", [
+        # HyperLogLog sketches, see gettor.utils.stats
+        "CREATE TABLE IF NOT EXISTS requesters(service TEXT, date TEXT, "
+        "sketch BLOB, updated INTEGER, PRIMARY KEY(service, date))",
+    ]),
+    (7, "stats rollups", [
+        "CREATE TABLE IF NOT EXISTS stats_rollups(period TEXT, start TEXT, "
+        "platform TEXT, language TEXT, command TEXT, service TEXT, "
+        "num_requests INTEGER, PRIMARY KEY(period, start, platform, "
+        "language, command, service))",
+    ] + [
+        "INSERT INTO stats_rollups SELECT '{}', {}, COALESCE(platform, ''), "
+        "COALESCE(language, ''), command, service, SUM(num_requests) FROM "
+        "stats GROUP BY 2, 3, 4, 5, 6".format(period, start)
+        for period, start in (
+            ("day", "CAST(date AS TEXT)"),
+            ("week", "strftime('%Y%m%d', " + _ISO_DATE + ", 'weekday 0', "
+             "'-6 days')"),
+            ("month", "substr(date, 1, 6) || '01'"),
+        )
+    ]),
+    (8, "links version", [
+        # Bumped on every change, so cached replies know when to go stale
+        "CREATE TABLE IF NOT EXISTS links_version(version INTEGER)",
+        "INSERT INTO links_version VALUES(0)",
+    ] + [
+        "CREATE TRIGGER IF NOT EXISTS links_{0} AFTER {0} ON links BEGIN "
+        "UPDATE links_version SET version=version+1; END".format(event)
+        for event in ("INSERT", "UPDATE", "DELETE")
+    ]),
+    (9, "stable request ids", [
+        # VACUUM may renumber implicit rowids, leased requests are claimed
+        # by rowid. An INTEGER PRIMARY KEY is the rowid and is kept, it goes
+        # last so SELECT * rows keep their layout.
+        "CREATE TABLE requests_new(id TEXT, command TEXT, platform TEXT, "
+        "language TEXT, service TEXT, date INTEGER, status TEXT, "
+        "worker TEXT, lease INTEGER, num INTEGER PRIMARY KEY)",
+        "INSERT INTO requests_new SELECT id, command, platform, language, "
+        "service, date, status, worker, lease, rowid FROM requests",
+        "DROP TABLE requests",
+        "ALTER TABLE requests_new RENAME TO requests",
+        "CREATE INDEX requests_service_status "
+        "ON requests(service, status, date)",
+        "CREATE INDEX requests_id_service ON requests(id, service)",
+        "CREATE INDEX requests_status_lease ON requests(status, lease)",
+    ]),
+    (10, "ingest checkpoints", [
+        # Messages stored by scripts/ingest_email, see gettor.parse.bulk
+        "CREATE TABLE IF NOT EXISTS ingested(checkpoint TEXT, key TEXT, "
+        "PRIMARY KEY(checkpoint, key))",
+    ]),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    """
+    Get the schema version of a database, 0 if it has never been migrated.
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY "
+        "KEY, description TEXT, applied INTEGER)"
+    )
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn, target=LATEST):
+    """
+    Apply the pending migrations to a database.
+
+    :param conn (sqlite3.Connection): connection to the database.
+    :param target (int): schema version to migrate to.
+
+    :return: list of the versions applied.
+    """
+    isolation_level = conn.isolation_level
+    # Run DDL statements inside our own transactions
+    conn.isolation_level = None
+    applied = []
+    try:
+        # Only takes effect on new files, see gettor.utils.retention
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        version = get_version(conn)
+        for number, description, statements in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have migrated the database meanwhile
+                if get_version(conn) >= number:
+                    conn.execute("ROLLBACK")
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(
+                    "INSERT INTO schema_version VALUES(?, ?, ?)",
+                    (number, description, int(time.time()))
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            log.info("MIGRATIONS:: Applied {} ({}).".format(
+                number, description
+            ))
+            applied.append(number)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+def ensure_schema(dbname):
+    """
+    Migrate a database to the latest schema, once per process. Errors are
+    logged, queries will fail later on as they would have before.
+    """
+    with _lock:
+        if dbname in _migrated:
+            return
+        try:
+            conn = sqlite3.connect(dbname)
+            try:
+                migrate(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            log.info("MIGRATIONS:: Could not migrate {}: {}".format(dbname, e))
+            return
+        _migrated.add(dbname)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import time
+import sqlite3
+import threading
+
+from twisted.internet import reactor, threads
+
+from .commons import log
+
+# Rate limiters of this process, by database name
+_limiters = {}
+
+
+def get_limiter(settings):
+    """
+    Get the rate limiter of a database, so that the email and twitter
+    parsers of this process share the same counters. Counters are loaded
+    from the database when the limiter is created and saved again when
+    the reactor shuts down.
+    """
+    dbname = settings.get("dbname")
+    limiter = _limiters.get(dbname)
+    if limiter is None:
+        limiter = RateLimiter(
+            dbname,
+            window=settings.get("rate_limit_window", 86400),
+            num_buckets=settings.get("rate_limit_buckets", 24),
+            persist_interval=settings.get("rate_limit_persist_interval", 60)
+        )
+        limiter.load()
+        reactor.addSystemEventTrigger("before", "shutdown", limiter.persist)
+        _limiters[dbname] = limiter
+    return limiter
+
+
+class RateLimiter(object):
+    """
+    Sliding window request counters, kept in memory per service and hashed
+    id. Each counter is a ring of time buckets, so counting the requests of
+    the last window costs the same no matter how many requests are stored.
+    Counters are periodically saved to the `rate_limits` table so limits
+    survive restarts.
+    """
+
+    def __init__(self, dbname=None, window=86400, num_buckets=24,
+                 persist_interval=60, clock=time.time):
+        """
+        Constructor.
+
+        :param dbname (str): database where counters are saved, or None to
+        keep them in memory only.
+        :param window (int): length of the sliding window, in seconds.
+        :param num_buckets (int): number of buckets the window is split in.
+        :param persist_interval (int): time between saves, in seconds.
+        :param clock (callable): function returning the current time.
+        """
+        self.dbname = dbname
+        self.num_buckets = num_buckets
+        self.bucket_size = max(1, window // num_buckets)
+        self.persist_interval = persist_interval
+        self.clock = clock
+        # (service, hid) -> [epochs, counts], `num_buckets` items each
+        self.counters = {}
+        # (service, hid, epoch) -> requests added since the last save
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def get_interval(self):
+        """
+        Get time interval for service periodicity.
+
+        :return: time interval (float) in seconds.
+        """
+        return self.persist_interval
+
+    def get_new(self):
+        """
+        Save the counters in a thread, called periodically by the
+        ratelimit service.
+        """
+        return threads.deferToThread(self.persist)
+
+    def epoch(self):
+        return int(self.clock()) // self.bucket_size
+
+    def count(self, service, hid):
+        """
+        Number of requests of an id in the last window.
+
+        :param service (str): `email` or `twitter`.
+        :param hid (str): hashed id of the sender.
+        """
+        oldest = self.epoch() - self.num_buckets
+        with self._lock:
+            counter = self.counters.get((service, hid))
+            if counter is None:
+                return 0
+            epochs, counts = counter
+            return sum(c for e, c in zip(epochs, counts) if e > oldest)
+
+    def add(self, service, hid, num=1):
+        """
+        Record requests of an id in the current bucket.
+        """
+        epoch = self.epoch()
+        slot = epoch % self.num_buckets
+        key = (service, hid)
+        with self._lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = [[0] * self.num_buckets, [0] * self.num_buckets]
+                self.counters[key] = counter
+            epochs, counts = counter
+            if epochs[slot] != epoch:
+                epochs[slot] = epoch
+                counts[slot] = 0
+            counts[slot] += num
+            pending = key + (epoch,)
+            self.pending[pending] = self.pending.get(pending, 0) + num
+
+    def allow(self, service, hid, limit):
+        """
+        Check the limit of an id and record the request if it's allowed.
+
+        :param limit (int): maximum number of requests per window.
+
+        :return: True if the request is allowed.
+        """
+        if self.count(service, hid) >= limit:
+            return False
+        self.add(service, hid)
+        return True
+
+    def load(self):
+        """
+        Load the counters of the current window from the database.
+        """
+        if not self.dbname:
+            return
+        oldest = self.epoch() - self.num_buckets
+        try:
+            conn = sqlite3.connect(self.dbname)
+            try:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS rate_limits(service TEXT, "
+                    "hid TEXT, bucket INTEGER, num_requests INTEGER, "
+                    "PRIMARY KEY(service, hid, bucket))"
+                )
+                rows = conn.execute(
+                    "SELECT service, hid, bucket, num_requests FROM "
+                    "rate_limits WHERE bucket > ?", (oldest,)
+                ).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # Start with empty counters rather than refusing requests
+            log.info("RATELIMIT:: Could not load counters: {}".format(e))
+            return
+
+        with self._lock:
+            for service, hid, bucket, num_requests in rows:
+                counter = self.counters.setdefault(
+                    (service, hid),
+                    [[0] * self.num_buckets, [0] * self.num_buckets]
+                )
+                slot = bucket % self.num_buckets
+                counter[0][slot] = bucket
+                counter[1][slot] = num_requests
+        log.info("RATELIMIT:: Loaded {} counters.".format(len(self.counters)))
+
+    def persist(self):
+        """
+        Add the requests counted since the last save to the database, and
+        forget the counters that have expired, both in memory and in the
+        database. Other processes, e.g. a bulk ingest, may count requests
+        of the same ids, so the counts are added up rather than replaced.
+        If the save fails the requests are kept for the next one.
+        """
+        oldest = self.epoch() - self.num_buckets
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            rows = [
+                key + (num,) for key, num in pending.items() if key[2] > oldest
+            ]
+            expired = [
+                key for key, (epochs, counts) in self.counters.items()
+                if max(epochs) <= oldest
+            ]
+            for key in expired:
+                del self.counters[key]
+
+        if not self.dbname:
+            return
+        try:
+            conn = sqlite3.connect(self.dbname)
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO rate_limits VALUES(?, ?, ?, ?) "
+                        "ON CONFLICT(service, hid, bucket) DO UPDATE SET "
+                        "num_requests=num_requests+excluded.num_requests",
+                        rows
+                    )
+                    conn.execute(
+                        "DELETE FROM rate_limits WHERE bucket <= ?", (oldest,)
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            log.info("RATELIMIT:: Could not save counters: {}".format(e))
+            with self._lock:
+                for key, num in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + num
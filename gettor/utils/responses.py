@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import os
+import weakref
+
+from twisted.internet import defer
+
+from .commons import log
+from . import strings
+
+# Response caches of this process, by database name
+_caches = {}
+
+
+def get_responses(settings):
+    """
+    Get the response cache of a database, shared by the services of this
+    process.
+    """
+    dbname = settings.get("dbname")
+    cache = _caches.get(dbname)
+    if cache is None:
+        cache = ResponseCache()
+        _caches[dbname] = cache
+    return cache
+
+
+def _ref(func):
+    if hasattr(func, "__self__"):
+        return weakref.WeakMethod(func)
+    return lambda: func
+
+
+class ResponseCache(object):
+    """
+    Rendered replies by channel, command, platform and language. A reply
+    only depends on those, the links table and the locale files, so each
+    variant is rendered once and kept until one of them changes.
+
+    Each channel registers a function rendering its replies and one listing
+    the variants worth rendering in advance.
+    """
+
+    def __init__(self):
+        self.renderers = {}
+        self.responses = {}
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, channel, render, variants):
+        """
+        Register the replies of a channel, dropping any cached ones.
+
+        :param render (callable): function(command, platform, language)
+        returning (a deferred firing with) the reply.
+        :param variants (callable): function(link_variants) returning the
+        (command, platform, language) keys to pre-render, given the
+        (platform, language) pairs with active links.
+        """
+        # Bound methods are held weakly, the cache outlives the services
+        self.renderers[channel] = (_ref(render), _ref(variants))
+        self.responses = dict(
+            (k, v) for k, v in self.responses.items() if k[0] != channel
+        )
+
+    @defer.inlineCallbacks
+    def get(self, channel, command, platform=None, language=None):
+        """
+        Get a reply, rendering it if it's not cached.
+
+        :return: deferred firing with the reply.
+        """
+        key = (channel, command, platform, language)
+        response = self.responses.get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        self.misses += 1
+        version = self.version
+        render = self.renderers[channel][0]()
+        response = yield defer.maybeDeferred(
+            render, command, platform, language
+        )
+        # Don't cache what was rendered from data changed meanwhile
+        if version == self.version:
+            self.responses[key] = response
+        return response
+
+    def get_locale_version(self):
+        """
+        Names, sizes and modification times of the locale files.
+        """
+        path = os.path.dirname(strings.get_resource_path(
+            "available_locales.json", "../share/locale"
+        ))
+        version = []
+        for name in sorted(os.listdir(path)):
+            st = os.stat(os.path.join(path, name))
+            version.append((name, st.st_size, st.st_mtime_ns))
+        return tuple(version)
+
+    @defer.inlineCallbacks
+    def refresh(self, conn):
+        """
+        Drop the cached replies if the links or the locale files changed
+        since they were rendered, and render all the variants again. The
+        first call warms the cache.
+
+        :param conn (SQLite3): database with the links.
+
+        :return: deferred firing with True if the cache was rebuilt.
+        """
+        rows = yield conn.get_links_version()
+        version = (rows[0][0] if rows else None, self.get_locale_version())
+        if version == self.version:
+            return False
+        self.version = version
+        self.responses = {}
+        yield self.warm(conn)
+        return True
+
+    @defer.inlineCallbacks
+    def warm(self, conn):
+        """
+        Render the variants of every channel.
+        """
+        link_variants = yield conn.get_link_variants()
+        for channel, (render, variants) in list(self.renderers.items()):
+            variants = variants()
+            if variants is None:
+                del self.renderers[channel]
+                continue
+            for key in variants(link_variants):
+                try:
+                    yield self.get(channel, *key)
+                except Exception as e:
+                    log.info("RESPONSES:: Could not render {} {}: {}".format(
+                        channel, key, e
+                    ))
+        log.info("RESPONSES:: Rendered {} replies.".format(len(self.responses)))
+
+    def stats(self):
+        return {
+            "size": len(self.responses),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+"""
+Online retention of the GetTor database. Old requests and stats are
+deleted in small transactions so writers are only held back for a few
+milliseconds at a time, and the freed pages are scrubbed and given back
+to the filesystem with incremental vacuum instead of replacing the file.
+"""
+
+from __future__ import absolute_import
+
+import time
+import sqlite3
+
+from datetime import datetime
+
+from twisted.internet import threads
+
+from .db import apply_pragmas, get_pragmas, get_shards
+from .commons import log
+from . import migrations
+
+# PRAGMA auto_vacuum value of incremental vacuum
+INCREMENTAL = 2
+
+
+class Retention(object):
+    """
+    Periodic purge of old rows of the main database and its shards.
+    """
+
+    def __init__(self, settings, clock=time.time):
+        """
+        Constructor.
+
+        :param settings (Settings): `retention_*` options, see
+        gettor.conf.json.example.
+        :param clock (callable): function returning the current time.
+        """
+        self.settings = settings
+        self.clock = clock
+        self.interval = settings.get("retention_interval", 3600)
+        # Ages in days, 0 keeps the rows forever
+        self.requests_age = settings.get("retention_requests_age", 30)
+        self.stats_age = settings.get("retention_stats_age", 0)
+        self.batch_size = settings.get("retention_batch_size", 500)
+        self.pause = settings.get("retention_pause", 0.05)
+        self.vacuum_pages = settings.get("retention_vacuum_pages", 256)
+        # Turning incremental vacuum on for an existing file rewrites it
+        self.convert = settings.get("retention_convert", False)
+        self.pragmas = dict(get_pragmas(settings), journal_mode=None)
+
+    def get_interval(self):
+        """
+        Get time interval for service periodicity.
+
+        :return: time interval (float) in seconds.
+        """
+        return self.interval
+
+    def get_new(self):
+        """
+        Purge the databases in a thread, called periodically by the
+        retention service.
+        """
+        return threads.deferToThread(self.run)
+
+    def get_files(self):
+        """
+        Get the distinct database files, the main one first.
+        """
+        files = [self.settings.get("dbname")]
+        for filename in sorted(get_shards(self.settings).values()):
+            if filename not in files:
+                files.append(filename)
+        return files
+
+    def run(self):
+        """
+        Purge all the databases.
+
+        :return: list of reports, one per database, see purge_file().
+        """
+        reports = []
+        for filename in self.get_files():
+            try:
+                reports.append(self.purge_file(filename))
+            except sqlite3.Error as e:
+                log.info("RETENTION:: Could not purge {}: {}".format(
+                    filename, e
+                ))
+        return reports
+
+    def purge_file(self, filename):
+        """
+        Delete the old rows of a database and reclaim their space.
+
+        :return: dict with the number of `requests` and `stats` deleted,
+        the `bytes` reclaimed, and the longest time a write lock was held,
+        `max_lock`, in seconds.
+        """
+        now = self.clock()
+        conn = sqlite3.connect(filename, isolation_level=None)
+        try:
+            apply_pragmas(conn, self.pragmas)
+            # Overwrite deleted rows with zeros
+            conn.execute("PRAGMA secure_delete=ON")
+            migrations.migrate(conn)
+
+            report = {"requests": 0, "stats": 0, "bytes": 0, "max_lock": 0}
+            if self.requests_age:
+                cutoff = int(now) - self.requests_age * 86400
+                # Claimed requests are left to their worker
+                report["requests"] = self.delete(
+                    conn, report, "requests",
+                    "date < ? AND status != 'IN_PROGRESS'", cutoff
+                )
+            if self.stats_age:
+                cutoff = datetime.fromtimestamp(
+                    now - self.stats_age * 86400
+                ).strftime("%Y%m%d")
+                report["stats"] = self.delete(
+                    conn, report, "stats", "date < ?", cutoff
+                )
+                self.delete(conn, report, "requesters", "date < ?", cutoff)
+            report["bytes"] = self.vacuum(conn, report)
+        finally:
+            conn.close()
+
+        log.info(
+            "RETENTION:: {}: deleted {} requests and {} stats, reclaimed {} "
+            "bytes, longest lock {:.3f}s.".format(
+                filename, report["requests"], report["stats"],
+                report["bytes"], report["max_lock"]
+            )
+        )
+        return report
+
+    def locked(self, conn, report, func, *args):
+        """
+        Run a function in a write transaction, timing how long it's held.
+        """
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(*args)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        report["max_lock"] = max(
+            report["max_lock"], time.perf_counter() - start
+        )
+        return result
+
+    def delete(self, conn, report, table, where, cutoff):
+        """
+        Delete the rows of a table matching `where`, `batch_size` rows per
+        transaction.
+
+        :return: number of rows deleted.
+        """
+        query = (
+            "DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} "
+            "WHERE {where} LIMIT ?)".format(table=table, where=where)
+        )
+        total = 0
+        while True:
+            num = self.locked(
+                conn, report,
+                lambda: conn.execute(query, (cutoff, self.batch_size)).rowcount
+            )
+            total += num
+            if num < self.batch_size:
+                return total
+            # Let queued writers in between batches
+            time.sleep(self.pause)
+
+    def vacuum(self, conn, report):
+        """
+        Give the free pages back to the filesystem, `vacuum_pages` pages per
+        transaction.
+
+        :return: number of bytes reclaimed.
+        """
+        def pages():
+            return conn.execute("PRAGMA page_count").fetchone()[0]
+
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        before = pages()
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum != INCREMENTAL:
+            if not self.convert:
+                return 0
+            # One-off full rewrite, the file stays incremental afterwards
+            log.info("RETENTION:: Enabling incremental vacuum.")
+            start = time.perf_counter()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            report["max_lock"] = max(
+                report["max_lock"], time.perf_counter() - start
+            )
+
+        while conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            self.locked(
+                conn, report, lambda: conn.execute(
+                    "PRAGMA incremental_vacuum({})".format(self.vacuum_pages)
+                ).fetchall()
+            )
+        return (before - pages()) * page_size
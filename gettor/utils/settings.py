@@ -15,6 +15,8 @@ import os
 
 from . import strings
 
+_MISSING = object()
+
 
 class Settings(object):
     """
@@ -74,8 +76,15 @@ class Settings(object):
               "test_hid": "",
               "twitter_handle": "get_tor",
               "twitter_messages_endpoint": "https://api.twitter.com/1.1/direct_messages/events/list.json",
-              "twitter_new_message_endpoint": "https://api.twitter.com/1.1/direct_messages/events/new.json"
+              "twitter_new_message_endpoint": "https://api.twitter.com/1.1/direct_messages/events/new.json",
+              "intake_socket": "/srv/gettor.torproject.org/home/gettor/intake.sock"
             }
 
-    def get(self, key):
+    def get(self, key, default=_MISSING):
+        """
+        Get a setting. If a default is given it is returned for settings
+        missing from the config file, otherwise a KeyError is raised.
+        """
+        if default is not _MISSING:
+            return self._settings.get(key, default)
         return self._settings[key]
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of GetTor, a Tor Browser distribution system.
+#
+# :authors: isra <ilv@torproject.org>
+#           see also AUTHORS file
+#
+# :copyright:   (c) 2008-2014, The Tor Project, Inc.
+#               (c) 2014-2018, Israel Leiva
+#
+# :license: This is Free Software. See LICENSE for license information.
+
+from __future__ import absolute_import
+
+import math
+import time
+import struct
+import sqlite3
+import hashlib
+import threading
+
+from datetime import datetime
+
+from twisted.internet import reactor, threads
+
+from .db import apply_pragmas, get_pragmas, get_shards, open_stats
+from .db import ROLLUP_PERIODS, ROLLUP_UPSERT, period_start, rollup_args
+from .cache import TTLCache
+from .commons import log
+from . import migrations
+
+# Stats collectors of this process, by database name
+_collectors = {}
+
+
+def get_stats(settings):
+    """
+    Get the stats collector of a database, shared by the services of this
+    process. Pending counters are flushed when the reactor shuts down.
+    """
+    dbname = settings.get("dbname")
+    collector = _collectors.get(dbname)
+    if collector is None:
+        collector = StatsCollector(
+            settings,
+            flush_interval=settings.get("stats_flush_interval", 60),
+            precision=settings.get("stats_hll_precision", 12)
+        )
+        reactor.addSystemEventTrigger("before", "shutdown", collector.flush)
+        _collectors[dbname] = collector
+    return collector
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch, estimating the number of distinct values added to
+    it in 2^precision bytes, with a standard error of about
+    1.04 / sqrt(2^precision). Values can't be recovered from it.
+    """
+
+    def __init__(self, precision=12, registers=None):
+        """
+        Constructor.
+
+        :param precision (int): number of index bits, 4 to 16.
+        :param registers (bytes): registers of a stored sketch.
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError("Invalid precision {}".format(precision))
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.size)
+        elif len(registers) != self.size:
+            raise ValueError("Sketch size doesn't match its precision")
+        else:
+            self.registers = bytearray(registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load a sketch stored with to_bytes().
+        """
+        return cls(data[0], data[1:])
+
+    def to_bytes(self):
+        return bytes(bytearray([self.precision]) + self.registers)
+
+    def add(self, value):
+        """
+        Add a value to the sketch.
+
+        :param value (str): value to count, e.g. a hashed id.
+        """
+        digest = hashlib.sha256(value.encode("utf-8")).digest()
+        x = struct.unpack(">Q", digest[:8])[0]
+        index = x >> (64 - self.precision)
+        rest = x & ((1 << (64 - self.precision)) - 1)
+        # Position of the first set bit of the remaining bits
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Add the values of another sketch of the same precision.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches of different precision")
+        self.registers = bytearray(
+            max(a, b) for a, b in zip(self.registers, other.registers)
+        )
+
+    def count(self):
+        """
+        Estimate the number of distinct values added.
+        """
+        m = self.size
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small sets
+            estimate = m * math.log(m / float(zeros))
+        return int(round(estimate))
+
+
+class StatsCollector(object):
+    """
+    Request stats accumulated in memory and written to the database in one
+    transaction per file every `flush_interval` seconds, so sending a reply
+    doesn't wait for a write. Distinct requesters are estimated with a
+    HyperLogLog sketch per service and day, stored in the `requesters`
+    table, instead of keeping their ids.
+    """
+
+    def __init__(self, settings, flush_interval=60, precision=12,
+                 clock=time.time):
+        """
+        Constructor.
+
+        :param settings (Settings): settings with the database and shards.
+        :param flush_interval (int): time between flushes, in seconds.
+        :param precision (int): precision of the sketches.
+        :param clock (callable): function returning the current time.
+        """
+        self.dbname = settings.get("dbname")
+        self.shards = get_shards(settings)
+        self.pragmas = dict(get_pragmas(settings), journal_mode=None)
+        self.flush_interval = flush_interval
+        self.precision = precision
+        self.clock = clock
+        # (platform, language, command, service, date) -> number
+        self.counters = {}
+        # (service, date) -> HyperLogLog
+        self.sketches = {}
+        self._lock = threading.Lock()
+
+    def get_interval(self):
+        """
+        Get time interval for service periodicity.
+
+        :return: time interval (float) in seconds.
+        """
+        return self.flush_interval
+
+    def get_new(self):
+        """
+        Flush the stats in a thread, called periodically by the stats
+        service.
+        """
+        return threads.deferToThread(self.flush)
+
+    def today(self):
+        return datetime.fromtimestamp(self.clock()).strftime("%Y%m%d")
+
+    def count(self, command, service, platform=None, language='en',
+              hid=None):
+        """
+        Count a reply, as SQLite3.update_stats does.
+
+        :param hid (str): hashed id of the requester, to estimate the
+        number of distinct requesters.
+        """
+        date = self.today()
+        key = (platform, language, command, service, date)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            if hid is not None:
+                sketch = self.sketches.get((service, date))
+                if sketch is None:
+                    sketch = HyperLogLog(self.precision)
+                    self.sketches[(service, date)] = sketch
+                sketch.add(hid)
+
+    def flush(self):
+        """
+        Write the pending counters and sketches, one transaction per
+        database file. Whatever can't be written is kept for the next time.
+        """
+        with self._lock:
+            counters, self.counters = self.counters, {}
+            sketches, self.sketches = self.sketches, {}
+        if not counters and not sketches:
+            return
+
+        files = {}
+        for key, num in counters.items():
+            filename = self.shards.get(key[3], self.dbname)
+            files.setdefault(filename, ({}, {}))[0][key] = num
+        for key, sketch in sketches.items():
+            filename = self.shards.get(key[0], self.dbname)
+            files.setdefault(filename, ({}, {}))[1][key] = sketch
+
+        for filename, (file_counters, file_sketches) in files.items():
+            try:
+                self.write(filename, file_counters, file_sketches)
+            except sqlite3.Error as e:
+                log.info("STATS:: Could not flush stats: {}".format(e))
+                self.restore(file_counters, file_sketches)
+
+    def restore(self, counters, sketches):
+        with self._lock:
+            for key, num in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + num
+            for key, sketch in sketches.items():
+                if key in self.sketches:
+                    sketch.merge(self.sketches[key])
+                self.sketches[key] = sketch
+
+    def write(self, filename, counters, sketches):
+        """
+        Add counters and sketches to the ones stored in a database.
+        """
+        migrations.ensure_schema(filename)
+        now = int(self.clock())
+        conn = sqlite3.connect(filename)
+        try:
+            apply_pragmas(conn, self.pragmas)
+            with conn:
+                conn.executemany(
+                    "INSERT INTO stats(num_requests, platform, language, "
+                    "command, service, date, updated) VALUES(?, ?, ?, ?, ?, "
+                    "?, ?) ON CONFLICT(platform, language, command, service, "
+                    "date) DO UPDATE SET num_requests=num_requests+"
+                    "excluded.num_requests, updated=excluded.updated",
+                    [(num,) + key + (now,) for key, num in counters.items()]
+                )
+                conn.executemany(ROLLUP_UPSERT, [
+                    args for key, num in counters.items()
+                    for args in rollup_args(num, *key)
+                ])
+                for (service, date), sketch in sketches.items():
+                    row = conn.execute(
+                        "SELECT sketch FROM requesters WHERE service=? AND "
+                        "date=?", (service, date)
+                    ).fetchone()
+                    if row:
+                        stored = HyperLogLog.from_bytes(row[0])
+                        stored.merge(sketch)
+                        sketch = stored
+                    conn.execute(
+                        "INSERT OR REPLACE INTO requesters VALUES(?, ?, ?, ?)",
+                        (service, date, sketch.to_bytes(), now)
+                    )
+        finally:
+            conn.close()
+
+    def get_requesters(self, service, date):
+        """
+        Estimate the distinct requesters of a service on a day, stored and
+        pending.
+
+        :param date (str): day, as YYYYmmdd.
+        """
+        filename = self.shards.get(service, self.dbname)
+        sketch = HyperLogLog(self.precision)
+        conn = sqlite3.connect(filename)
+        try:
+            row = conn.execute(
+                "SELECT sketch FROM requesters WHERE service=? AND date=?",
+                (service, date)
+            ).fetchone()
+        finally:
+            conn.close()
+        if row:
+            sketch.merge(HyperLogLog.from_bytes(row[0]))
+        with self._lock:
+            pending = self.sketches.get((service, date))
+            if pending is not None:
+                sketch.merge(pending)
+        return sketch.count()
+
+
+class StatsQuery(object):
+    """
+    Read only queries over the stats rollups of all the shards, with the
+    answers cached for `cache_ttl` seconds.
+    """
+
+    COLUMNS = ("platform", "language", "command", "service")
+
+    def __init__(self, settings, cache_size=256, cache_ttl=300,
+                 clock=time.monotonic):
+        """
+        Constructor.
+
+        :param settings (Settings): settings with the database and shards.
+        :param cache_size (int): maximum number of answers cached.
+        :param cache_ttl (int): time answers are cached, in seconds.
+        """
+        self.settings = settings
+        self.cache = TTLCache(cache_size, cache_ttl, clock=clock)
+
+    def query(self, period="day", since=None, until=None,
+              group_by=("platform",), **filters):
+        """
+        Number of requests per period and group.
+
+        :param period (str): `day`, `week` or `month`.
+        :param since (str): first day, as YYYYmmdd, of the periods wanted.
+        :param until (str): last day, as YYYYmmdd, of the periods wanted.
+        :param group_by (list): columns the requests are grouped by.
+        :param filters: values the columns must have, e.g. service="email".
+
+        :return: list of dicts with the `start` of the period, the group
+        columns and `num_requests`.
+
+        :raise: ValueError if the query is not valid.
+        """
+        if period not in ROLLUP_PERIODS:
+            raise ValueError("Invalid period {}".format(period))
+        for column in list(group_by) + list(filters):
+            if column not in self.COLUMNS:
+                raise ValueError("Invalid column {}".format(column))
+        for day in (since, until):
+            if day is not None:
+                datetime.strptime(day, "%Y%m%d")
+
+        key = (period, since, until, tuple(group_by),
+               tuple(sorted(filters.items())))
+        rows = self.cache.get(key)
+        if rows is not None:
+            return rows
+
+        where = ["period=?"]
+        args = [period]
+        if since is not None:
+            where.append("start>=?")
+            args.append(period_start(period, since))
+        if until is not None:
+            where.append("start<=?")
+            args.append(until)
+        for column, value in sorted(filters.items()):
+            where.append("{}=?".format(column))
+            args.append(value)
+        columns = ["start"] + list(group_by)
+
+        conn = open_stats(self.settings, readonly=True)
+        try:
+            cursor = conn.execute(
+                "SELECT {columns}, SUM(num_requests) FROM all_rollups WHERE "
+                "{where} GROUP BY {columns} ORDER BY {columns}".format(
+                    columns=", ".join(columns), where=" AND ".join(where)
+                ), args
+            )
+            rows = [
+                dict(zip(columns + ["num_requests"], row)) for row in cursor
+            ]
+        finally:
+            conn.close()
+        self.cache.set(key, rows)
+        return rows
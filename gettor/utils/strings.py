@@ -107,13 +107,16 @@ def load_strings(current_locale):
     if current_locale not in available_locales:
         current_locale = "en"
 
-    filename = get_resource_path("{}.json".format(current_locale), '../share/locale')
-    with open(filename, encoding='utf-8') as f:
-        translations[current_locale] = json.load(f)
+    # Strings missing from a translation are taken from English
+    for locale in set(["en", current_locale]):
+        filename = get_resource_path("{}.json".format(locale), '../share/locale')
+        with open(filename, encoding='utf-8') as f:
+            translations[locale] = json.load(f)
 
     strings = {}
-    for s in translations[current_locale]:
-        strings[s] = translations[current_locale][s]
+    for locale in ["en", current_locale]:
+        for s in translations[locale]:
+            strings[s] = translations[locale][s]
 
 
 def redact_emails(text):
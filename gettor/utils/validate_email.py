@@ -4,7 +4,7 @@
 # for support of mx and user check
 # This code is made available to you under the GNU LGPL v3.
 #
-# This module provides a single method, valid_email_address(),
+# This module provides a single method, validate_email(),
 # which returns True or False to indicate whether a given address
 # is valid according to the 'addr-spec' part of the specification
 # given in RFC 2822.  Ideally, we would like to find this
@@ -22,6 +22,14 @@ import smtplib
 import logging
 import socket
 
+from twisted.internet import defer, endpoints, reactor
+from twisted.protocols import basic
+
+from twisted.names.dns import MX as MX_TYPE
+from twisted.names.error import DNSNameError, DNSServerError
+
+from .cache import TTLCache
+
 try:
     raw_input
 except NameError:
@@ -38,62 +46,160 @@ except (ImportError, AttributeError):
     class ServerError(Exception):
         pass
 
-# All we are really doing is comparing the input string to one
-# gigantic regular expression.  But building that regexp, and
-# ensuring its correctness, is made much easier by assembling it
-# from the "tokens" defined by the RFC.  Each of these tokens is
-# tested in the accompanying unit test file.
-#
-# The section of RFC 2822 from which each pattern component is
-# derived is given in an accompanying comment.
+# The address is checked with a hand-written scanner following the
+# 'addr-spec' grammar of the RFC, instead of one gigantic regular
+# expression. The nested quantifiers of such an expression (CFWS inside
+# DOT_ATOM inside LOCAL_PART) can backtrack catastrophically on crafted
+# input, while the scanner looks at each character once.
 #
-# (To make things simple, every string below is given as 'raw',
-# even when it's not strictly necessary.  This way we don't forget
-# when it is necessary.)
+# The section of RFC 2822 from which each character class is derived is
+# given in an accompanying comment. FWS is any run of whitespace, as the
+# original expression allowed.
 #
-WSP = r'[\s]'                                        # see 2.2.2. Structured Header Field Bodies
-CRLF = r'(?:\r\n)'                                   # see 2.2.3. Long Header Fields
-NO_WS_CTL = r'\x01-\x08\x0b\x0c\x0f-\x1f\x7f'        # see 3.2.1. Primitive Tokens
-QUOTED_PAIR = r'(?:\\.)'                             # see 3.2.2. Quoted characters
-FWS = r'(?:(?:' + WSP + r'*' + CRLF + r')?' + \
-      WSP + r'+)'                                    # see 3.2.3. Folding white space and comments
-CTEXT = r'[' + NO_WS_CTL + \
-        r'\x21-\x27\x2a-\x5b\x5d-\x7e]'              # see 3.2.3
-CCONTENT = r'(?:' + CTEXT + r'|' + \
-           QUOTED_PAIR + r')'                        # see 3.2.3 (NB: The RFC includes COMMENT here
-# as well, but that would be circular.)
-COMMENT = r'\((?:' + FWS + r'?' + CCONTENT + \
-          r')*' + FWS + r'?\)'                       # see 3.2.3
-CFWS = r'(?:' + FWS + r'?' + COMMENT + ')*(?:' + \
-       FWS + '?' + COMMENT + '|' + FWS + ')'         # see 3.2.3
-ATEXT = r'[\w!#$%&\'\*\+\-/=\?\^`\{\|\}~]'           # see 3.2.4. Atom
-ATOM = CFWS + r'?' + ATEXT + r'+' + CFWS + r'?'      # see 3.2.4
-DOT_ATOM_TEXT = ATEXT + r'+(?:\.' + ATEXT + r'+)*'   # see 3.2.4
-DOT_ATOM = CFWS + r'?' + DOT_ATOM_TEXT + CFWS + r'?' # see 3.2.4
-QTEXT = r'[' + NO_WS_CTL + \
-        r'\x21\x23-\x5b\x5d-\x7e]'                   # see 3.2.5. Quoted strings
-QCONTENT = r'(?:' + QTEXT + r'|' + \
-           QUOTED_PAIR + r')'                        # see 3.2.5
-QUOTED_STRING = CFWS + r'?' + r'"(?:' + FWS + \
-                r'?' + QCONTENT + r')*' + FWS + \
-                r'?' + r'"' + CFWS + r'?'
-LOCAL_PART = r'(?:' + DOT_ATOM + r'|' + \
-             QUOTED_STRING + r')'                    # see 3.4.1. Addr-spec specification
-DTEXT = r'[' + NO_WS_CTL + r'\x21-\x5a\x5e-\x7e]'    # see 3.4.1
-DCONTENT = r'(?:' + DTEXT + r'|' + \
-           QUOTED_PAIR + r')'                        # see 3.4.1
-DOMAIN_LITERAL = CFWS + r'?' + r'\[' + \
-                 r'(?:' + FWS + r'?' + DCONTENT + \
-                 r')*' + FWS + r'?\]' + CFWS + r'?'  # see 3.4.1
-DOMAIN = r'(?:' + DOT_ATOM + r'|' + \
-         DOMAIN_LITERAL + r')'                       # see 3.4.1
-ADDR_SPEC = LOCAL_PART + r'@' + DOMAIN               # see 3.4.1
-
-# A valid address will match exactly the 3.4.1 addr-spec.
-VALID_ADDRESS_REGEXP = '^' + ADDR_SPEC + '$'
-
-MX_DNS_CACHE = {}
-MX_CHECK_CACHE = {}
+NO_WS_CTL = set(chr(c) for c in list(range(0x01, 0x09)) +
+                [0x0b, 0x0c] + list(range(0x0f, 0x20)) + [0x7f])    # see 3.2.1. Primitive Tokens
+CTEXT = NO_WS_CTL | set(chr(c) for c in list(range(0x21, 0x28)) +
+                        list(range(0x2a, 0x5c)) +
+                        list(range(0x5d, 0x7f)))                     # see 3.2.3. Folding white space and comments
+ATEXT_SPECIALS = set("!#$%&'*+-/=?^`{|}~")                           # see 3.2.4. Atom
+QTEXT = NO_WS_CTL | set(chr(c) for c in [0x21] +
+                        list(range(0x23, 0x5c)) +
+                        list(range(0x5d, 0x7f)))                     # see 3.2.5. Quoted strings
+DTEXT = NO_WS_CTL | set(chr(c) for c in list(range(0x21, 0x5b)) +
+                        list(range(0x5e, 0x7f)))                     # see 3.4.1. Addr-spec specification
+
+
+def _is_atext(c):
+    return c.isalnum() or c == '_' or c in ATEXT_SPECIALS
+
+
+def _skip_cfws(s, i):
+    """
+    Skip comments and folding white space starting at position i.
+
+    :return: the position after them, or -1 if a comment is malformed.
+    """
+    n = len(s)
+    while i < n:
+        c = s[i]
+        if c.isspace():
+            i += 1
+        elif c == '(':
+            i = _scan_delimited(s, i + 1, ')', CTEXT)
+            if i < 0:
+                return -1
+        else:
+            break
+    return i
+
+
+def _scan_delimited(s, i, end, allowed):
+    """
+    Scan the content of a comment, quoted string or domain literal up to
+    its closing character: allowed characters, quoted pairs and folding
+    white space.
+
+    :return: the position after the closing character, or -1.
+    """
+    n = len(s)
+    while i < n:
+        c = s[i]
+        if c == end:
+            return i + 1
+        elif c == '\\':
+            # quoted-pair, see 3.2.2. Quoted characters
+            if i + 1 >= n or s[i + 1] == '\n':
+                return -1
+            i += 2
+        elif c in allowed or c.isspace():
+            i += 1
+        else:
+            return -1
+    return -1
+
+
+def _scan_dot_atom_text(s, i):
+    """
+    Scan atext+ ('.' atext+)*, see 3.2.4.
+
+    :return: the position after it, or -1.
+    """
+    n = len(s)
+    while True:
+        start = i
+        while i < n and _is_atext(s[i]):
+            i += 1
+        if i == start:
+            return -1
+        if i < n and s[i] == '.':
+            i += 1
+        else:
+            return i
+
+
+def is_addr_spec(email):
+    """
+    Check if a string matches the 3.4.1 addr-spec, with optional comments
+    and folding white space around its parts. This takes linear time in the
+    length of the string.
+    """
+    # local-part = dot-atom / quoted-string
+    i = _skip_cfws(email, 0)
+    if i < 0 or i >= len(email):
+        return False
+    if email[i] == '"':
+        i = _scan_delimited(email, i + 1, '"', QTEXT)
+    else:
+        i = _scan_dot_atom_text(email, i)
+    if i < 0:
+        return False
+
+    i = _skip_cfws(email, i)
+    if i < 0 or i >= len(email) or email[i] != '@':
+        return False
+
+    # domain = dot-atom / domain-literal
+    i = _skip_cfws(email, i + 1)
+    if i < 0 or i >= len(email):
+        return False
+    if email[i] == '[':
+        i = _scan_delimited(email, i + 1, ']', DTEXT)
+    else:
+        i = _scan_dot_atom_text(email, i)
+    if i < 0:
+        return False
+
+    return _skip_cfws(email, i) == len(email)
+
+
+# MX records per domain and SMTP check results per MX host. Both caches
+# are bounded and expire, see configure_caches().
+MX_DNS_CACHE = TTLCache(maxsize=4096, ttl=3600)
+MX_CHECK_CACHE = TTLCache(maxsize=4096, ttl=3600)
+
+# Marks a missing entry, as None is cached for non-existent domains
+_MISSING = object()
+
+
+def configure_caches(maxsize, ttl):
+    """
+    Resize the MX caches. Cached entries are dropped only if the size or
+    time to live change.
+
+    :param maxsize (int): maximum number of entries of each cache.
+    :param ttl (int): time to keep each entry, in seconds.
+    """
+    global MX_DNS_CACHE, MX_CHECK_CACHE
+    if (MX_DNS_CACHE.maxsize, MX_DNS_CACHE.ttl) != (maxsize, ttl):
+        MX_DNS_CACHE = TTLCache(maxsize=maxsize, ttl=ttl)
+        MX_CHECK_CACHE = TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+def cache_stats():
+    """
+    Hit and miss counters of the MX caches.
+    """
+    return {"dns": MX_DNS_CACHE.stats(), "check": MX_CHECK_CACHE.stats()}
 
 
 # List of known autoresponder email patterns
@@ -103,17 +209,24 @@ autoresponders = [
         r'gettor.*@torproject.org'
 ]
 
+# All the autoresponder patterns, matched at once
+AUTORESPONDER_RE = re.compile(
+    "|".join("(?:{})".format(pattern) for pattern in autoresponders)
+)
+
 def get_mx_ip(hostname):
-    if hostname not in MX_DNS_CACHE:
+    mx_hosts = MX_DNS_CACHE.get(hostname, _MISSING)
+    if mx_hosts is _MISSING:
         try:
-            MX_DNS_CACHE[hostname] = DNS.mxlookup(hostname)
+            mx_hosts = DNS.mxlookup(hostname)
         except ServerError as e:
             if e.rcode == 3 or e.rcode == 2:  # NXDOMAIN (Non-Existent Domain) or SERVFAIL
-                MX_DNS_CACHE[hostname] = None
+                mx_hosts = None
             else:
                 raise
+        MX_DNS_CACHE.set(hostname, mx_hosts)
 
-    return MX_DNS_CACHE[hostname]
+    return mx_hosts
 
 
 def validate_email(email, check_mx=False, verify=False, debug=False, smtp_timeout=10):
@@ -131,7 +244,7 @@ def validate_email(email, check_mx=False, verify=False, debug=False, smtp_timeou
         logger = None
 
     try:
-        assert re.match(VALID_ADDRESS_REGEXP, email) is not None
+        assert is_addr_spec(email)
         check_mx |= verify
         if check_mx:
             if not DNS:
@@ -144,10 +257,10 @@ def validate_email(email, check_mx=False, verify=False, debug=False, smtp_timeou
             for mx in mx_hosts:
                 try:
                     if not verify and mx[1] in MX_CHECK_CACHE:
-                        return MX_CHECK_CACHE[mx[1]]
+                        return MX_CHECK_CACHE.get(mx[1])
                     smtp = smtplib.SMTP(timeout=smtp_timeout)
                     smtp.connect(mx[1])
-                    MX_CHECK_CACHE[mx[1]] = True
+                    MX_CHECK_CACHE.set(mx[1], True)
                     if not verify:
                         try:
                             smtp.quit()
@@ -183,6 +296,170 @@ def validate_email(email, check_mx=False, verify=False, debug=False, smtp_timeou
         return None
     return True
 
+# Name given in HELO, resolved once per process, see get_helo_name
+_helo_name = None
+
+
+def get_helo_name():
+    """
+    Fully qualified name of this host, as smtplib gives in HELO. The first
+    call may block on DNS, make it at startup rather than from the reactor.
+    """
+    global _helo_name
+    if _helo_name is None:
+        _helo_name = socket.getfqdn()
+    return _helo_name
+
+
+class SMTPProbe(basic.LineReceiver):
+    """
+    Non-blocking version of the SMTP dialog of validate_email: wait for
+    the greeting and, to verify the address, try HELO, MAIL and RCPT.
+    """
+
+    def __init__(self, email, verify, helo_name=""):
+        """
+        Constructor.
+
+        :param helo_name (str): name of this host given in HELO.
+        """
+        self.email = email
+        self.verify = verify
+        self.result = defer.Deferred()
+        self.commands = []
+        if verify:
+            self.commands = [
+                b"HELO " + helo_name.encode("ascii", "ignore"),
+                b"MAIL FROM:<>",
+                b"RCPT TO:<" + email.encode("utf-8") + b">"
+            ]
+
+    def lineReceived(self, line):
+        # Wait for the last line of multiline replies
+        if len(line) > 3 and line[3:4] == b"-":
+            return
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = 0
+
+        if not self.commands:
+            # greeting or RCPT reply
+            expected = 220 if not self.verify else 250
+            self.finish(code == expected or None)
+        elif 200 <= code < 300:
+            self.sendLine(self.commands.pop(0))
+        else:
+            self.finish(None)
+
+    def finish(self, result):
+        if not self.result.called:
+            self.sendLine(b"QUIT")
+            self.transport.loseConnection()
+            self.result.callback(result)
+
+    def connectionLost(self, reason):
+        if not self.result.called:
+            self.result.callback(None)
+
+
+def parse_mx_records(result):
+    """
+    Get a list of (preference, host) from a twisted.names MX lookup.
+    """
+    answers, authority, additional = result
+    return sorted(
+        (rr.payload.preference, str(rr.payload.name))
+        for rr in answers if rr.type == MX_TYPE
+    )
+
+
+@defer.inlineCallbacks
+def get_mx_ip_async(hostname, resolver=None):
+    """
+    Non-blocking version of get_mx_ip, using twisted.names.
+
+    :return: deferred firing with a list of (preference, host), or None if
+    the domain doesn't exist.
+    """
+    mx_hosts = MX_DNS_CACHE.get(hostname, _MISSING)
+    if mx_hosts is _MISSING:
+        if resolver is None:
+            from twisted.names import client
+            resolver = client.getResolver()
+        try:
+            result = yield resolver.lookupMailExchange(hostname)
+            mx_hosts = parse_mx_records(result)
+        except (DNSNameError, DNSServerError):
+            # NXDOMAIN (Non-Existent Domain) or SERVFAIL
+            mx_hosts = None
+        MX_DNS_CACHE.set(hostname, mx_hosts)
+
+    return mx_hosts
+
+
+@defer.inlineCallbacks
+def smtp_probe(host, email, verify, port=25, timeout=10, helo_name=""):
+    """
+    Connect to an MX host and run SMTPProbe.
+
+    :return: deferred firing with True, or None if the host couldn't tell.
+    """
+    endpoint = endpoints.HostnameEndpoint(reactor, host, port, timeout=timeout)
+    probe = SMTPProbe(email, verify, helo_name)
+    yield endpoints.connectProtocol(endpoint, probe)
+    probe.result.addTimeout(timeout, reactor)
+    try:
+        result = yield probe.result
+    except defer.TimeoutError:
+        probe.transport.abortConnection()
+        result = None
+    return result
+
+
+@defer.inlineCallbacks
+def validate_email_async(email, check_mx=False, verify=False, resolver=None,
+                         smtp_timeout=10, smtp_port=25, helo_name=None):
+    """
+    Non-blocking version of validate_email for use in the reactor thread.
+    MX records are looked up with twisted.names and the SMTP checks don't
+    block, both share the bounded caches of validate_email.
+
+    :param resolver: twisted.names resolver, the system one by default.
+    :param helo_name (str): name given in HELO when verifying, the one of
+    get_helo_name() by default.
+
+    :return: deferred firing with True, False or None as validate_email.
+    """
+    if not is_addr_spec(email):
+        return False
+    check_mx |= verify
+    if not check_mx:
+        return True
+
+    hostname = email[email.find('@') + 1:]
+    mx_hosts = yield get_mx_ip_async(hostname, resolver)
+    if mx_hosts is None:
+        return False
+    if verify and helo_name is None:
+        helo_name = get_helo_name()
+
+    for mx in mx_hosts:
+        if not verify and mx[1] in MX_CHECK_CACHE:
+            return MX_CHECK_CACHE.get(mx[1])
+        try:
+            result = yield smtp_probe(
+                mx[1], email, verify, smtp_port, smtp_timeout, helo_name
+            )
+        except Exception:
+            # Unable to connect
+            continue
+        MX_CHECK_CACHE.set(mx[1], True)
+        if result:
+            return True
+    return None
+
+
 def autoresponder(from_addr):
     """
     We sometimes receive messages from autoresponders like Mail Deliver System
@@ -191,11 +468,7 @@ def autoresponder(from_addr):
 
     Returns true if the email address matches a known autoresponder pattern.
     """
-    for pattern in autoresponders:
-        if re.match(pattern, from_addr.lower()) is not None:
-            return True
-
-    return False
+    return AUTORESPONDER_RE.match(from_addr.lower()) is not None
 
 if __name__ == "__main__":
     import time
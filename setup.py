@@ -27,7 +27,9 @@ setuptools.setup(
         scripts=['scripts/add_links_to_db',
                  'scripts/create_db',
                  'scripts/export_stats',
+                 'scripts/ingest_email',
                  'scripts/process_email',
+                 'scripts/query_stats',
                  'scripts/update_files',
                  'scripts/update_git'],
         install_requires=['twisted',
@@ -6,10 +6,85 @@ from gettor.utils import options
 from gettor.utils import strings
 from gettor.utils import twitter
 from gettor.utils.db import SQLite3
+from gettor.utils import db
+from gettor.utils import dkim_verifier
+from gettor.utils import validate_email
+from gettor.utils import ratelimit
+from gettor.utils import blacklist
+from gettor.utils import migrations
+from gettor.utils import retention
+from gettor.utils import export
+from gettor.utils import stats
+from gettor.utils import responses
 from gettor.services.email.sendmail import Sendmail
+from gettor.services.email.smtp_pool import SMTPPool
+from gettor.services.email.mime import MessageTemplate
+from gettor.services.email import intake
+from gettor.services import stats as stats_api
 from gettor.services.twitter import twitterdm
 from gettor.parse.email import EmailParser, AddressError, DKIMError
 from gettor.parse.twitter import TwitterParser
+from gettor.parse.bulk import BulkIngest
+from gettor.parse import bulk
+from gettor.parse import mime
+from gettor.parse import keywords
+
+from twisted.internet import base
+
+import os
+import sqlite3
+import tempfile
 
 from email import message_from_string
+from email.header import decode_header, make_header
 from email.utils import parseaddr
+
+LINKS = [
+    ("https://{0}/tor-{1}-{2}.bin".format(provider, platform, locale),
+     platform, locale, "64", "12.0", provider, "ACTIVE",
+     "tor-{0}-{1}.bin".format(platform, locale))
+    for platform in ("osx", "windows", "linux")
+    for locale in ("en-US", "es-ES", "pt-BR", "fa", "es-AR", "fr")
+    for provider in ("github", "gitlab")
+]
+
+
+def temp_db(settings):
+    """
+    Create a database with the current schema and some links in a temporary
+    directory, and point the dbname of settings to it.
+
+    :param settings (Settings): test settings.
+
+    :return: path of the database.
+    """
+    dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+    migrations.ensure_schema(dbname)
+    conn = sqlite3.connect(dbname)
+    conn.executemany(
+        "INSERT INTO links(link, platform, language, arch, version, provider,"
+        " status, file) VALUES(?, ?, ?, ?, ?, ?, ?, ?)", LINKS
+    )
+    conn.commit()
+    conn.close()
+    settings._settings["dbname"] = dbname
+    return dbname
+
+
+class ShutdownReactor(object):
+    """
+    Stand-in for the system event triggers of the reactor, so tests can
+    fire the shutdown event without stopping the real reactor.
+    """
+
+    def __init__(self):
+        self.event = base._ThreePhaseEvent()
+
+    def addSystemEventTrigger(self, phase, event, f, *args, **kwargs):
+        return self.event.addTrigger(phase, f, *args, **kwargs)
+
+    def removeSystemEventTrigger(self, trigger):
+        self.event.removeTrigger(trigger)
+
+    def fire(self):
+        self.event.fireEvent()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+import pytest
+import pytest_twisted
+from twisted.trial import unittest
+
+from . import conftests
+
+def hashed(user):
+    return hashlib.sha256(user.encode('utf-8')).hexdigest()
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+class BlacklistTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        self.dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+        self.settings._settings["dbname"] = self.dbname
+        self.clock = Clock()
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def blacklist(self, **kwargs):
+        bl = conftests.blacklist.Blacklist(
+            self.dbname, clock=self.clock, **kwargs
+        )
+        bl.load()
+        return bl
+
+    @pytest_twisted.inlineCallbacks
+    def test_permanent_block(self):
+        bl = self.blacklist(max_req=0)
+        user = hashed("spammer@example.com")
+        bl.is_blacklisted(user, "email")
+
+        yield bl.add(user, "email")
+        self.assertRaises(
+            conftests.blacklist.BlacklistError, bl.is_blacklisted, user, "email"
+        )
+        # Blocks are per service
+        bl.is_blacklisted(user, "twitter")
+        bl.is_blacklisted(hashed("hiro@torproject.org"), "email")
+
+        # Blocks are loaded again from the database
+        bl = self.blacklist(max_req=0)
+        self.assertTrue(bl.is_blocked(user, "email"))
+
+        yield bl.remove(user, "email")
+        bl.is_blacklisted(user, "email")
+        bl = self.blacklist(max_req=0)
+        self.assertFalse(bl.is_blocked(user, "email"))
+
+    def test_too_many_requests(self):
+        bl = self.blacklist(max_req=3, wait_time=20)
+        user = hashed("greedy@example.com")
+        for i in range(3):
+            bl.is_blacklisted(user, "email")
+        self.assertRaises(
+            conftests.blacklist.BlacklistError, bl.is_blacklisted, user, "email"
+        )
+
+        # Fresh user again after waiting
+        self.clock.now += 20 * 60 + 1
+        bl.is_blacklisted(user, "email")
+
+    def test_lookup_time(self):
+        def elapsed(num):
+            bl = conftests.blacklist.Blacklist(max_req=0)
+            for i in range(num):
+                bl.add(hashed("user{}@example.com".format(i)), "email")
+            self.assertTrue(bl.is_blocked(hashed("user42@example.com"), "email"))
+
+            user = hashed("hiro@torproject.org")
+            best = None
+            for run in range(3):
+                start = time.perf_counter()
+                for i in range(10000):
+                    bl.is_blacklisted(user, "email")
+                total = time.perf_counter() - start
+                best = total if best is None else min(best, total)
+            return best
+
+        # Lookups are binary searches, 64 times the blocks barely changes
+        # their time where a scan would take 64 times as long
+        self.assertLess(elapsed(64000), elapsed(1000) * 8)
+
+    def test_email_parser_blacklist(self):
+        ep = conftests.EmailParser(self.settings, "gettor@torproject.org")
+        msg_str = "From: spammer@example.com\nSubject: help\nTo: gettor@torproject.org\n\n"
+        self.assertEqual(ep.parse(msg_str)["command"], "help")
+
+        ep.blacklist = conftests.blacklist.Blacklist(max_req=0)
+        ep.blacklist.add(hashed("spammer@example.com"), "email")
+        self.assertEqual(ep.parse(msg_str), {})
+        del ep
+
+if __name__ == "__main__":
+    unittest.main()
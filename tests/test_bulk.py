@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import os
+import mailbox
+import sqlite3
+import tempfile
+import pytest
+from twisted.trial import unittest
+
+from . import conftests
+
+MESSAGES = [
+    "From: alice@example.com\nTo: gettor@torproject.org\nSubject: linux es\n\n",
+    "From: bob@example.com\nTo: gettor@torproject.org\nSubject: help\n\n",
+    "From: MAILER-DAEMON@example.com\nTo: gettor@torproject.org\n\nosx\n",
+    "From: alice@example.com\nTo: gettor@torproject.org\n\nwindows\n",
+]
+
+class BulkIngestTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.tmpdir, "gettor.db")
+        self.settings._settings["dbname"] = self.dbname
+        self.settings._settings["email_requests_limit"] = 1
+        conn = sqlite3.connect(self.dbname)
+        with conn:
+            conn.execute(
+                "CREATE TABLE requests(id TEXT, command TEXT, platform TEXT,"
+                " language TEXT, service TEXT, date TEXT, status TEXT)"
+            )
+        conn.close()
+
+        self.maildir = os.path.join(self.tmpdir, "Maildir")
+        box = mailbox.Maildir(self.maildir)
+        for m in MESSAGES:
+            box.add(m)
+        box.close()
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def stored_requests(self):
+        conn = sqlite3.connect(self.dbname)
+        rows = conn.execute(
+            "SELECT id, command, platform, language FROM requests ORDER BY id"
+        ).fetchall()
+        conn.close()
+        return rows
+
+    def test_ingest_maildir(self):
+        checkpoint = os.path.join(self.tmpdir, "ingest.ckpt")
+        ingest = conftests.BulkIngest(
+            self.settings, ["en-US", "es-ES"], checkpoint=checkpoint,
+            batch_size=2, workers=1
+        )
+        result = ingest.run(self.maildir, "maildir")
+        self.assertEqual(result["messages"], 4)
+        # The autoresponder is dropped and alice is over the limit
+        self.assertEqual(result["requests"], 2)
+
+        rows = self.stored_requests()
+        self.assertEqual(len(rows), 2)
+        self.assertIn(("bob@example.com", "help", None, "en-US"), rows)
+
+        # The keys are stored with the requests, not in a separate file
+        self.assertFalse(os.path.exists(checkpoint))
+        conn = sqlite3.connect(self.dbname)
+        num = conn.execute(
+            "SELECT COUNT(*) FROM ingested WHERE checkpoint=?", (checkpoint,)
+        ).fetchone()[0]
+        conn.close()
+        self.assertEqual(num, 4)
+
+        # Resuming from the checkpoint doesn't ingest anything again
+        ingest = conftests.BulkIngest(
+            self.settings, ["en-US", "es-ES"], checkpoint=checkpoint,
+            batch_size=2, workers=1
+        )
+        result = ingest.run(self.maildir, "maildir")
+        self.assertEqual(result["messages"], 0)
+        self.assertEqual(len(self.stored_requests()), 2)
+
+    def test_worker_parser(self):
+        conftests.bulk.init_worker(self.settings, ["en-US"])
+        try:
+            # Workers only parse, they don't open the database
+            self.assertIsNone(conftests.bulk._parser.conn)
+            self.assertIsNone(conftests.bulk._parser.limiter)
+            request = conftests.bulk.parse_message(MESSAGES[1])
+            self.assertEqual(request["command"], "help")
+        finally:
+            conftests.bulk.close_worker()
+
+    def test_check_mx(self):
+        self.settings._settings["email_check_mx"] = True
+        validate = conftests.validate_email.validate_email
+        def fake_validate(email, check_mx=False, **kwargs):
+            if check_mx:
+                return not email.startswith("bob@")
+            return validate(email)
+        self.patch(conftests.validate_email, "validate_email", fake_validate)
+        ingest = conftests.BulkIngest(
+            self.settings, ["en-US", "es-ES"], batch_size=2, workers=1
+        )
+        result = ingest.run(self.maildir, "maildir")
+        self.assertEqual(result["messages"], 4)
+        # bob has no valid MX, alice is over the limit
+        self.assertEqual(result["requests"], 1)
+        self.assertEqual(self.stored_requests()[0][0], "alice@example.com")
+
+    def test_dkim(self):
+        self.settings._settings["email_dkim"] = True
+        self.settings._settings["dkim_trusted_authserv_id"] = "mx.torproject.org"
+        maildir = os.path.join(self.tmpdir, "DKIM")
+        box = mailbox.Maildir(maildir)
+        box.add("Authentication-Results: mx.torproject.org; dkim=pass\n"
+            + MESSAGES[0])
+        box.add("Authentication-Results: mx.torproject.org; dkim=fail\n"
+            + MESSAGES[1])
+        # Unsigned, the worker verifies it and fails
+        box.add(MESSAGES[3].replace("alice@", "carol@"))
+        box.close()
+        ingest = conftests.BulkIngest(
+            self.settings, ["en-US", "es-ES"], batch_size=2, workers=1
+        )
+        result = ingest.run(maildir, "maildir")
+        self.assertEqual(result["messages"], 3)
+        self.assertEqual(self.stored_requests(), [
+            ("alice@example.com", "links", "linux", "es-ES")
+        ])
+
+if __name__ == "__main__":
+    unittest.main()
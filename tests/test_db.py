@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
+import os
+import sys
+import warnings
+import time
+import sqlite3
+import tempfile
+import subprocess
 import pytest
 import pytest_twisted
 from datetime import datetime
 from twisted.trial import unittest
+from twisted.internet import defer
 
 from . import conftests
 
@@ -12,6 +20,7 @@ class DatabaseTests(unittest.TestCase):
     timeout = 15
     def setUp(self):
         self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        conftests.temp_db(self.settings)
         self.locales = conftests.strings.get_locales()
 
         self.conn = conftests.SQLite3(self.settings.get("dbname"))
@@ -21,8 +30,7 @@ class DatabaseTests(unittest.TestCase):
         del self.conn
 
     @pytest_twisted.inlineCallbacks
-    def add_dummy_requests(self, command, num):
-        now_str = datetime.now().strftime("%Y%m%d")
+    def add_dummy_requests(self, command, num, now):
         for i in range(0, num):
             yield self.conn.new_request(
                 id='testid',
@@ -30,7 +38,7 @@ class DatabaseTests(unittest.TestCase):
                 platform='linux',
                 language='en',
                 service='email',
-                date=now_str,
+                date=now,
                 status="ONHOLD",
             )
 
@@ -44,20 +52,20 @@ class DatabaseTests(unittest.TestCase):
 
     @pytest_twisted.inlineCallbacks
     def test_requests(self):
-        now_str = datetime.now().strftime("%Y%m%d")
-        yield self.add_dummy_requests("links", 2)
-        yield self.add_dummy_requests("help", 1)
+        now = int(time.time())
+        yield self.add_dummy_requests("links", 2, now)
+        yield self.add_dummy_requests("help", 1, now)
         num = yield self.conn.get_num_requests("testid", "email")
         self.assertEqual(num[0][0], 3)
 
         requests = yield self.conn.get_requests("ONHOLD", "email")
         for request in requests:
             self.assertEqual(request[4], "email")
-            self.assertEqual(request[5], now_str)
+            self.assertEqual(request[5], now)
             self.assertEqual(request[6], "ONHOLD")
         self.assertEqual(len(requests), 3)
 
-        yield self.conn.remove_request("testid", "email", now_str)
+        yield self.conn.remove_request("testid", "email", now)
         num = yield self.conn.get_num_requests("testid", "email")
         self.assertEqual(num[0][0], 0)
 
@@ -71,5 +79,202 @@ class DatabaseTests(unittest.TestCase):
             self.assertEqual(link[6], "ACTIVE")
             self.assertIn(link[5], ["github", "gitlab"])
 
+    @pytest_twisted.inlineCallbacks
+    def test_group_commit(self):
+        writer = self.conn.writer
+        num_commits = writer.num_commits
+        now = int(time.time())
+        writes = [
+            self.conn.new_request(
+                id='groupid', command='help', platform=None, language='en',
+                service='email', date=now + i, status="ONHOLD"
+            ) for i in range(5)
+        ]
+        bad = writer.write("INSERT INTO nonexistent VALUES(?)", (1,))
+        yield defer.gatherResults(writes)
+        yield self.assertFailure(bad, sqlite3.OperationalError)
+
+        # One transaction, and the failing query doesn't undo the others
+        self.assertEqual(writer.num_commits, num_commits + 1)
+        num = yield self.conn.get_num_requests("groupid", "email")
+        self.assertEqual(num[0][0], 5)
+
+        yield defer.gatherResults([
+            self.conn.remove_request("groupid", "email", now + i)
+            for i in range(5)
+        ])
+        num = yield self.conn.get_num_requests("groupid", "email")
+        self.assertEqual(num[0][0], 0)
+
+    @pytest_twisted.inlineCallbacks
+    def test_claim_requests(self):
+        now = int(time.time())
+        yield defer.gatherResults([
+            self.conn.new_request(
+                id='claimid', command='help', platform=None, language='en',
+                service='leasetest', date=now + i, status="ONHOLD"
+            ) for i in range(5)
+        ])
+
+        # Workers get disjoint batches, paging from the last row claimed
+        first = yield self.conn.claim_requests("leasetest", "w1", 2, 600)
+        second = yield self.conn.claim_requests("leasetest", "w2", 2, 600)
+        self.assertEqual([r[6] for r in first], [now, now + 1])
+        self.assertEqual([r[6] for r in second], [now + 2, now + 3])
+        last = yield self.conn.claim_requests(
+            "leasetest", "w1", 2, 600, after=(first[-1][6], first[-1][0])
+        )
+        self.assertEqual([r[6] for r in last], [now + 4])
+
+        # Only the owner completes a request
+        yield self.conn.complete_request(first[0][0], "w2", "leasetest")
+        yield self.conn.complete_request(first[0][0], "w1", "leasetest")
+        num = yield self.conn.get_num_requests("claimid", "leasetest")
+        self.assertEqual(num[0][0], 4)
+
+        # Expired leases are claimed again
+        yield self.conn.reap_requests(now=now + 700)
+        again = yield self.conn.claim_requests("leasetest", "w3", 10, 600)
+        self.assertEqual(len(again), 4)
+        yield defer.gatherResults([
+            self.conn.complete_request(r[0], "w3", "leasetest") for r in again
+        ])
+        num = yield self.conn.get_num_requests("claimid", "leasetest")
+        self.assertEqual(num[0][0], 0)
+
+    @pytest_twisted.inlineCallbacks
+    def test_shared_pool(self):
+        dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+        first = conftests.SQLite3(dbname)
+        second = conftests.SQLite3(dbname, cp_max=1)
+        self.assertIs(first.dbpool, second.dbpool)
+        self.assertIs(first.writer, second.writer)
+
+        # The pool is closed by the last user, only once
+        self.assertIsNone(first.close())
+        self.assertIsNone(first.close())
+        num = yield second.get_num_requests("poolid", "email")
+        self.assertEqual(num[0][0], 0)
+        yield second.close()
+        self.assertFalse(second.writer.pending)
+        self.assertNotIn(dbname, conftests.db._pools)
+
+    @pytest_twisted.inlineCallbacks
+    def test_shared_pool_shutdown(self):
+        fake = conftests.ShutdownReactor()
+        self.patch(conftests.db, "reactor", fake)
+        conn = conftests.SQLite3(os.path.join(tempfile.mkdtemp(), "gettor.db"))
+        conn.writer.write("DELETE FROM requests")
+        fake.fire()
+        self.assertIsNone(conn.writer.shutdown_trigger)
+        # Closing after shutdown doesn't remove the fired trigger again
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            yield conn.close()
+        self.assertFalse(conn.writer.pending)
+
+    @pytest_twisted.inlineCallbacks
+    def test_shards(self):
+        tmpdir = tempfile.mkdtemp()
+        settings = {
+            "dbname": os.path.join(tmpdir, "gettor.db"),
+            "db_shards": {
+                "email": os.path.join(tmpdir, "email.db"),
+                "twitter": os.path.join(tmpdir, "twitter.db"),
+            }
+        }
+        conn = conftests.SQLite3.from_settings(settings)
+        self.assertIsNot(conn.route("email").writer, conn.route("twitter").writer)
+        self.assertIs(conn.route("links"), conn.pool)
+
+        now = int(time.time())
+        for service in ("email", "twitter", "twitter"):
+            yield conn.new_request(
+                id='shardid', command='links', platform='linux',
+                language='en', service=service, date=now, status="ONHOLD"
+            )
+            yield conn.update_stats(
+                command='links', platform='linux', language='en',
+                service=service
+            )
+        num = yield conn.get_num_requests("shardid", "twitter")
+        self.assertEqual(num[0][0], 2)
+
+        # Each service only writes to its own file
+        for name, expected in (("email", 1), ("twitter", 2), ("gettor", 0)):
+            db = sqlite3.connect(os.path.join(tmpdir, name + ".db"))
+            self.assertEqual(
+                db.execute("SELECT COUNT(*) FROM requests").fetchone()[0],
+                expected
+            )
+            db.close()
+
+        stats = conftests.db.open_stats(settings)
+        rows = stats.execute(
+            "SELECT service, num_requests FROM all_stats ORDER BY service"
+        ).fetchall()
+        stats.close()
+        self.assertEqual(rows, [("email", 1), ("twitter", 2)])
+        yield conn.close()
+
+    @pytest_twisted.inlineCallbacks
+    def test_pragmas(self):
+        pragmas = yield self.conn.dbpool.runInteraction(
+            lambda c: [
+                c.execute("PRAGMA {}".format(p)).fetchone()[0]
+                for p in ("journal_mode", "busy_timeout")
+            ]
+        )
+        self.assertEqual(pragmas, ["wal", 5000])
+
+        conn = sqlite3.connect(":memory:")
+        self.assertRaises(
+            ValueError, conftests.db.apply_pragmas, conn,
+            {"cache_size": "1; DROP TABLE requests"}
+        )
+        conn.close()
+
+    def test_migrations(self):
+        dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+        conn = sqlite3.connect(dbname)
+        with conn:
+            conn.execute(
+                "CREATE TABLE requests(id TEXT, command TEXT, platform TEXT,"
+                " language TEXT, service TEXT, date TEXT, status TEXT)"
+            )
+            conn.execute(
+                "INSERT INTO requests VALUES('testid', 'help', NULL, 'en', "
+                "'email', '20191017120000', 'ONHOLD')"
+            )
+
+        applied = conftests.migrations.migrate(conn)
+        self.assertEqual(applied[-1], conftests.migrations.LATEST)
+        self.assertEqual(conftests.migrations.migrate(conn), [])
+
+        date = conn.execute("SELECT date FROM requests").fetchone()[0]
+        self.assertEqual(
+            date, int(time.mktime(datetime(2019, 10, 17, 12).timetuple()))
+        )
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM requests WHERE service=? AND "
+            "status=?", ("email", "ONHOLD")
+        ).fetchall()
+        self.assertIn("requests_service_status", str(plan))
+        conn.close()
+
+    def test_create_db(self):
+        dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+        for flag in ("-n", "-c"):
+            subprocess.check_call(
+                [sys.executable, "scripts/create_db", flag, "-f", dbname],
+                stdout=subprocess.DEVNULL
+            )
+            conn = sqlite3.connect(dbname)
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )]
+            conn.close()
+            self.assertIn("blacklist", tables)
+
 if __name__ == "__main__":
     unittest.main()
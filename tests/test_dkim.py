@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import pytest
+import pytest_twisted
+from twisted.trial import unittest
+
+from . import conftests
+
+UNSIGNED_MSG = ("From: hiro@torproject.org\r\n"
+        "To: gettor@torproject.org\r\n"
+        "Subject: linux\r\n\r\nlinux es\r\n")
+
+class DKIMTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        conftests.temp_db(self.settings)
+        self.lookups = []
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def dnsfunc(self, name, timeout=5):
+        self.lookups.append(name)
+        if name.startswith(b"missing."):
+            return None
+        return b"v=DKIM1; k=rsa; p=KEY"
+
+    def test_key_cache(self):
+        verifier = conftests.dkim_verifier.DKIMVerifier(dnsfunc=self.dnsfunc)
+        for i in range(3):
+            txt = verifier.get_txt(b"sel._domainkey.example.com.")
+            self.assertEqual(txt, b"v=DKIM1; k=rsa; p=KEY")
+            self.assertEqual(verifier.get_txt(b"missing._domainkey.example.com."), None)
+        # One lookup per selector, the rest comes from the cache
+        self.assertEqual(len(self.lookups), 2)
+        self.assertEqual(verifier.keys.hits, 4)
+        self.assertEqual(verifier.keys.misses, 2)
+
+    @pytest_twisted.inlineCallbacks
+    def test_verify_unsigned(self):
+        verifier = conftests.dkim_verifier.DKIMVerifier(dnsfunc=self.dnsfunc)
+        try:
+            valid = yield verifier.verify(UNSIGNED_MSG.encode('utf-8'))
+        finally:
+            verifier.stop()
+        self.assertFalse(valid)
+        self.assertEqual(verifier.stats()["invalid"], 1)
+
+    def test_shutdown_trigger(self):
+        fake = conftests.ShutdownReactor()
+        self.patch(conftests.dkim_verifier, "reactor", fake)
+        verifier = conftests.dkim_verifier.DKIMVerifier(dnsfunc=self.dnsfunc)
+        verifier.start()
+        fake.fire()
+        self.assertFalse(verifier.threadpool.started)
+        self.assertIsNone(verifier.shutdown_trigger)
+        # Stopping after shutdown doesn't remove the fired trigger again
+        verifier.stop()
+
+        verifier = conftests.dkim_verifier.DKIMVerifier(dnsfunc=self.dnsfunc)
+        verifier.start()
+        verifier.stop()
+        self.assertEqual(fake.event.during, [])
+
+    def test_dkim_verify_failure(self):
+        ep = conftests.EmailParser(self.settings, "gettor@torproject.org", dkim=True)
+        ep.verifier = conftests.dkim_verifier.DKIMVerifier(dnsfunc=self.dnsfunc)
+        self.assertRaises(
+            conftests.DKIMError, ep.dkim_verify, UNSIGNED_MSG, "hiro@torproject.org"
+        )
+        del ep
+
+    def test_authentication_results(self):
+        self.settings._settings["dkim_trusted_authserv_id"] = "mx.torproject.org"
+        ep = conftests.EmailParser(self.settings, "gettor@torproject.org", dkim=True)
+        ep.locales = ["en-US", "es-ES"]
+        request = ep.parse(
+            "Authentication-Results: mx.torproject.org;\r\n"
+            "  dkim=pass (1024-bit key) header.d=torproject.org header.s=sel\r\n"
+            "Authentication-Results: other.example.com; dkim=fail\r\n" + UNSIGNED_MSG
+        )
+        self.assertEqual(request["platform"], "linux")
+        self.assertEqual(request["language"], "es-ES")
+
+        # Only the topmost header from the trusted MTA counts
+        self.assertRaises(conftests.DKIMError, ep.parse,
+            "Authentication-Results: mx.torproject.org; dkim=none\r\n"
+            "Authentication-Results: mx.torproject.org; dkim=pass\r\n" + UNSIGNED_MSG
+        )
+
+        msg = conftests.message_from_string(
+            "Authentication-Results: other.example.com; dkim=pass\r\n" + UNSIGNED_MSG
+        )
+        self.assertEqual(ep.auth_results_verdict(msg), None)
+
+        # A header from the trusted MTA below someone else's was forged
+        msg = conftests.message_from_string(
+            "Authentication-Results: other.example.com; dkim=fail\r\n"
+            "Authentication-Results: mx.torproject.org; dkim=pass\r\n" + UNSIGNED_MSG
+        )
+        self.assertEqual(ep.auth_results_verdict(msg), None)
+        del ep
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,86 @@
 #!/usr/bin/env python3
 import pytest
 import pytest_twisted
+import os
+import sys
+import json
+import time
 import hashlib
+import sqlite3
+import tempfile
+import subprocess
 from datetime import datetime
+from email import message_from_bytes
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from twisted.internet import task
+from twisted.mail import smtp
+from zope.interface import implementer
 
 from . import conftests
 
+@implementer(smtp.IMessage)
+class SinkMessage(object):
+    def __init__(self, received):
+        self.received = received
+        self.lines = []
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+    def eomReceived(self):
+        self.received.append(b"\n".join(self.lines))
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        pass
+
+
+@implementer(smtp.IMessageDelivery)
+class SinkDelivery(object):
+    def __init__(self):
+        self.received = []
+
+    def receivedHeader(self, helo, origin, recipients):
+        return b"Received: by test sink"
+
+    def validateFrom(self, helo, origin):
+        return origin
+
+    def validateTo(self, user):
+        if user.dest.local == b"bounce":
+            raise smtp.SMTPBadRcpt(user)
+        return lambda: SinkMessage(self.received)
+
+
+class SinkFactory(smtp.SMTPFactory):
+    def __init__(self, delivery):
+        smtp.SMTPFactory.__init__(self)
+        self.delivery = delivery
+        self.connections = []
+
+    def buildProtocol(self, addr):
+        p = smtp.SMTPFactory.buildProtocol(self, addr)
+        p.delivery = self.delivery
+        self.connections.append(p)
+        return p
+
+
+class LMTPServer(smtp.ESMTP):
+    def do_LHLO(self, rest):
+        self._helo = (rest, b"local")
+        self._from = None
+        self._to = []
+        self.sendCode(250, self.host + b"\n" + self.listExtensions())
+
+
 class EmailServiceTests(unittest.TestCase):
 
     # Fail any tests which take longer than 15 seconds.
     timeout = 15
     def setUp(self):
         self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        conftests.temp_db(self.settings)
         self.sm_client = conftests.Sendmail(self.settings)
         self.locales = conftests.strings.get_locales()
 
@@ -66,6 +132,139 @@ class EmailServiceTests(unittest.TestCase):
         self.assertEqual(request["language"], "es")
         del ep
 
+    def test_keyword_token_limit(self):
+        ep = conftests.EmailParser(self.settings, "gettor@torproject.org")
+        ep.locales = ["en-US", "es-ES"]
+        ep.max_tokens = 100
+        request = {"command": None, "platform": None, "language": None}
+        request = ep.parse_keywords("word " * 100 + "linux es", request)
+        self.assertEqual(request["command"], None)
+        self.assertEqual(request["language"], None)
+
+        request = ep.parse_keywords("word " * 98 + "linux es", request)
+        self.assertEqual(request["command"], "links")
+        self.assertEqual(request["language"], "es-ES")
+        del ep
+
+    def test_keyword_index_shared(self):
+        index = conftests.keywords.get_index(["en-US", "es-ES"], ["linux"])
+        self.assertIs(index, conftests.keywords.get_index(["en-US", "es-ES"], ["linux"]))
+        self.assertEqual(index.language("es-mx"), "es-ES")
+        self.assertEqual(index.language("es-mx", "en-US"), "en-US")
+        self.assertEqual(index.language("en-us", "es-ES"), "en-US")
+
+    def test_multipart_email_parser(self):
+        ep = conftests.EmailParser(self.settings, "gettor@torproject.org")
+        ep.locales = ["en-US", "es-ES", "es-AR", "pt-BR", "fa"]
+        request = ep.parse(
+            "To: gettor@torproject.org\n"
+            "From: hiro@torproject.org\n"
+            "Subject: =?utf-8?q?linux?=\n"
+            "MIME-Version: 1.0\n"
+            "Content-Type: multipart/mixed; boundary=\"b1\"\n"
+            "\n"
+            "--b1\n"
+            "Content-Type: multipart/alternative; boundary=\"b2\"\n"
+            "\n"
+            "--b2\n"
+            "Content-Type: text/html; charset=utf-8\n"
+            "\n"
+            "<p>windows</p>\n"
+            "--b2\n"
+            "Content-Type: text/plain; charset=utf-8\n"
+            "Content-Transfer-Encoding: base64\n"
+            "\n"
+            "Zm9yIG1lIGZhCi0tIApvc3ggZW4K\n"
+            "--b2--\n"
+            "--b1\n"
+            "Content-Type: text/plain; name=\"notes.txt\"\n"
+            "Content-Disposition: attachment\n"
+            "\n"
+            "windows es\n"
+            "--b1--\n"
+        )
+        # Only the first text/plain part counts, up to the signature
+        self.assertEqual(request["command"], "links")
+        self.assertEqual(request["platform"], "linux")
+        self.assertEqual(request["language"], "fa")
+
+        request = ep.parse(
+            "To: gettor@torproject.org\n"
+            "From: hiro@torproject.org\n"
+            "Content-Type: text/html\n"
+            "\n"
+            "<html><style>linux {}</style><b>osx</b> es</html>\n"
+        )
+        self.assertEqual(request["platform"], "osx")
+        self.assertEqual(request["language"], "es-ES")
+
+        # Text attachments are skipped, the message headers parsed once
+        parsed = []
+        def parse_headers(headers):
+            parsed.append(headers)
+            return parse(headers)
+        parse = conftests.mime.parse_headers
+        self.patch(conftests.mime, "parse_headers", parse_headers)
+        request = ep.parse(
+            "To: gettor@torproject.org\n"
+            "From: hiro@torproject.org\n"
+            "Content-Type: multipart/mixed; boundary=\"b1\"\n"
+            "\n"
+            "--b1\n"
+            "Content-Type: text/plain\n"
+            "Content-Disposition: attachment; filename=\"notes.txt\"\n"
+            "\n"
+            "windows\n"
+            "--b1\n"
+            "Content-Type: text/plain\n"
+            "\n"
+            "linux\n"
+            "--b1--\n"
+        )
+        self.assertEqual(request["platform"], "linux")
+        self.assertEqual(len(parsed), 3)
+        del ep
+
+    def test_strip_html_time(self):
+        pathological = [
+            lambda n: "<style>" * n,
+            lambda n: "<script>" * n + "</style>" * n,
+            lambda n: "<style><script>" * n + "</style>",
+        ]
+
+        def elapsed(n):
+            best = None
+            for i in range(3):
+                start = time.perf_counter()
+                for p in pathological:
+                    conftests.mime.strip_html(p(n))
+                total = time.perf_counter() - start
+                best = total if best is None else min(best, total)
+            return best
+
+        self.assertEqual(
+            conftests.mime.strip_html("<style>" * 3 + "linux</style>osx"),
+            " osx"
+        )
+        # Linear, 8 times the input takes about 8 times as long, where
+        # quadratic matching would take 64 times
+        small = elapsed(500)
+        large = elapsed(4000)
+        self.assertLess(large, small * 32)
+
+    def test_bounded_body(self):
+        ep = conftests.EmailParser(self.settings, "gettor@torproject.org")
+        ep.locales = ["en-US", "es-ES"]
+        ep.max_body_lines = 10
+        request = ep.parse(
+            "To: gettor@torproject.org\n"
+            "From: hiro@torproject.org\n"
+            "\n" + "hello\n" * 10 + "linux es\n"
+        )
+        self.assertEqual(request["command"], "help")
+        self.assertEqual(request["language"], "en-US")
+        del ep
+
     def test_too_many_request_exclude(self):
         ep = conftests.EmailParser(self.settings, "gettor@torproject.org")
         hid = "80d7054da0d3826563c7babb5453e18f3e42f932e562c5ab0434aec9df7b0625"
@@ -346,5 +545,270 @@ class EmailServiceTests(unittest.TestCase):
 
         self.assertEqual(request, {})
 
+    @pytest_twisted.inlineCallbacks
+    def test_concurrent_delivery(self):
+        settings = {
+            "dbname": os.path.join(tempfile.mkdtemp(), "gettor.db"),
+            "sendmail_concurrency": 2,
+            "sendmail_batch_size": 3,
+        }
+        sm = conftests.Sendmail(settings)
+        now = int(time.time())
+        for i in range(5):
+            yield sm.conn.new_request(
+                id="user{}@example.com".format(i), command="help",
+                platform=None, language="en", service="email", date=now + i,
+                status="ONHOLD"
+            )
+
+        pending = []
+        gauges = []
+        def sendmail(email_addr, subject, body):
+            gauges.append(sm.get_gauges())
+            d = defer.Deferred()
+            pending.append((email_addr, d))
+            return d
+        sm.sendmail = sendmail
+
+        run = sm.get_new()
+        while pending or not run.called:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+            gauges.append(sm.get_gauges())
+            while pending:
+                email_addr, d = pending.pop(0)
+                if email_addr == "user1@example.com":
+                    d.errback(RuntimeError("Mailbox unavailable"))
+                else:
+                    d.callback(None)
+        yield run
+
+        self.assertEqual(max(g["in_flight"] for g in gauges), 2)
+        self.assertEqual(max(g["queued"] for g in gauges), 1)
+        gauges = sm.get_gauges()
+        self.assertEqual((gauges["sent"], gauges["failed"]), (4, 1))
+        # Failed replies are not retried
+        num = yield sm.conn.get_num_requests("user1@example.com", "email")
+        self.assertEqual(num[0][0], 0)
+        yield sm.close()
+
+    @pytest_twisted.inlineCallbacks
+    def test_smtp_pool(self):
+        delivery = SinkDelivery()
+        factory = SinkFactory(delivery)
+        listener = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        pool = conftests.SMTPPool(
+            "127.0.0.1", port=listener.getHost().port, size=2,
+            idle_timeout=0.5, require_tls=False
+        )
+        try:
+            sent = yield defer.DeferredList([
+                pool.send(
+                    "gettor@torproject.org",
+                    "{}@example.com".format("bounce" if i == 3 else i),
+                    "Subject: {}\r\n\r\nbody".format(i).encode("utf-8")
+                ) for i in range(10)
+            ], consumeErrors=True)
+            self.assertEqual([ok for ok, _ in sent].count(False), 1)
+            self.assertTrue(sent[3][1].check(smtp.SMTPDeliveryError))
+            self.assertEqual(len(delivery.received), 9)
+            # Sessions are reused, a rejected recipient doesn't close them
+            self.assertEqual(len(factory.connections), 2)
+            self.assertEqual(pool.get_stats(), {
+                "sent": 10, "connections": 2, "handshakes_saved": 8
+            })
+
+            # The server drops an idle session
+            factory.connections[0].transport.loseConnection()
+            yield task.deferLater(reactor, 0.1, lambda: None)
+            self.assertEqual(len(pool.sessions), 1)
+            yield pool.send("gettor@torproject.org", "a@example.com", b"\r\n")
+            self.assertEqual(len(factory.connections), 2)
+
+            # Idle sessions are closed
+            yield task.deferLater(reactor, 0.7, lambda: None)
+            self.assertEqual(len(pool.sessions), 0)
+            yield pool.send("gettor@torproject.org", "b@example.com", b"\r\n")
+            self.assertEqual(len(factory.connections), 3)
+            self.assertEqual(len(delivery.received), 11)
+        finally:
+            pool.close()
+            yield task.deferLater(reactor, 0.1, lambda: None)
+            yield listener.stopListening()
+
+    @pytest_twisted.inlineCallbacks
+    def test_local_backends(self):
+        tmpdir = tempfile.mkdtemp()
+        settings = {
+            "dbname": os.path.join(tmpdir, "gettor.db"),
+            "sendmail_addr": "gettor@torproject.org",
+            "sendmail_backend": "maildrop",
+            "sendmail_maildrop_dir": os.path.join(tmpdir, "maildrop"),
+            "sendmail_pool_size": 2,
+        }
+        sm = conftests.Sendmail(settings)
+        yield sm.sendmail("user@example.com", "[GetTor] Help", "body")
+        new = os.path.join(tmpdir, "maildrop", "new")
+        self.assertEqual(os.listdir(os.path.join(tmpdir, "maildrop", "tmp")), [])
+        [name] = os.listdir(new)
+        with open(os.path.join(new, name), "rb") as f:
+            message = message_from_bytes(f.read())
+        self.assertEqual(message["Return-Path"], "<gettor@torproject.org>")
+        self.assertEqual(message["X-Original-To"], "user@example.com")
+        self.assertEqual(message["Subject"], "[GetTor] Help")
+        yield sm.close()
+
+        # A run that crashed left the message in cur/, it's sent again
+        cur = os.path.join(tmpdir, "maildrop", "cur")
+        os.makedirs(cur, exist_ok=True)
+        os.rename(os.path.join(new, name), os.path.join(cur, name))
+        claimed = time.time() - 3600
+        os.utime(os.path.join(cur, name), (claimed, claimed))
+
+        # The pickup job hands the message to sendmail(8)
+        sendmail = os.path.join(tmpdir, "sendmail")
+        with open(sendmail, "w") as f:
+            f.write('#!/bin/sh\necho "$@" > {0}/args\ncat > {0}/sent\n'.format(
+                tmpdir
+            ))
+        os.chmod(sendmail, 0o755)
+        config = os.path.join(tmpdir, "gettor.conf.json")
+        with open(config, "w") as f:
+            json.dump(settings, f)
+        subprocess.check_call([
+            sys.executable, "scripts/send_maildrop", "-c", config,
+            "-s", sendmail
+        ], stdout=subprocess.DEVNULL)
+        self.assertEqual(os.listdir(new), [])
+        self.assertEqual(os.listdir(cur), [])
+        with open(os.path.join(tmpdir, "args")) as f:
+            self.assertEqual(
+                f.read(), "-i -f gettor@torproject.org -- user@example.com\n"
+            )
+        with open(os.path.join(tmpdir, "sent"), "rb") as f:
+            sent = f.read()
+        self.assertTrue(sent.startswith(b"Content-Type: "))
+        self.assertNotIn(b"Return-Path", sent)
+
+        delivery = SinkDelivery()
+        factory = SinkFactory(delivery)
+        factory.protocol = LMTPServer
+        path = os.path.join(tmpdir, "lmtp")
+        listener = reactor.listenUNIX(path, factory)
+        settings.update(sendmail_backend="lmtp", sendmail_lmtp_socket=path)
+        sm = conftests.Sendmail(settings)
+        try:
+            yield defer.gatherResults([
+                sm.sendmail("user{}@example.com".format(i), "Help", "body")
+                for i in range(5)
+            ])
+            self.assertEqual(len(delivery.received), 5)
+            self.assertEqual(sm.transport.get_stats()["handshakes_saved"], 3)
+        finally:
+            yield sm.close()
+            yield task.deferLater(reactor, 0.1, lambda: None)
+            yield listener.stopListening()
+
+        settings["sendmail_backend"] = "uucp"
+        self.assertRaises(ValueError, sm.build_transport)
+
+    @pytest_twisted.inlineCallbacks
+    def test_response_cache(self):
+        dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+        settings = {"dbname": dbname, "sendmail_addr": "gettor@torproject.org"}
+        sm = conftests.Sendmail(settings)
+        cache = sm.responses
+        self.assertIs(cache, conftests.responses.get_responses(settings))
+        yield sm.conn.get_links_version()
+        conn = sqlite3.connect(dbname)
+        with conn:
+            for platform in ("linux", "windows"):
+                conn.execute(
+                    "INSERT INTO links(link, platform, language, arch, "
+                    "version, provider, status, file) VALUES(?, ?, 'en-US', "
+                    "'64', '9.0', 'github', 'ACTIVE', 'tor.tar.xz')",
+                    ("https://example.com/" + platform, platform)
+                )
+
+        rendered = []
+        def render(command, platform, language):
+            rendered.append((command, platform, language))
+            return sm.render_reply(command, platform, language)
+        cache.register("email", render, sm.variants)
+
+        changed = yield cache.refresh(sm.conn)
+        self.assertTrue(changed)
+        self.assertEqual(rendered, [
+            ("help", None, None), ("links", "linux", "en-US"),
+            ("links", "windows", "en-US"),
+        ])
+        subject, body = yield cache.get("email", "links", "linux", "en-US")
+        self.assertIn("https://example.com/linux", body)
+        yield cache.get("email", "help")
+        self.assertEqual(len(rendered), 3)
+        self.assertEqual(cache.stats()["hits"], 2)
+        changed = yield cache.refresh(sm.conn)
+        self.assertFalse(changed)
+
+        # Changing the links renders every variant again
+        with conn:
+            conn.execute(
+                "UPDATE links SET link='https://example.org/linux' WHERE "
+                "platform='linux'"
+            )
+        changed = yield cache.refresh(sm.conn)
+        self.assertTrue(changed)
+        self.assertEqual(len(rendered), 6)
+        subject, body = yield cache.get("email", "links", "linux", "en-US")
+        self.assertIn("https://example.org/linux", body)
+
+        # And so does changing the locales
+        cache.get_locale_version = lambda: ("changed",)
+        changed = yield cache.refresh(sm.conn)
+        self.assertTrue(changed)
+        self.assertEqual(len(rendered), 9)
+        conn.close()
+        yield sm.close()
+
+    def test_message_template(self):
+        bodies = (
+            ("Hello\n\n\tlinux\n", "7bit"),
+            ("Descarga el navegador Tor para tu sistema, versión " * 4,
+             "quoted-printable"),
+            ("Загрузите Tor Browser для вашей системы\n" * 4, "base64"),
+        )
+        for body, encoding in bodies:
+            template = conftests.MessageTemplate(
+                "gettor@torproject.org", "[GetTor] Ayuda ñ", body
+            )
+            self.assertEqual(template.encoding, encoding)
+            message = message_from_bytes(
+                template.render("user@example.com", "<1@torproject.org>")
+            )
+            self.assertEqual(str(conftests.make_header(
+                conftests.decode_header(message["Subject"])
+            )), "[GetTor] Ayuda ñ")
+            self.assertEqual(message["From"], "gettor@torproject.org")
+            self.assertEqual(message["To"], "user@example.com")
+            self.assertEqual(message["Message-ID"], "<1@torproject.org>")
+            self.assertEqual(
+                message.get_payload(decode=True).decode("utf-8"), body
+            )
+        self.assertRaises(
+            ValueError, template.render, "user@example.com\nBcc: x@y.org",
+            "<1@torproject.org>"
+        )
+
+        sent = []
+        def send(from_addr, to_addr, data):
+            sent.append(data)
+            return defer.succeed(None)
+        self.sm_client.transport.send = send
+        for to_addr in ("a@example.com", "b@example.com"):
+            self.sm_client.sendmail(to_addr, "Help", "body")
+        self.assertEqual(len(self.sm_client.templates), 1)
+        first, second = [message_from_bytes(data) for data in sent]
+        self.assertEqual(second["To"], "b@example.com")
+        self.assertNotEqual(first["Message-ID"], second["Message-ID"])
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import csv
+import gzip
+import time
+import sqlite3
+import tempfile
+import pytest
+from twisted.trial import unittest
+
+from . import conftests
+
+class ExportTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        tmpdir = tempfile.mkdtemp()
+        self.outdir = os.path.join(tmpdir, "csv")
+        self.db_settings = {
+            "dbname": os.path.join(tmpdir, "gettor.db"),
+            "db_shards": {"twitter": os.path.join(tmpdir, "twitter.db")}
+        }
+        self.now = 1571313600
+        for filename in (self.db_settings["dbname"],
+                         self.db_settings["db_shards"]["twitter"]):
+            conftests.migrations.ensure_schema(filename)
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def stats(self, filename, num, service, date, updated):
+        conn = sqlite3.connect(filename)
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO stats(num_requests, platform, "
+                "language, command, service, date, updated) VALUES(?, "
+                "'linux', 'en', 'links', ?, ?, ?)",
+                (num, service, date, updated)
+            )
+        conn.close()
+
+    def read(self, path):
+        with gzip.open(path, "rt") as f:
+            return list(csv.reader(f))
+
+    def test_incremental(self):
+        dbname = self.db_settings["dbname"]
+        twitter = self.db_settings["db_shards"]["twitter"]
+        self.stats(dbname, 3, "email", "20191014", self.now - 3600)
+        self.stats(dbname, 2, "email", "20191017", self.now - 60)
+        self.stats(twitter, 4, "twitter", "20191017", self.now - 60)
+
+        exporter = conftests.export.StatsExport(
+            self.db_settings, self.outdir, clock=lambda: self.now
+        )
+        report = exporter.run(["weekly"])
+        self.assertEqual(report["rows"], 3)
+        files = [os.path.relpath(f, self.outdir) for f in report["files"]]
+        self.assertEqual(files, [
+            "2019-10-14/stats-{}.csv.gz".format(self.now - 1),
+            "2019-10-17/stats-{}.csv.gz".format(self.now - 1),
+            "rollups/weekly-2019-W42.csv.gz",
+        ])
+        rows = self.read(report["files"][1])
+        self.assertEqual(rows[0], conftests.export.HEADER)
+        self.assertEqual(sorted(r[4] for r in rows[1:]), ["email", "twitter"])
+        self.assertEqual(self.read(report["files"][2])[1:], [
+            ["2019-W42", "email", "links", "linux", "5"],
+            ["2019-W42", "twitter", "links", "linux", "4"],
+        ])
+
+        # Nothing changed, nothing exported
+        self.assertEqual(exporter.run()["rows"], 0)
+
+        self.now += 600
+        self.stats(twitter, 5, "twitter", "20191017", self.now - 10)
+        report = exporter.run(["daily"])
+        self.assertEqual(report["rows"], 1)
+        self.assertEqual(self.read(report["files"][0])[1][0], "5")
+        self.assertEqual(self.read(report["files"][1])[1:], [
+            ["2019-10-17", "email", "links", "linux", "2"],
+            ["2019-10-17", "twitter", "links", "linux", "5"],
+        ])
+
+    def test_late_flush(self):
+        dbname = self.db_settings["dbname"]
+        twitter = self.db_settings["db_shards"]["twitter"]
+        self.stats(dbname, 2, "email", "20191017", self.now - 60)
+        exporter = conftests.export.StatsExport(
+            self.db_settings, self.outdir, clock=lambda: self.now
+        )
+        self.assertEqual(exporter.run()["rows"], 1)
+
+        # Stamped before the watermark, committed after the export
+        self.now += 60
+        self.stats(twitter, 4, "twitter", "20191017", self.now - 90)
+        report = exporter.run()
+        self.assertEqual(report["rows"], 1)
+        self.assertEqual(self.read(report["files"][0])[1][4], "twitter")
+
+        # Rows of the overlap are only exported once
+        self.now += 60
+        self.assertEqual(exporter.run()["rows"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
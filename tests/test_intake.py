@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import threading
+import pytest
+import pytest_twisted
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.test import proto_helpers
+
+from . import conftests
+
+AUTORESPONDER_MSG = ("From: MAILER-DAEMON@mx1.riseup.net\n"
+        "Subject: Undelivered Mail Returned to Sender\r\n"
+        "To: gettor@torproject.org\r\n\r\n osx en\n")
+
+class IntakeTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        conftests.temp_db(self.settings)
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings._settings["intake_socket"] = os.path.join(self.tmpdir, "intake.sock")
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def test_intake_protocol(self):
+        intake = conftests.intake.Intake(self.settings)
+        intake.locales_loaded = True
+        factory = conftests.intake.IntakeFactory(intake, 1024)
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(b"%d:%s," % (len(AUTORESPONDER_MSG), AUTORESPONDER_MSG.encode()))
+        self.assertEqual(transport.value(), b"2:OK,")
+
+    def test_intake_rejected(self):
+        intake = conftests.intake.Intake(self.settings)
+        intake.locales_loaded = True
+        def parse(message):
+            return defer.fail(conftests.DKIMError("DKIM failed"))
+        self.patch(intake.ep, "parse", parse)
+        factory = conftests.intake.IntakeFactory(intake, 1024)
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(b"%d:%s," % (len(AUTORESPONDER_MSG), AUTORESPONDER_MSG.encode()))
+        self.assertEqual(transport.value(), b"8:REJECTED,")
+
+    def in_thread(self, f, *args):
+        # Daemon thread, so a blocking client can't keep the tests running
+        d = defer.Deferred()
+        def run():
+            result = f(*args)
+            reactor.callFromThread(d.callback, result)
+        threading.Thread(target=run, daemon=True).start()
+        return d
+
+    @pytest_twisted.inlineCallbacks
+    def test_send_message(self):
+        service = conftests.intake.IntakeService(self.settings)
+        service.startService()
+        try:
+            path = self.settings.get("intake_socket")
+            self.assertTrue(conftests.intake.intake_available(path))
+            processed = yield self.in_thread(
+                conftests.intake.send_message, path, AUTORESPONDER_MSG
+            )
+            self.assertTrue(processed)
+            self.assertTrue(service.intake.locales_loaded)
+        finally:
+            yield service.stopService()
+        # Stopping waits for the database pool to be closed
+        self.assertNotIn(self.settings.get("dbname"), conftests.db._pools)
+
+    @pytest_twisted.inlineCallbacks
+    def test_send_message_too_big(self):
+        self.settings._settings["intake_max_size"] = 16
+        service = conftests.intake.IntakeService(self.settings)
+        service.startService()
+        try:
+            # Dropped, process_email must not report it as delivered
+            processed = yield self.in_thread(
+                conftests.intake.send_message,
+                self.settings.get("intake_socket"), AUTORESPONDER_MSG
+            )
+            self.assertFalse(processed)
+        finally:
+            yield service.stopService()
+
+if __name__ == "__main__":
+    unittest.main()
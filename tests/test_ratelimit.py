@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+import tempfile
+import pytest
+from twisted.trial import unittest
+
+from . import conftests
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+class RateLimiterTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        self.dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+        self.settings._settings["dbname"] = self.dbname
+        self.clock = Clock()
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def limiter(self):
+        limiter = conftests.ratelimit.RateLimiter(
+            self.dbname, window=3600, num_buckets=6, clock=self.clock
+        )
+        limiter.load()
+        return limiter
+
+    def test_sliding_window(self):
+        limiter = self.limiter()
+        for i in range(3):
+            self.assertTrue(limiter.allow("email", "hid", 3))
+        self.assertFalse(limiter.allow("email", "hid", 3))
+        # Limits are per service and id
+        self.assertTrue(limiter.allow("twitter", "hid", 3))
+        self.assertTrue(limiter.allow("email", "other", 3))
+
+        # Requests leave the window one bucket at a time
+        limiter.add("email", "late")
+        self.clock.now += 3000
+        limiter.add("email", "late")
+        self.assertEqual(limiter.count("email", "late"), 2)
+        self.clock.now += 600
+        self.assertEqual(limiter.count("email", "late"), 1)
+        self.assertEqual(limiter.count("email", "hid"), 0)
+        self.assertTrue(limiter.allow("email", "hid", 3))
+
+    def test_persist(self):
+        limiter = self.limiter()
+        for i in range(3):
+            limiter.add("email", "hid")
+        limiter.add("twitter", "old")
+        self.clock.now += 1200
+        limiter.add("email", "hid")
+        limiter.persist()
+
+        # Counters survive a restart
+        limiter = self.limiter()
+        self.assertEqual(limiter.count("email", "hid"), 4)
+        self.assertEqual(limiter.count("twitter", "old"), 1)
+
+        # Expired counters are dropped from memory and the database
+        self.clock.now += 3000
+        limiter.persist()
+        self.assertNotIn(("twitter", "old"), limiter.counters)
+        self.assertEqual(limiter.count("email", "hid"), 1)
+        conn = sqlite3.connect(self.dbname)
+        rows = conn.execute("SELECT service, hid FROM rate_limits").fetchall()
+        conn.close()
+        self.assertEqual(rows, [("email", "hid")])
+
+    def test_persist_merge(self):
+        # The service and a bulk ingest count requests of the same id
+        service = self.limiter()
+        bulk = self.limiter()
+        service.add("email", "hid", 2)
+        bulk.add("email", "hid", 3)
+        service.persist()
+        bulk.persist()
+        bulk.persist()
+        self.assertEqual(self.limiter().count("email", "hid"), 5)
+
+        # Requests not saved are kept for the next save
+        service.dbname = os.path.dirname(self.dbname)
+        service.add("email", "hid")
+        service.persist()
+        self.assertEqual(len(service.pending), 1)
+        service.dbname = self.dbname
+        service.persist()
+        self.assertEqual(service.pending, {})
+        self.assertEqual(self.limiter().count("email", "hid"), 6)
+
+    def test_shared_limiter(self):
+        ep = conftests.EmailParser(self.settings, "gettor@torproject.org")
+        tp = conftests.TwitterParser(self.settings)
+        self.assertIs(ep.limiter, tp.limiter)
+        self.assertIs(ep.limiter, conftests.ratelimit.get_limiter(self.settings))
+        del ep
+        del tp
+
+if __name__ == "__main__":
+    unittest.main()
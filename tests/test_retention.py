@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+import time
+import sqlite3
+import tempfile
+import pytest
+from twisted.trial import unittest
+
+from . import conftests
+
+class RetentionTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        self.dbname = os.path.join(tempfile.mkdtemp(), "gettor.db")
+        self.now = time.time()
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def fill(self, num):
+        conn = sqlite3.connect(self.dbname)
+        conftests.migrations.migrate(conn)
+        old = int(self.now) - 40 * 86400
+        with conn:
+            conn.executemany(
+                "INSERT INTO requests(id, command, platform, language, "
+                "service, date, status) VALUES(?, ?, ?, ?, ?, ?, ?)",
+                [("user{}".format(i) + "x" * 500, "links", "linux", "en",
+                  "twitter", old, "SENT") for i in range(num)]
+            )
+            conn.execute(
+                "INSERT INTO requests(id, command, platform, language, "
+                "service, date, status) VALUES('claimed', 'links', 'linux', "
+                "'en', 'email', ?, 'IN_PROGRESS')", (old,)
+            )
+            conn.execute(
+                "INSERT INTO requests(id, command, platform, language, "
+                "service, date, status) VALUES('recent', 'help', NULL, "
+                "'en', 'email', ?, 'ONHOLD')", (int(self.now),)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO stats(num_requests, platform, language, "
+                "command, service, date) VALUES(3, 'linux', 'en', 'links', "
+                "'email', '20190101')"
+            )
+        conn.close()
+
+    def retention(self, **kwargs):
+        settings = {"dbname": self.dbname, "retention_batch_size": 100,
+                    "retention_pause": 0}
+        settings.update(kwargs)
+        return conftests.retention.Retention(settings, clock=lambda: self.now)
+
+    def test_purge(self):
+        self.fill(1000)
+        size = os.path.getsize(self.dbname)
+        reports = self.retention(retention_stats_age=365).run()
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]["requests"], 1000)
+        self.assertEqual(reports[0]["stats"], 1)
+        self.assertGreater(reports[0]["bytes"], 0)
+        self.assertLess(reports[0]["max_lock"], 5)
+
+        conn = sqlite3.connect(self.dbname)
+        ids = [r[0] for r in conn.execute("SELECT id FROM requests ORDER BY id")]
+        self.assertEqual(ids, ["claimed", "recent"])
+        self.assertEqual(conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        conn.close()
+        self.assertLess(os.path.getsize(self.dbname), size)
+
+    def test_convert(self):
+        conn = sqlite3.connect(self.dbname)
+        conn.execute("CREATE TABLE t(x)")
+        conn.close()
+        self.fill(200)
+
+        # Existing files are only rewritten when asked to
+        report = self.retention().run()[0]
+        self.assertEqual(report["requests"], 200)
+        self.assertEqual(report["bytes"], 0)
+
+        self.fill(200)
+
+        def recent():
+            conn = sqlite3.connect(self.dbname)
+            # num is the rowid itself, not a column VACUUM could renumber
+            rows = conn.execute(
+                "SELECT rowid, num FROM requests WHERE id='recent'"
+            ).fetchall()
+            self.assertEqual(rows[0][0], rows[0][1])
+            conn.close()
+            return rows
+
+        # Claimed requests are updated by rowid, VACUUM must not renumber
+        rowids = recent()
+        report = self.retention(retention_convert=True).run()[0]
+        self.assertGreater(report["bytes"], 0)
+        self.assertEqual(recent(), rowids)
+        conn = sqlite3.connect(self.dbname)
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        conn.close()
+
+if __name__ == "__main__":
+    unittest.main()
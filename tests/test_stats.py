@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import json
+import pytest
+import pytest_twisted
+from twisted.web.test.requesthelper import DummyRequest
+from twisted.web.server import NOT_DONE_YET
+from twisted.trial import unittest
+
+from . import conftests
+
+def render(api, request):
+    d = request.notifyFinish()
+    if api.render(request) != NOT_DONE_YET:
+        request.finish()
+    return d
+
+class StatsTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+    def setUp(self):
+        self.settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        tmpdir = tempfile.mkdtemp()
+        self.db_settings = {
+            "dbname": os.path.join(tmpdir, "gettor.db"),
+            "db_shards": {"twitter": os.path.join(tmpdir, "twitter.db")}
+        }
+        self.now = time.mktime((2019, 10, 17, 12, 0, 0, 0, 0, -1))
+
+    def tearDown(self):
+        print("tearDown()")
+
+    def test_hyperloglog(self):
+        hll = conftests.stats.HyperLogLog(12)
+        for i in range(20000):
+            hll.add(hashlib.sha256(str(i % 10000).encode()).hexdigest())
+        self.assertLess(abs(hll.count() - 10000), 10000 * 0.05)
+
+        other = conftests.stats.HyperLogLog(12)
+        for i in range(5000, 15000):
+            other.add(hashlib.sha256(str(i).encode()).hexdigest())
+        other = conftests.stats.HyperLogLog.from_bytes(other.to_bytes())
+        hll.merge(other)
+        self.assertLess(abs(hll.count() - 15000), 15000 * 0.05)
+
+        small = conftests.stats.HyperLogLog(12)
+        for user in ("a", "b", "c", "a"):
+            small.add(user)
+        self.assertEqual(small.count(), 3)
+        self.assertRaises(ValueError, hll.merge, conftests.stats.HyperLogLog(10))
+
+    def test_flush(self):
+        collector = conftests.stats.StatsCollector(
+            self.db_settings, clock=lambda: self.now
+        )
+        for i in range(10):
+            collector.count("links", "email", "linux", "en", hid="user{}".format(i % 4))
+        collector.count("help", "twitter", hid="tweeter")
+        # Nothing is written until flushed
+        self.assertFalse(os.path.exists(self.db_settings["dbname"]))
+
+        collector.flush()
+        collector.count("links", "email", "linux", "en", hid="user9")
+        collector.flush()
+
+        conn = sqlite3.connect(self.db_settings["dbname"])
+        rows = conn.execute(
+            "SELECT num_requests, platform, command, service, date FROM stats"
+        ).fetchall()
+        conn.close()
+        self.assertEqual(rows, [(11, "linux", "links", "email", "20191017")])
+        self.assertEqual(collector.get_requesters("email", "20191017"), 5)
+        self.assertEqual(collector.get_requesters("twitter", "20191017"), 1)
+
+        # Counters survive a failed flush
+        collector.dbname = os.path.join(self.db_settings["dbname"], "missing")
+        collector.count("links", "email", "linux", "en", hid="user10")
+        collector.flush()
+        self.assertEqual(len(collector.counters), 1)
+
+    def test_rollups(self):
+        dbname = self.db_settings["dbname"]
+        conn = sqlite3.connect(dbname)
+        conftests.migrations.migrate(conn, 6)
+        with conn:
+            conn.execute(
+                "INSERT INTO stats(num_requests, platform, language, command, "
+                "service, date) VALUES(2, 'linux', 'en', 'links', 'email', "
+                "'20190930')"
+            )
+        conftests.migrations.migrate(conn)
+        conn.close()
+
+        collector = conftests.stats.StatsCollector(
+            self.db_settings, clock=lambda: self.now
+        )
+        collector.count("links", "email", "linux", "en")
+        collector.count("links", "twitter", "windows", "en")
+        collector.count("help", "email", None, "en")
+        collector.flush()
+
+        query = conftests.stats.StatsQuery(self.db_settings)
+        self.assertEqual(
+            query.query("month", group_by=["platform"], command="links"), [
+                {"start": "20190901", "platform": "linux", "num_requests": 2},
+                {"start": "20191001", "platform": "linux", "num_requests": 1},
+                {"start": "20191001", "platform": "windows", "num_requests": 1},
+            ]
+        )
+        # 2019-09-30 and 2019-10-17 are not in the same week
+        rows = query.query("week", since="20191016", group_by=["service"])
+        self.assertEqual(rows, [
+            {"start": "20191014", "service": "email", "num_requests": 2},
+            {"start": "20191014", "service": "twitter", "num_requests": 1},
+        ])
+
+        # Answers are cached
+        collector.count("links", "twitter", "windows", "en")
+        collector.flush()
+        self.assertIs(
+            query.query("week", since="20191016", group_by=["service"]), rows
+        )
+        self.assertRaises(ValueError, query.query, "year")
+        self.assertRaises(ValueError, query.query, group_by=["date; --"])
+
+    @pytest_twisted.inlineCallbacks
+    def test_api(self):
+        collector = conftests.stats.StatsCollector(
+            self.db_settings, clock=lambda: self.now
+        )
+        collector.count("links", "email", "linux", "en")
+        collector.flush()
+        conftests.migrations.ensure_schema(self.db_settings["db_shards"]["twitter"])
+
+        api = conftests.stats_api.StatsResource(
+            conftests.stats.StatsQuery(self.db_settings)
+        )
+        request = DummyRequest([b""])
+        request.args = {b"period": [b"day"], b"service": [b"email"]}
+        yield render(api, request)
+        self.assertEqual(json.loads(b"".join(request.written)), [
+            {"start": "20191017", "platform": "linux", "num_requests": 1}
+        ])
+
+        request = DummyRequest([b""])
+        request.args = {b"period": [b"year"]}
+        yield render(api, request)
+        self.assertEqual(request.responseCode, 400)
+
+if __name__ == "__main__":
+    unittest.main()
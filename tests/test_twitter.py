@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
+import os
+import sqlite3
+import tempfile
 import pytest
+import pytest_twisted
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from twisted.internet import task
@@ -26,6 +30,49 @@ class TwitterTests(unittest.TestCase):
         r = tp.parse(message, str(message_id))
         self.assertEqual(r, {'command': 'links', 'id': "{'id': '1178649287208689669', 'twitter_handle': '1467062174'}", 'language': 'en', 'platform': 'windows','service': 'twitter'})
 
+    @pytest_twisted.inlineCallbacks
+    def test_reply_without_links(self):
+        settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        settings._settings["dbname"] = os.path.join(
+            tempfile.mkdtemp(), "gettor.db"
+        )
+        dm = conftests.twitterdm.Twitterdm(settings)
+        body = yield dm.render_reply("links", "linux", "en")
+        self.assertNotIn("None", body)
+        help_body = yield dm.render_reply("help", None, None)
+        self.assertEqual(body, help_body)
+
+    @pytest_twisted.inlineCallbacks
+    def test_rate_limit(self):
+        settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        dbname = conftests.temp_db(settings)
+        limit = settings.get("twitter_requests_limit")
+        tp = conftests.TwitterParser(settings)
+        for i in range(limit + 1):
+            message_id = {'id': str(1000 + i), 'twitter_handle': '1467062174'}
+            request = tp.parse('linux', message_id)
+            yield tp.parse_callback(request)
+        yield tp.close()
+
+        conn = sqlite3.connect(dbname)
+        num = conn.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+        conn.close()
+        self.assertEqual(num, limit)
+
+    @pytest_twisted.inlineCallbacks
+    def test_reply_with_links(self):
+        settings = conftests.options.parse_settings("en","tests/test.conf.json")
+        conftests.temp_db(settings)
+        dm = conftests.twitterdm.Twitterdm(settings)
+        for language, locale in (("en", "en-US"), ("es", "es-ES")):
+            body = yield dm.render_reply("links", "linux", language)
+            url = "https://github/tor-linux-{}.bin".format(locale)
+            self.assertIn(url, body)
+
+        # Every reply rendered in advance, links included
+        yield dm.responses.refresh(dm.conn)
+        body = yield dm.responses.get("twitter", "links", "osx", "pt")
+        self.assertIn("https://gitlab/tor-osx-pt-BR.bin", body)
 
 if __name__ == "__main__":
     unittest.main()
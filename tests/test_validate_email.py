@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import time
+import random
+import pytest
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, reactor
+from twisted.names import dns, error
+from twisted.protocols import basic
+
+from . import conftests
+
+# Inputs of size about 4 * n that make backtracking address expressions
+# explode
+PATHOLOGICAL = [
+    lambda n: "(" + " " * (4 * n),
+    lambda n: "a" + " (x)" * n + "!",
+    lambda n: "(" + "\\a" * (2 * n) + "@",
+    lambda n: "\"" + " \\\" " * n,
+    lambda n: "a" * (4 * n) + "@" + "b." * n + ".",
+    lambda n: "a@[" + " 1" * (2 * n),
+    lambda n: "(" * (2 * n) + "a@b",
+    lambda n: "a@b" + " ( )" * n + "(",
+]
+
+class FakeResolver(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.lookups = 0
+
+    def lookupMailExchange(self, name):
+        self.lookups += 1
+        if self.fail:
+            return defer.fail(error.DNSNameError(name))
+        rr = dns.RRHeader(
+            name, dns.MX, payload=dns.Record_MX(10, b"127.0.0.1")
+        )
+        return defer.succeed(([rr], [], []))
+
+
+class FakeSMTP(basic.LineReceiver):
+    helos = []
+
+    def connectionMade(self):
+        self.sendLine(b"220 localhost ESMTP")
+
+    def lineReceived(self, line):
+        if line.startswith(b"HELO"):
+            self.helos.append(line)
+        if line.startswith(b"RCPT"):
+            known = b"<hiro@" in line
+            self.sendLine(b"250 OK" if known else b"550 No such user")
+        elif line == b"QUIT":
+            self.sendLine(b"221 Bye")
+            self.transport.loseConnection()
+        else:
+            self.sendLine(b"250 OK")
+
+
+class ValidateEmailTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+
+    def test_valid_addresses(self):
+        for addr in ["hiro@torproject.org", "a.b+c@d.e", "\"a b\"@x.org",
+                     "a@[127.0.0.1]", "(comment) a@b (comment)", "ñ@ñ.org"]:
+            self.assertTrue(conftests.validate_email.validate_email(addr), addr)
+
+    def test_invalid_addresses(self):
+        for addr in ["", "a", "@b", "a@", "a..b@c", "a@b.", "a b@c", "a@b@c",
+                     "\"a@b", "a@[b", "(a@b", "<a@b>"]:
+            self.assertFalse(conftests.validate_email.validate_email(addr), addr)
+
+    def test_bounded_time(self):
+        alphabet = "ab.@\"()[]\\ \t\r\n_-+1"
+
+        def inputs(n):
+            rnd = random.Random(2822)
+            return [p(n) for p in PATHOLOGICAL] + [
+                "".join(rnd.choice(alphabet) for _ in range(4 * n))
+                for i in range(20)
+            ]
+
+        def elapsed(addrs):
+            best = None
+            for i in range(3):
+                start = time.perf_counter()
+                for addr in addrs:
+                    conftests.validate_email.validate_email(addr)
+                    conftests.validate_email.autoresponder(addr)
+                total = time.perf_counter() - start
+                best = total if best is None else min(best, total)
+            return best
+
+        # Each check is linear, 8 times the input takes about 8 times as
+        # long, where quadratic checks would take 64 times
+        small = elapsed(inputs(500))
+        large = elapsed(inputs(4000))
+        self.assertLess(large, small * 32)
+
+    def test_autoresponder(self):
+        self.assertTrue(conftests.validate_email.autoresponder("MAILER-DAEMON@mx.org"))
+        self.assertTrue(conftests.validate_email.autoresponder("postmaster@x.sk"))
+        self.assertTrue(conftests.validate_email.autoresponder("gettor+en@torproject.org"))
+        self.assertFalse(conftests.validate_email.autoresponder("hiro@torproject.org"))
+
+class ValidateEmailAsyncTests(unittest.TestCase):
+
+    # Fail any tests which take longer than 15 seconds.
+    timeout = 15
+
+    def setUp(self):
+        conftests.validate_email.configure_caches(16, 60)
+        conftests.validate_email.MX_DNS_CACHE.clear()
+        conftests.validate_email.MX_CHECK_CACHE.clear()
+        factory = protocol.Factory.forProtocol(FakeSMTP)
+        self.port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.smtp_port = self.port.getHost().port
+
+    def tearDown(self):
+        print("tearDown()")
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_check_mx(self):
+        resolver = FakeResolver()
+        before = conftests.validate_email.cache_stats()
+        for i in range(3):
+            valid = yield conftests.validate_email.validate_email_async(
+                "hiro@torproject.org", check_mx=True, resolver=resolver,
+                smtp_port=self.smtp_port
+            )
+            self.assertTrue(valid)
+
+        # The domain is looked up and the MX host checked only once
+        self.assertEqual(resolver.lookups, 1)
+        stats = conftests.validate_email.cache_stats()
+        self.assertEqual(stats["dns"]["hits"] - before["dns"]["hits"], 2)
+        self.assertEqual(stats["check"]["hits"] - before["check"]["hits"], 2)
+
+    @defer.inlineCallbacks
+    def test_verify(self):
+        def getfqdn():
+            raise AssertionError("HELO name resolved in the reactor")
+        self.patch(conftests.validate_email.socket, "getfqdn", getfqdn)
+        self.patch(FakeSMTP, "helos", [])
+        resolver = FakeResolver()
+        valid = yield conftests.validate_email.validate_email_async(
+            "hiro@torproject.org", verify=True, resolver=resolver,
+            smtp_port=self.smtp_port, helo_name="gettor.example.org"
+        )
+        self.assertTrue(valid)
+        self.assertEqual(FakeSMTP.helos, [b"HELO gettor.example.org"])
+        valid = yield conftests.validate_email.validate_email_async(
+            "nobody@torproject.org", verify=True, resolver=resolver,
+            smtp_port=self.smtp_port, helo_name="gettor.example.org"
+        )
+        self.assertIsNone(valid)
+
+    @defer.inlineCallbacks
+    def test_nxdomain(self):
+        resolver = FakeResolver(fail=True)
+        for i in range(2):
+            valid = yield conftests.validate_email.validate_email_async(
+                "hiro@nonexistent.invalid", check_mx=True, resolver=resolver
+            )
+            self.assertFalse(valid)
+        self.assertEqual(resolver.lookups, 1)
+
+    @defer.inlineCallbacks
+    def test_invalid_address(self):
+        valid = yield conftests.validate_email.validate_email_async(
+            "a..b@c", check_mx=True, resolver=FakeResolver(fail=True)
+        )
+        self.assertFalse(valid)
+
+if __name__ == "__main__":
+    unittest.main()